@@ -3,17 +3,47 @@ from __future__ import print_function
 import os
 import sys
 import re
+import bz2
+import codecs
 import copy
+import gzip
+import io
+import json
+import mmap
+import struct
 import unittest
 import tempfile
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import islice
+from operator import is_
 from datetime import date, datetime
 from decimal import Decimal
 
+from six import PY3
 from six import StringIO
 from six import string_types as basestring # pylint: disable=redefined-builtin
 
 import dateutil.parser
 
+try:
+    from collections.abc import Mapping, MutableMapping, MutableSequence
+except ImportError:
+    from collections import Mapping, MutableMapping, MutableSequence
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for the columnar storage.
+    np = None
+
+try:
+    import lzma
+except ImportError:
+    # Only needed for xz compressed files.
+    lzma = None
+
 MISSING = '?'
 
 def is_numeric(v):
@@ -66,6 +96,73 @@ def convert_weka_to_py_date_pattern(p):
     p = p.replace('ss', r'%S')
     return p
 
+# Python pattern of the default Weka date format, formatted and parsed
+# without going through strftime() and strptime().
+ISO_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Upper bound on the number of values remembered by each DateCodec.
+DATE_CACHE_SIZE = 10000
+
+_fromisoformat = getattr(datetime, 'fromisoformat', None)
+
+class DateCodec(object):
+    """
+    Parses and formats the values of a date attribute, with its Weka date
+    pattern translated once.
+    
+    Strings are parsed with the attribute's own format first, and only with
+    the much slower dateutil parser if that fails. The most recent values
+    are remembered, since time series often repeat the same timestamps.
+    """
+
+    def __init__(self, weka_format=None, cache_size=DATE_CACHE_SIZE):
+        self.weka_format = weka_format or DEFAULT_DATE_FORMAT
+        self.py_format = convert_weka_to_py_date_pattern(self.weka_format)
+        self.cache_size = cache_size
+        self._iso = self.py_format == ISO_DATE_FORMAT
+        self._parsed = {}
+        self._formatted = {}
+
+    def _remember(self, cache, key, value):
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[key] = value
+
+    def parse(self, s):
+        """
+        Converts a string into a datetime.
+        """
+        value = self._parsed.get(s)
+        if value is None:
+            try:
+                if self._iso and _fromisoformat is not None:
+                    value = _fromisoformat(s)
+                else:
+                    value = datetime.strptime(s, self.py_format)
+            except ValueError:
+                value = dateutil.parser.parse(s)
+            self._remember(self._parsed, s, value)
+        return value
+
+    def format(self, v):
+        """
+        Converts a datetime, date or date string into a string in the
+        attribute's format.
+        """
+        s = self._formatted.get(v)
+        if s is None:
+            key = v
+            if isinstance(v, basestring):
+                v = self.parse(v)
+            else:
+                assert isinstance(v, (date, datetime))
+            if self._iso and isinstance(v, datetime) and v.year >= 1000:
+                s = '%i-%02i-%02i %02i:%02i:%02i' % (v.year, v.month, v.day, v.hour, v.minute, v.second)
+            else:
+                s = v.strftime(self.py_format)
+            self._remember(self._formatted, key, s)
+        return s
+
 def cmp(a, b): # pylint: disable=redefined-builtin
     return (a > b) - (a < b)
 
@@ -223,6 +320,717 @@ def wrap_value(v):
     except ValueError:
         pass
 
+class NominalValues(object):
+    """
+    The ordered values of a nominal attribute.
+
+    Each value's code is its position in the order values were declared or
+    first seen, and lookups in either direction take constant time. Sets
+    are added in sorted order, so their codes don't depend on hashing.
+    """
+
+    __slots__ = ('_values', '_codes')
+
+    def __init__(self, values=()):
+        self._values = []
+        self._codes = {}
+        self.update(values)
+
+    def add(self, value):
+        """
+        Adds a value if it's new, and returns its code.
+        """
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self._values)
+            self._values.append(value)
+        return code
+
+    def update(self, values):
+        if isinstance(values, (set, frozenset)):
+            values = sorted(values)
+        for value in values:
+            self.add(value)
+
+    def code(self, value):
+        """
+        Returns the code of a value, raising KeyError if it's unknown.
+        """
+        return self._codes[value]
+
+    # Values used to be stored in lists, so the list methods that still
+    # make sense are kept for existing callers.
+
+    def index(self, value):
+        """
+        Returns the code of a value, raising ValueError if it's unknown,
+        like list.index().
+        """
+        try:
+            return self._codes[value]
+        except KeyError:
+            raise ValueError('%r is not a nominal value' % (value,))
+
+    def count(self, value):
+        return int(value in self._codes)
+
+    def append(self, value):
+        self.add(value)
+
+    def extend(self, values):
+        self.update(values)
+
+    def value(self, code):
+        return self._values[code]
+
+    def intern(self, value):
+        """
+        Returns the stored instance equal to the given value, so rows share
+        one copy of each value instead of holding their own.
+        """
+        return self._values[self._codes[value]]
+
+    def copy(self):
+        return NominalValues(self._values)
+
+    def __getstate__(self):
+        return (self._values,)
+
+    def __setstate__(self, state):
+        self._values = []
+        self._codes = {}
+        self.update(state[0])
+
+    def __contains__(self, value):
+        return value in self._codes
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, code):
+        return self._values[code]
+
+    def __eq__(self, other):
+        if isinstance(other, NominalValues):
+            return self._values == other._values
+        elif isinstance(other, (list, tuple)):
+            return self._values == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'NominalValues(%r)' % (self._values,)
+
+def as_nominal_values(values):
+    """
+    Returns the given nominal values as a NominalValues instance,
+    converting lists, tuples and sets.
+    """
+    if isinstance(values, NominalValues):
+        return values
+    return NominalValues(values or ())
+
+class SparseRow(MutableMapping):
+    """
+    A row parsed from a sparse data line.
+
+    Only the attribute indexes and the plain values of the line are kept,
+    in two parallel arrays, along with the attribute list and name lookup
+    shared by all rows of the same schema, instead of a dictionary of Value
+    instances per row. It reads like that dictionary though: each lookup
+    returns a new Value of the attribute's type, so changing a value means
+    assigning it back to the row.
+    """
+
+    __slots__ = ('_attributes', '_positions', '_indexes', '_values')
+
+    def __init__(self, attributes, positions, indexes=(), values=()):
+        # ((name, ValueClass), ...) in schema order.
+        self._attributes = attributes
+        # {name: schema index}
+        self._positions = positions
+        indexes = list(indexes)
+        values = list(values)
+        if any(a >= b for a, b in zip(indexes, indexes[1:])):
+            pairs = sorted(zip(indexes, values), key=lambda pair: pair[0])
+            indexes = [i for i, _ in pairs]
+            values = [v for _, v in pairs]
+        self._indexes = array('i', indexes)
+        self._values = values
+
+    def _find(self, name):
+        """
+        Returns the position of the named attribute's value in the arrays,
+        or -1 if the row doesn't contain it.
+        """
+        index = self._positions.get(name)
+        if index is None:
+            return -1
+        indexes = self._indexes
+        pos = bisect_left(indexes, index)
+        if pos < len(indexes) and indexes[pos] == index:
+            return pos
+        return -1
+
+    def _wrap(self, pos):
+        value = self._values[pos]
+        if value == MISSING:
+            return Str(value)
+        return self._attributes[self._indexes[pos]][1](value)
+
+    def __getitem__(self, name):
+        pos = self._find(name)
+        if pos < 0:
+            raise KeyError(name)
+        return self._wrap(pos)
+
+    def get(self, name, default=None):
+        pos = self._find(name)
+        if pos < 0:
+            return default
+        return self._wrap(pos)
+
+    def __contains__(self, name):
+        return self._find(name) >= 0
+
+    def __setitem__(self, name, value):
+        index = self._positions.get(name)
+        if index is None:
+            raise KeyError('Unknown attribute %s.' % (name,))
+        if isinstance(value, Value):
+            value = value.value
+        pos = bisect_left(self._indexes, index)
+        if pos < len(self._indexes) and self._indexes[pos] == index:
+            self._values[pos] = value
+        else:
+            self._indexes.insert(pos, index)
+            self._values.insert(pos, value)
+
+    def __delitem__(self, name):
+        pos = self._find(name)
+        if pos < 0:
+            raise KeyError(name)
+        del self._indexes[pos]
+        del self._values[pos]
+
+    def __iter__(self):
+        attributes = self._attributes
+        for index in self._indexes:
+            yield attributes[index][0]
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def items(self):
+        return [(self._attributes[self._indexes[pos]][0], self._wrap(pos)) for pos in range(len(self._indexes))]
+
+    def __getstate__(self):
+        return (self._attributes, self._positions, self._indexes, self._values)
+
+    def __setstate__(self, state):
+        self._attributes, self._positions, self._indexes, self._values = state
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class RowView(MutableSequence):
+    """
+    A list of rows read from another list without copying it, optionally
+    through a selection of row positions and a function projecting each row.
+
+    The shared list is never modified. The first change made through the
+    view copies its rows into a private list, which later changes go to.
+    The rows themselves are always shared, as in a shallow copy, so
+    replace them rather than changing them in place. Projected rows are
+    built each time they're read.
+    """
+
+    def __init__(self, rows, indexes=None, projection=None):
+        self._rows = rows
+        # Positions in rows of the viewed rows, or None for all.
+        self._indexes = indexes
+        self._projection = projection
+        self._own = None
+
+    def view(self, indexes=None, projection=None):
+        """
+        Returns a new view of the rows at the given positions of this one,
+        projected after this view's own projection.
+        """
+        if self._own is not None:
+            # Share the private rows from now on, so neither view can
+            # modify the other's.
+            self._rows = self._own
+            self._indexes = self._projection = self._own = None
+        if self._indexes is not None and indexes is not None:
+            indexes = array('l', [self._indexes[i] for i in indexes])
+        elif indexes is None:
+            indexes = self._indexes
+        outer = self._projection
+        if outer is not None and projection is not None:
+            inner = projection
+            projection = lambda row: inner(outer(row))
+        elif projection is None:
+            projection = outer
+        return RowView(self._rows, indexes, projection)
+
+    def _materialize(self):
+        if self._own is None:
+            self._own = list(self)
+            self._rows = self._indexes = self._projection = None
+        return self._own
+
+    def __len__(self):
+        if self._own is not None:
+            return len(self._own)
+        if self._indexes is not None:
+            return len(self._indexes)
+        return len(self._rows)
+
+    def _get(self, i):
+        if self._indexes is not None:
+            i = self._indexes[i]
+        row = self._rows[i]
+        if self._projection is not None:
+            row = self._projection(row)
+        return row
+
+    def __getitem__(self, i):
+        if self._own is not None:
+            return self._own[i]
+        if isinstance(i, slice):
+            return [self._get(j) for j in range(*i.indices(len(self)))]
+        return self._get(i)
+
+    def __iter__(self):
+        if self._own is not None:
+            return iter(self._own)
+        rows = self._rows
+        if self._indexes is not None:
+            shared = rows
+            rows = (shared[i] for i in self._indexes)
+        if self._projection is not None:
+            projection = self._projection
+            return (projection(row) for row in rows)
+        return iter(rows)
+
+    def __setitem__(self, i, row):
+        self._materialize()[i] = row
+
+    def __delitem__(self, i):
+        del self._materialize()[i]
+
+    def insert(self, i, row):
+        self._materialize().insert(i, row)
+
+    def append(self, row):
+        self._materialize().append(row)
+
+    def extend(self, rows):
+        self._materialize().extend(rows)
+
+    def sort(self, *args, **kwargs):
+        self._materialize().sort(*args, **kwargs)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, RowView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # Copied and pickled as a plain list.
+        return (list, (list(self),))
+
+    def __repr__(self):
+        return repr(list(self))
+
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+XZ = 'xz'
+
+COMPRESSION_EXTENSIONS = {
+    '.gz': GZIP,
+    '.bz2': BZIP2,
+    '.xz': XZ,
+}
+
+# Leading bytes identifying each kind of compressed file.
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', GZIP),
+    (b'BZh', BZIP2),
+    (b'\xfd7zXZ\x00', XZ),
+)
+
+def get_compression(filename, mode='r'):
+    """
+    Returns the compression used by a file, or None if it's uncompressed.
+    Existing files being read are identified by their first bytes, and
+    others by their extension.
+    """
+    if 'r' in mode and os.path.isfile(filename):
+        with open(filename, 'rb') as fin:
+            head = fin.read(6)
+        for magic, compression in COMPRESSION_MAGIC:
+            if head.startswith(magic):
+                return compression
+        return None
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+def open_file(filename, mode='r', buffering=-1):
+    """
+    Opens a text file, transparently decompressing or compressing gzip,
+    bzip2 and xz files as they're read or written.
+    """
+    compression = get_compression(filename, mode)
+    if compression is None:
+        return open(filename, mode, buffering)
+    binary_mode = mode[0] + 'b'
+    if compression == GZIP:
+        f = gzip.GzipFile(filename, binary_mode)
+    elif compression == BZIP2:
+        f = bz2.BZ2File(filename, binary_mode)
+    else:
+        assert lzma is not None, 'The lzma module is required for xz files.'
+        f = lzma.LZMAFile(filename, binary_mode)
+    if not PY3:
+        # Python 2's compressed files can't be wrapped in a TextIOWrapper.
+        if binary_mode[0] == 'r':
+            return codecs.getreader('utf-8')(f)
+        return codecs.getwriter('utf-8')(f)
+    return io.TextIOWrapper(f, encoding='utf-8')
+
+# Number of lines joined into each write when saving data.
+WRITE_CHUNK_SIZE = 10000
+
+# Size in bytes of the file buffer used by open_stream().
+STREAM_BUFFER_SIZE = 1024*1024
+
+def write_lines(fout, lines, chunk_size=WRITE_CHUNK_SIZE):
+    """
+    Writes an iterable of data line strings to a file object in large
+    chunks, skipping empty lines.
+    """
+    chunk = []
+    for line in lines:
+        if line:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                chunk.append('')
+                fout.write('\n'.join(chunk))
+                chunk = []
+    if chunk:
+        chunk.append('')
+        fout.write('\n'.join(chunk))
+
+def smart_quote(s):
+    """
+    Quotes a sparse value if it contains spaces.
+    """
+    if isinstance(s, basestring) and ' ' in s and s[0] != '"':
+        s = '"%s"' % s
+    return s
+
+class _DenseLineWriter(object):
+    """
+    Writes list rows in dense format.
+    """
+
+    def __init__(self, arff):
+        self.formatters = []
+        for name in arff.attributes:
+            at = arff.attribute_types[name]
+            if at in NUMERIC_TYPES or at == TYPE_NOMINAL:
+                self.formatters.append(str)
+            elif at == TYPE_STRING:
+                self.formatters.append(arff.esc)
+            else:
+                self.formatters.append(self._unsupported(at))
+
+    @staticmethod
+    def _unsupported(at):
+        def f(e):
+            raise Exception("Type " + at + " not supported for writing!")
+        return f
+
+    def __call__(self, d):
+        assert not isinstance(d, Mapping), NotImplemented
+        return ','.join([f(e) for f, e in zip(self.formatters, d)])
+
+class _SparseLineWriter(object):
+    """
+    Writes list or dictionary rows in sparse format.
+    """
+
+    def __init__(self, arff):
+        self.arff = arff
+        self.attributes = list(arff.attributes)
+        self.index = dict((name, i) for i, name in enumerate(self.attributes))
+        # Formatters for values of dictionary rows.
+        self.formatters = []
+        # Formatters for values of list rows.
+        self.list_formatters = []
+        self.date_codecs = {}
+        for i, name in enumerate(self.attributes):
+            at = arff.attribute_types[name]
+            nominal_values = None
+            if at == TYPE_NOMINAL:
+                nominal_values = frozenset(map(str, arff.get_vocabulary(name)))
+            self.formatters.append(self._get_formatter(i, name, nominal_values))
+            self.list_formatters.append(self._get_list_formatter(i, name, at, nominal_values))
+
+    def _format_date(self, name, v):
+        codec = self.date_codecs.get(name)
+        if codec is None:
+            codec = self.date_codecs[name] = self.arff.get_date_codec(name)
+        return codec.format(v)
+
+    def _get_formatter(self, i, name, nominal_values):
+        prefix = '%i ' % i
+        missing = prefix + MISSING
+        def f(v):
+            if isinstance(v, Value):
+                if v.value == MISSING:
+                    return missing
+                elif isinstance(v, String):
+                    v = '"%s"' % v.value
+                elif isinstance(v, Date):
+                    v.value = v = self._format_date(name, v.value)
+                else:
+                    v = v.value
+            elif v == MISSING:
+                return missing
+            if nominal_values is not None and str(v) not in nominal_values:
+                return
+            return prefix + str(smart_quote(v))
+        return f
+
+    def _get_list_formatter(self, i, name, at, nominal_values):
+        prefix = '%i ' % i
+        formatter = self.formatters[i]
+        if at in (TYPE_NUMERIC, TYPE_REAL):
+            convert = lambda v: str(float(v))
+        elif at == TYPE_INTEGER:
+            convert = lambda v: str(int(v))
+        elif at == TYPE_STRING:
+            convert = lambda v: '"%s"' % v
+        elif at == TYPE_NOMINAL:
+            return formatter
+        elif at == TYPE_DATE:
+            convert = lambda v: smart_quote(self._format_date(name, v))
+        else:
+            raise Exception('Unknown type: %s' % at)
+        def f(v):
+            if isinstance(v, Value) or v == MISSING:
+                return formatter(v)
+            return prefix + convert(v)
+        return f
+
+    def __call__(self, d):
+        line = []
+        if isinstance(d, (list, tuple)):
+            for f, v in zip(self.list_formatters, d):
+                if v is not None:
+                    v = f(v)
+                    if v is not None:
+                        line.append(v)
+        elif isinstance(d, SparseRow):
+            # Format the stored values directly, instead of wrapping each one
+            # in a Value first.
+            index = self.index
+            attributes = d._attributes
+            cells = sorted(
+                (index[attributes[i][0]], v)
+                for i, v in zip(d._indexes, d._values)
+                if attributes[i][0] in index)
+            list_formatters = self.list_formatters
+            for i, v in cells:
+                v = list_formatters[i](v)
+                if v is not None:
+                    line.append(v)
+        else:
+            for f, name in zip(self.formatters, self.attributes):
+                v = d.get(name)
+                if v is not None:
+                    v = f(v)
+                    if v is not None:
+                        line.append(v)
+        if len(line) == 1 and MISSING in line[-1]:
+            # Skip lines with nothing other than a missing class.
+            return
+        elif not line:
+            # Don't write blank lines.
+            return
+        return '{' + (', '.join(line)) + '}'
+
+# Matches each "index value" pair of a sparse line, where values end at the
+# first comma not escaped with a backslash.
+SPARSE_VALUE_REGEX = re.compile(r'\s*([0-9]+)\s+((?:[^,\\]|\\.)+)')
+
+class _ParsePlan(object):
+    """
+    Per-schema converters used to parse data lines, compiled once
+    instead of being looked up for every value.
+    """
+
+    def __init__(self, arff):
+        self.attributes = list(arff.attributes)
+        self.size = len(arff.attributes)
+        self.numeric_type = arff.numeric_type
+        # Converters for values of dense lines, which are always strings.
+        line_converters = []
+        # Converters for values of list rows, which may be of any type.
+        value_converters = []
+        for name in arff.attributes:
+            at = arff.attribute_types[name]
+            if at == TYPE_INTEGER:
+                line_converters.append(int)
+                value_converters.append(int)
+            elif at in (TYPE_NUMERIC, TYPE_REAL):
+                if arff.numeric_type is float:
+                    line_converters.append(float)
+                    value_converters.append(float)
+                else:
+                    line_converters.append(Decimal)
+                    value_converters.append(lambda v: Decimal(str(v)))
+            elif at == TYPE_NOMINAL:
+                f = self._get_nominal_converter(name, arff.get_vocabulary(name))
+                line_converters.append(f)
+                value_converters.append(f)
+            else:
+                line_converters.append(str)
+                value_converters.append(lambda v: v)
+        self.line_converters = tuple(line_converters)
+        self.value_converters = tuple(value_converters)
+        self.sparse_attributes = tuple(
+            (name, TYPE_TO_CLASS[arff.attribute_types[name]])
+            for name in arff.attributes)
+        # Converters for values of sparse lines, storing the same plain
+        # values their Value instances would hold.
+        self.sparse_converters = tuple(
+            self._get_sparse_converter(arff, name)
+            for name in arff.attributes)
+        self.sparse_positions = dict((name, i) for i, name in enumerate(arff.attributes))
+        self.escaped_attributes = frozenset(arff.esc(a) for a in arff.attributes)
+        # The schema compiled, to detect direct edits, captured last since
+        # looking up vocabularies may replace lists assigned to attribute_data.
+        self.attribute_types = list(map(arff.attribute_types.get, self.attributes))
+        self.attribute_data = list(map(arff.attribute_data.get, self.attributes))
+
+    @staticmethod
+    def _get_nominal_converter(name, values):
+        codes = values._codes
+        stored = values._values
+        def f(v):
+            try:
+                return stored[codes[v]]
+            except KeyError:
+                raise Exception('Incorrect value %s for nominal attribute %s' % (v, name))
+        return f
+
+    @staticmethod
+    def _get_sparse_converter(arff, name):
+        at = arff.attribute_types[name]
+        if at == TYPE_INTEGER:
+            return int
+        elif at in (TYPE_NUMERIC, TYPE_REAL):
+            return float
+        elif at == TYPE_NOMINAL:
+            # Unknown values are kept as is.
+            values = arff.get_vocabulary(name)
+            codes = values._codes
+            stored = values._values
+            def f(v):
+                code = codes.get(v)
+                return v if code is None else stored[code]
+            return f
+        return str
+
+    def is_current(self, arff):
+        """
+        Returns True if the schema hasn't changed since the plan was compiled,
+        including direct edits to attributes, attribute_types or attribute_data.
+        """
+        attributes = arff.attributes
+        return self.attributes == attributes \
+            and self.numeric_type is arff.numeric_type \
+            and self.attribute_types == list(map(arff.attribute_types.get, attributes)) \
+            and all(map(is_, self.attribute_data, map(arff.attribute_data.get, attributes)))
+
+    def warn_size(self, l, lineno):
+        print("Warning: line %d contains %i values but it should contain %i values" % (lineno, len(l), self.size))
+
+    def split_line(self, l, lineno=0):
+        """
+        Splits a dense or sparse data line string into a tuple of the form
+        (sparse, values), where values are the unconverted value strings of
+        a dense line, or (index, value string) pairs for a sparse line.
+        
+        Dense lines with the wrong number of values are warned about, and
+        split into None.
+        """
+        l = l.strip()
+        if l.startswith('{'):
+            assert l.endswith('}'), 'Malformed sparse data line: %s' % (l,)
+            values = []
+            for index, value in SPARSE_VALUE_REGEX.findall(l, 1, len(l) - 1):
+                value = value.rstrip()
+                if value[0] == value[-1] and value[0] in ('"', "'"):
+                    # Strip quotes.
+                    value = value[1:-1]
+                values.append((int(index), value))
+            return True, values
+        # Convert string to list.
+        l = l.split(',')
+        if len(l) != self.size:
+            self.warn_size(l, lineno)
+            return False, None
+        return False, [v.strip() for v in l]
+
+    def parse_line(self, l, lineno=0):
+        """
+        Converts a dense or sparse data line string into a row.
+        """
+        sparse, values = self.split_line(l, lineno)
+        if sparse:
+            return self.parse_sparse(values)
+        elif values is not None:
+            return [
+                MISSING if v == MISSING else f(v)
+                for f, v in zip(self.line_converters, values)]
+
+    def parse_sparse(self, values):
+        """
+        Converts the (index, value string) pairs of a sparse line into a row.
+        """
+        indexes = []
+        row_values = []
+        converters = self.sparse_converters
+        for index, value in values:
+            indexes.append(index)
+            row_values.append(MISSING if value == MISSING else converters[index](value))
+        return SparseRow(self.sparse_attributes, self.sparse_positions, indexes, row_values)
+
 class ArffFile(object):
     """An ARFF File object describes a data set consisting of a number
     of data points made up of attributes. The whole data set is called
@@ -255,10 +1063,28 @@ class ArffFile(object):
     - 'comment': the initial comment in the file. Typically contains some
                  information on the data set.
     - 'data': the actual data, by data points.
+    - 'numeric_type': the type numeric and real values are parsed into,
+                      either Decimal, the default, or the faster float.
     """
-    def __init__(self, relation='', schema=None):
+    
+    numeric_type = Decimal
+    
+    _parse_plan = None
+    
+    _attribute_index = None
+    
+    _date_codecs = None
+    
+    _stream_writer = None
+    
+    _stream_schema = None
+    
+    def __init__(self, relation='', schema=None, numeric_type=Decimal):
         """Construct an empty ARFF structure."""
+        assert numeric_type in (Decimal, float), \
+            'Invalid numeric type "%s". Should be Decimal or float.' % (numeric_type,)
         self.relation = relation
+        self.numeric_type = numeric_type
         self.clear()
         
         # Load schema.
@@ -268,7 +1094,7 @@ class ArffFile(object):
                 self.attributes.append(name)
                 if isinstance(data, (tuple, list)):
                     self.attribute_types[name] = TYPE_NOMINAL
-                    self.attribute_data[name] = set(data)
+                    self.attribute_data[name] = NominalValues(data)
                 else:
                     self.attribute_types[name] = data
                     self.attribute_data[name] = None
@@ -276,13 +1102,27 @@ class ArffFile(object):
     def clear(self):
         self.attributes = [] # [attr_name, attr_name, ...]
         self.attribute_types = dict() # {attr_name:type}
-        self.attribute_data = dict() # {attr_name:[nominal values]}
+        self.attribute_data = dict() # {attr_name:NominalValues}
         self._filename = None
         self.comment = []
         self.data = []
         self.lineno = 0
         self.fout = None
         self.class_attr_name = None
+        self._parse_plan = None
+        self._attribute_index = None
+        self._date_codecs = {}
+    
+    def __getstate__(self):
+        # Compiled parsers and writers hold closures that can't be pickled,
+        # so they're dropped and rebuilt on first use.
+        state = self.__dict__.copy()
+        for name in ('_parse_plan', '_stream_writer', '_stream_schema'):
+            state.pop(name, None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
     
     def get_attribute_value(self, name, index):
         """
@@ -297,13 +1137,15 @@ class ArffFile(object):
             at = self.attribute_types[name]
             if at == TYPE_INTEGER:
                 return int(index)
+            if self.numeric_type is float:
+                return float(index)
             return Decimal(str(index))
         else:
             assert self.attribute_types[name] == TYPE_NOMINAL
             cls_index, cls_value = index.split(':')
             #return self.attribute_data[name][index-1]
             if cls_value != MISSING:
-                assert cls_value in self.attribute_data[name], \
+                assert cls_value in self.get_vocabulary(name), \
                     'Predicted value "%s" but only values %s are allowed.' \
                         % (cls_value, ', '.join(self.attribute_data[name]))
             return cls_value
@@ -312,82 +1154,377 @@ class ArffFile(object):
         return len(self.data)
     
     def __iter__(self):
+        """
+        Iterates over the rows as dictionaries keyed by attribute name.
+        """
+        names = self.get_clean_names()
+        size = len(names)
+        # Keys of dictionary rows are cleaned once, not once per row.
+        clean_names = dict(zip(self.attributes, names))
+        for d in self.data:
+            if isinstance(d, Mapping):
+                try:
+                    row = dict([(clean_names[k], v) for k, v in d.items()])
+                except KeyError:
+                    clean_names.update(
+                        (k, STRIP_QUOTES_REGEX.sub('', k)) for k in d if k not in clean_names)
+                    row = dict([(clean_names[k], v) for k, v in d.items()])
+                yield row
+            else:
+                assert len(d) == size
+                yield dict(zip(names, d))
+
+    def get_clean_names(self):
+        """
+        Returns the attribute names with any surrounding quotes removed.
+        """
+        return [STRIP_QUOTES_REGEX.sub('', _) for _ in self.attributes]
+
+    def iter_tuples(self):
+        """
+        Iterates over the rows as tuples of plain values in attribute order,
+        the cheapest shape to read. Values omitted from sparse rows are None.
+        """
+        attributes = self.attributes
+        size = len(attributes)
         for d in self.data:
-            named = dict(zip(
-                [re.sub(r'^[\'\"]|[\'\"]$', '', _) for _ in self.attributes],
-                d))
-            assert len(d) == len(self.attributes)
-            assert len(d) == len(named)
-            yield named
+            if isinstance(d, Mapping):
+                d = [d.get(name) for name in attributes]
+                yield tuple([v.value if isinstance(v, Value) else v for v in d])
+            else:
+                # Dense rows already hold plain values.
+                assert len(d) == size
+                yield tuple(d)
+
+    def get_record_class(self):
+        """
+        Returns a namedtuple class with a field per attribute. Names that
+        aren't valid identifiers have other characters replaced by
+        underscores, or are replaced by their position if that isn't enough.
+        """
+        fields = [re.sub(r'\W', '_', name) for name in self.get_clean_names()]
+        return namedtuple('Record', fields, rename=True)
+
+    def iter_records(self):
+        """
+        Iterates over the rows as records created by get_record_class().
+        """
+        make = self.get_record_class()._make
+        for values in self.iter_tuples():
+            yield make(values)
+
+    def iter_batches(self, batch_size=1000):
+        """
+        Iterates over the rows in batches of up to batch_size, each a
+        dictionary mapping every attribute name to a tuple of its values.
+        """
+        assert batch_size >= 1
+        names = self.get_clean_names()
+        rows = self.iter_tuples()
+        while 1:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return
+            yield dict(zip(names, zip(*batch)))
 
     @classmethod
-    def load(cls, filename, schema_only=False):
+    def load(cls, filename, schema_only=False, numeric_type=Decimal):
         """
         Load an ARFF File from a file.
         """
-        o = open(filename)
-        s = o.read()
-        a = cls.parse(s, schema_only=schema_only)
+        with open_file(filename) as o:
+            # Read line by line, so the raw file is never held in memory
+            # alongside the parsed data.
+            a = cls.parse_lines(
+                (l.rstrip('\r\n') for l in o),
+                schema_only=schema_only,
+                numeric_type=numeric_type)
         if not schema_only:
             a._filename = filename
-        o.close()
         return a
 
     @classmethod
-    def parse(cls, s, schema_only=False):
+    def parse(cls, s, schema_only=False, numeric_type=Decimal):
         """
         Parse an ARFF File already loaded into a string.
         """
-        a = cls()
+        return cls.parse_lines(s.splitlines(), schema_only=schema_only, numeric_type=numeric_type)
+
+    @classmethod
+    def parse_lines(cls, lines, schema_only=False, numeric_type=Decimal):
+        """
+        Parse an ARFF File from an iterable of lines without line endings.
+        """
+        a = cls(numeric_type=numeric_type)
         a.state = 'comment'
         a.lineno = 1
-        for l in s.splitlines():
+        lines = iter(lines)
+        for l in lines:
             a.parseline(l)
             a.lineno += 1
-            if schema_only and a.state == 'data':
-                # Don't parse data if we're only loading the schema.
+            if a.state == 'data':
                 break
+        # Don't parse data if we're only loading the schema.
+        if not schema_only:
+            a._parse_data_lines(lines)
+        return a
+
+    def to_numpy(self):
+        """
+        Returns the data as an ArffColumns instance, holding one NumPy
+        array per attribute.
+        """
+        return ArffColumns.from_rows(self, self.data)
+
+    @classmethod
+    def from_numpy(cls, columns):
+        """
+        Creates an ARFF File with dense rows from an ArffColumns instance.
+        """
+        schema = columns.schema
+        a = cls(relation=schema.relation, numeric_type=schema.numeric_type)
+        a.attributes = list(schema.attributes)
+        a.attribute_types = schema.attribute_types.copy()
+        a.attribute_data = schema.attribute_data.copy()
+        a.class_attr_name = schema.class_attr_name
+        a.comment = copy.copy(schema.comment)
+        a.data = list(columns.iter_rows())
         return a
 
+    def save_binary(self, filename, fmt=None):
+        """
+        Saves the data in the compact binary format read by load_binary().
+        See ArffColumns.save_binary().
+        """
+        self.to_numpy().save_binary(filename, fmt=fmt)
+
+    @classmethod
+    def load_binary(cls, filename):
+        """
+        Creates an ARFF File with dense rows from a file written by
+        save_binary().
+        """
+        with ArffColumns.load_binary(filename) as columns:
+            return cls.from_numpy(columns)
+
+    @classmethod
+    def iter_rows(cls, filename, numeric_type=Decimal):
+        """
+        Iterates over the data rows of an ARFF file without loading
+        the file into memory.
+        Dense rows are yielded as lists and sparse rows as dictionaries,
+        the same as they would appear in the data attribute.
+        """
+        with ArffReader(filename, arff_class=cls, numeric_type=numeric_type) as reader:
+            for row in reader:
+                yield row
+
+    @classmethod
+    def open_indexed(cls, filename, **kwargs):
+        """
+        Opens an ARFF file for random access to its rows, returning an
+        IndexedArffFile.
+        """
+        return IndexedArffFile(filename, arff_class=cls, **kwargs)
+
     def copy(self, schema_only=False):
         """
         Creates a deepcopy of the instance.
         If schema_only is True, the data will be excluded from the copy.
+        See view() for a copy sharing the rows instead.
         """
-        o = type(self)()
+        o = type(self)(numeric_type=self.numeric_type)
         o.relation = self.relation
         o.attributes = list(self.attributes)
         o.attribute_types = self.attribute_types.copy()
-        o.attribute_data = self.attribute_data.copy()
+        o.attribute_data = dict(
+            (name, data.copy() if isinstance(data, NominalValues) else data)
+            for name, data in self.attribute_data.items())
+        o.class_attr_name = self.class_attr_name
         if not schema_only:
             o.comment = list(self.comment)
-            o.data = copy.deepcopy(self.data)
+            o.data = copy.deepcopy(list(self.data))
         return o
 
-    def flush(self):
-        if self.fout:
-            self.fout.flush()
-
-    def open_stream(self, class_attr_name=None, fn=None):
+    def view(self, mask=None):
         """
-        Save an arff structure to a file, leaving the file object
-        open for writing of new data samples.
+        Returns a copy holding the same row objects instead of duplicates,
+        optionally only the rows selected by mask, as in filter().
+        
+        Like a shallow copy of a list, adding, removing or replacing rows
+        in either instance doesn't affect the other, but changing a row in
+        place changes it in both, so replace rows instead, or use copy() or
+        filter().
+        """
+        o = self.copy(schema_only=True)
+        o.comment = list(self.comment)
+        o.data = self._view_data(indexes=None if mask is None else self._get_indexes(mask))
+        return o
+
+    def _view_data(self, indexes=None, projection=None):
+        """
+        Returns a RowView of the data, at the given row positions if any.
+        
+        Views of a view share its rows. A plain list is left as it is, and
+        the view reads a shallow copy of it instead, so that neither can
+        add, remove or replace the other's rows.
+        """
+        data = self.data
+        if isinstance(data, RowView):
+            return data.view(indexes, projection)
+        if indexes is None:
+            rows = list(data)
+        else:
+            rows = [data[i] for i in indexes]
+        return RowView(rows, projection=projection)
+
+    def _get_indexes(self, mask):
+        """
+        Returns the positions of the rows selected by a mask given to filter().
+        """
+        if callable(mask):
+            return array('l', [i for i, row in enumerate(self.data) if mask(row)])
+        assert len(mask) == len(self.data), \
+            'Mask has %i values but there are %i rows.' % (len(mask), len(self.data))
+        return array('l', [i for i, keep in enumerate(mask) if keep])
+
+    def filter(self, mask):
+        """
+        Returns a deepcopy holding only some of the rows, selected either by
+        a sequence of booleans, one per row, or a function called with each
+        row.
+        
+        Use view(mask) to share the selected rows instead of copying them.
+        """
+        o = self.view(mask)
+        o.data = copy.deepcopy(list(o.data))
+        return o
+
+    def select(self, columns):
+        """
+        Returns a copy holding only the given attributes, kept in their
+        current order.
+        
+        Rows are projected as they're read instead of being duplicated,
+        so they can't be changed in place.
+        """
+        columns = frozenset(columns)
+        index = self.attribute_index
+        for name in columns:
+            assert name in index, 'Unknown attribute %s.' % (name,)
+        attributes = [name for name in self.attributes if name in columns]
+        positions = [index[name] for name in attributes]
+        def project(row):
+            if isinstance(row, Mapping):
+                return dict((k, v) for k, v in row.items() if k in columns)
+            return [row[i] for i in positions]
+        o = self.copy(schema_only=True)
+        o.comment = list(self.comment)
+        o.attributes = attributes
+        o.attribute_types = dict((name, self.attribute_types[name]) for name in attributes)
+        o.attribute_data = dict((name, o.attribute_data.get(name)) for name in attributes)
+        if o.class_attr_name not in columns:
+            o.class_attr_name = None
+        o.data = self._view_data(projection=project)
+        return o
+
+    def flush(self):
+        if self.fout:
+            self.fout.flush()
+
+    def open_stream(self, class_attr_name=None, fn=None, buffer_size=STREAM_BUFFER_SIZE):
+        """
+        Save an arff structure to a file, leaving the file object
+        open for writing of new data samples.
         This prevents you from directly accessing the data via Python,
         but when generating a huge file, this prevents all your data
         from being stored in memory.
+        
+        Rows are buffered, buffer_size bytes at a time, and only flushed to
+        disk by flush() or close_stream().
         """
         if fn:
             self.fout_fn = fn
         else:
             fd, self.fout_fn = tempfile.mkstemp()
             os.close(fd)
-        self.fout = open(self.fout_fn, 'w')
+        self.fout = open_file(self.fout_fn, 'w', buffer_size)
         if class_attr_name:
             self.class_attr_name = class_attr_name
         self.write(fout=self.fout, schema_only=True)
         self.write(fout=self.fout, data_only=True)
         self.fout.flush()
+        self._compile_stream()
         
+    def _compile_stream(self):
+        """
+        Prepares the writer and schema checks used for every streamed row,
+        since the schema can't change once it's been written.
+        """
+        self._stream_writer = self.get_line_writer(SPARSE)
+        self._stream_schema = dict(
+            (name, (at, frozenset(self.attribute_data.get(name) or ()) if at == TYPE_NOMINAL else None))
+            for name, at in self.attribute_types.items())
+
+    def _validate_stream_row(self, line):
+        """
+        Checks a dictionary row against the streamed schema, removing values
+        the schema doesn't allow.
+        """
+        schema = self._stream_schema
+        for k, v in list(line.items()):
+            try:
+                at, nominal_values = schema[k]
+            except KeyError:
+                # Remove feature that violates the schema.
+                del line[k]
+                continue
+            if not isinstance(v, Value):
+                if v == MISSING:
+                    continue
+                v = TYPE_TO_CLASS[at](v)
+            if v.value != MISSING:
+                assert at == v.c_type, \
+                    ('Attempting to set attribute %s to type %s but it is already defined as type %s.') % (k, at, v.c_type)
+            if isinstance(v, Nominal) and v.value not in nominal_values:
+                del line[k]
+            if v.cls:
+                if self.class_attr_name is None:
+                    self.class_attr_name = k
+                else:
+                    assert self.class_attr_name == k, \
+                        ('Attempting to set class to "%s" when it has already been set to "%s"') % (k, self.class_attr_name)
+
+    def _format_stream_row(self, line, update_schema=True):
+        """
+        Returns the line written to the stream for a row, or None if
+        nothing is written.
+        """
+        if self._stream_writer is None:
+            self._compile_stream()
+        if isinstance(line, Mapping):
+            if update_schema:
+                self._validate_stream_row(line)
+        else:
+            if isinstance(line, basestring):
+                assert not line.strip().startswith('{'), NotImplemented
+            line = self._convert_data(line)
+            if line is None:
+                return
+        return self._stream_writer(line)
+
+    def append_many(self, rows, update_schema=True):
+        """
+        Appends each of the given rows. When streaming, the rows are
+        formatted and written out in large chunks.
+        """
+        if not self.fout:
+            for row in rows:
+                self.append(row, update_schema=update_schema)
+            return
+        write_lines(self.fout, (self._format_stream_row(row, update_schema) for row in rows))
+
+
     def close_stream(self):
         """
         Terminates an open stream and returns the filename
@@ -400,6 +1537,8 @@ class ArffFile(object):
             self.fout.close()
             self.fout = None
             self.fout_fn = None
+            self._stream_writer = None
+            self._stream_schema = None
             return fout_fn
 
     def save(self, filename=None):
@@ -407,94 +1546,31 @@ class ArffFile(object):
         Save an arff structure to a file.
         """
         filename = filename or self._filename
-        o = open(filename, 'w')
-        o.write(self.write())
-        o.close()
+        with open_file(filename, 'w') as fout:
+            self.write(fout=fout)
 
     def write_line(self, d, fmt=SPARSE):
         """
         Converts a single data line to a string.
-        """
         
-        def smart_quote(s):
-            if isinstance(s, basestring) and ' ' in s and s[0] != '"':
-                s = '"%s"' % s
-            return s
+        When writing many lines, use get_line_writer() instead, so the
+        schema is only compiled once.
+        """
+        return self.get_line_writer(fmt)(d)
+
+    def get_line_writer(self, fmt=SPARSE):
+        """
+        Returns a function converting a single data line to a string,
+        or None if the line shouldn't be written, like write_line().
         
+        The per-attribute formatters and nominal value sets are
+        precomputed, so the schema must not change while it's in use.
+        """
         if fmt == DENSE:
-            assert not isinstance(d, dict), NotImplemented
-            line = []
-            for e, a in zip(d, self.attributes):
-                at = self.attribute_types[a]
-                if at in NUMERIC_TYPES:
-                    line.append(str(e))
-                elif at == TYPE_STRING:
-                    line.append(self.esc(e))
-                elif at == TYPE_NOMINAL:
-                    line.append(e)
-                else:
-                    raise Exception("Type " + at + " not supported for writing!")
-            s = ','.join(map(str, line))
-            return s
+            return _DenseLineWriter(self)
         elif fmt == SPARSE:
-            line = []
-            
-            # Convert flat row into dictionary.
-            if isinstance(d, (list, tuple)):
-                d = dict(zip(self.attributes, d))
-                for k in d:
-                    at = self.attribute_types.get(k)
-                    if isinstance(d[k], Value):
-                        continue
-                    elif d[k] == MISSING:
-                        d[k] = Str(d[k])
-                    elif at in (TYPE_NUMERIC, TYPE_REAL):
-                        d[k] = Num(d[k])
-                    elif at == TYPE_STRING:
-                        d[k] = Str(d[k])
-                    elif at == TYPE_INTEGER:
-                        d[k] = Int(d[k])
-                    elif at == TYPE_NOMINAL:
-                        d[k] = Nom(d[k])
-                    elif at == TYPE_DATE:
-                        d[k] = Date(d[k])
-                    else:
-                        raise Exception('Unknown type: %s' % at)
-
-            for i, name in enumerate(self.attributes):
-                v = d.get(name)
-                if v is None:
-                    continue
-                elif v == MISSING or (isinstance(v, Value) and v.value == MISSING):
-                    v = MISSING
-                elif isinstance(v, String):
-                    v = '"%s"' % v.value
-                elif isinstance(v, Date):
-                    date_format = self.attribute_data.get(name, DEFAULT_DATE_FORMAT)
-                    date_format = convert_weka_to_py_date_pattern(date_format)
-                    if isinstance(v.value, basestring):
-                        _value = dateutil.parser.parse(v.value)
-                    else:
-                        assert isinstance(v.value, (date, datetime))
-                        _value = v.value
-                    v.value = v = _value.strftime(date_format)
-                elif isinstance(v, Value):
-                    v = v.value
-
-                if v != MISSING and self.attribute_types[name] == TYPE_NOMINAL and str(v) not in map(str, self.attribute_data[name]):
-                    pass
-                else:
-                    line.append('%i %s' % (i, smart_quote(v)))
-
-            if len(line) == 1 and MISSING in line[-1]:
-                # Skip lines with nothing other than a missing class.
-                return
-            elif not line:
-                # Don't write blank lines.
-                return
-            return '{' + (', '.join(line)) + '}'
-        else:
-            raise Exception('Uknown format: %s' % (fmt,))
+            return _SparseLineWriter(self)
+        raise Exception('Uknown format: %s' % (fmt,))
 
     def write_attributes(self, fout=None):
         close = False
@@ -540,10 +1616,7 @@ class ArffFile(object):
             self.write_attributes(fout=fout)
         if not schema_only:
             print("@data", file=fout)
-            for d in self.data:
-                line_str = self.write_line(d, fmt=fmt)
-                if line_str:
-                    print(line_str, file=fout)
+            write_lines(fout, map(self.get_line_writer(fmt), self.data))
         if isinstance(fout, StringIO) and close:
             return fout.getvalue()
 
@@ -559,10 +1632,56 @@ class ArffFile(object):
         For nominal attributes, pass the possible values as data.
         For date attributes, pass the format as data.
         """
-        self.attributes.append(name)
+        self._add_attribute(name)
         assert atype in TYPES, "Unknown type '%s'. Must be one of: %s" % (atype, ', '.join(TYPES),)
         self.attribute_types[name] = atype
+        if atype == TYPE_NOMINAL:
+            data = as_nominal_values(data)
         self.attribute_data[name] = data
+        self._parse_plan = None
+
+    @property
+    def attribute_index(self):
+        """
+        A dictionary mapping each attribute name to its position in attributes.
+        It's rebuilt only when the attributes differ from the names it was
+        built for, including when they're reordered in place.
+        """
+        index = self._attribute_index
+        if index is None or index[0] != self.attributes:
+            index = self._attribute_index = (
+                list(self.attributes),
+                dict((name, i) for i, name in enumerate(self.attributes)))
+        return index[1]
+
+    def _add_attribute(self, name):
+        """
+        Appends a name to attributes, keeping the attribute index current.
+        """
+        index = self._attribute_index
+        if index is not None:
+            # If the index was already stale, it still won't match the
+            # attributes, so it's rebuilt when next used.
+            index[0].append(name)
+            index[1][name] = len(self.attributes)
+        self.attributes.append(name)
+
+    def _move_class_last(self):
+        """
+        Ensures the class attribute is the last one listed,
+        as that's assumed to be the class unless otherwise specified.
+        Returns True if the attributes were reordered.
+        """
+        name = self.class_attr_name
+        if not name or not self.attributes or self.attributes[-1] == name:
+            return False
+        index = self.attribute_index
+        if name not in index:
+            return False
+        del self.attributes[index[name]]
+        self.attributes.append(name)
+        self._attribute_index = None
+        return True
 
     def parseline(self, l):
         if self.state == 'comment':
@@ -612,71 +1731,65 @@ class ArffFile(object):
             raise NotImplementedError("Unsupported type " + atype + " for attribute " + name + ".")
 
     def _parse_data(self, l):
+        if self.fout:
+            # If we're streaming out data, then don't even bother saving it to
+            # memory and just write it out to disk instead.
+            line_str = self._format_stream_row(l)
+            if line_str:
+                self.fout.write(line_str + '\n')
+            return
+        datum = self._convert_data(l)
+        if datum is not None:
+            self.data.append(datum)
+
+    def _get_parse_plan(self):
+        """
+        Returns the parse plan for the current schema, compiling it if
+        the schema changed since it was last used.
+        """
+        plan = self._parse_plan
+        if plan is None or not plan.is_current(self):
+            plan = self._parse_plan = _ParsePlan(self)
+        return plan
+
+    def _convert_data(self, l):
+        """
+        Converts a single data line, given as a string, list or dictionary,
+        into the row stored in the data attribute.
+        Returns None if the line doesn't match the schema.
+        """
+        plan = self._get_parse_plan()
         if isinstance(l, basestring):
-            l = l.strip()
-            if l.startswith('{'):
-                assert l.endswith('}'), 'Malformed sparse data line: %s' % (l,)
-                assert not self.fout, NotImplemented
-                dline = {}
-                parts = re.split(r'(?<!\\),', l[1:-1])
-                for part in parts:
-                    index, value = re.findall(r'(^[0-9]+)\s+(.*)$', part.strip())[0]
-                    index = int(index)
-                    if value[0] == value[-1] and value[0] in ('"', "'"):
-                        # Strip quotes.
-                        value = value[1:-1]
-                    name = self.attributes[index]
-                    ValueClass = TYPE_TO_CLASS[self.attribute_types[name]]
-                    if value == MISSING:
-                        dline[name] = Str(value)
-                    else:
-                        dline[name] = ValueClass(value)
-                self.data.append(dline)
-                return
-            else:
-                # Convert string to list.
-                l = [s.strip() for s in l.split(',')]
-        elif isinstance(l, dict):
-            assert len(l) == len(self.attributes), \
+            return plan.parse_line(l, self.lineno)
+        elif isinstance(l, Mapping):
+            assert len(l) == plan.size, \
                 "Sparse data not supported."
-            # Convert dict to list.
-            #l = dict((k,v) for k,v in l.iteritems())
             # Confirm complete feature name overlap.
-            assert set(self.esc(a) for a in l) == \
-                set(self.esc(a) for a in self.attributes)
+            assert set(self.esc(a) for a in l) == plan.escaped_attributes
+            # Convert dict to list.
             l = [l[name] for name in self.attributes]
         else:
             # Otherwise, confirm list.
             assert isinstance(l, (tuple, list))
-        if len(l) != len(self.attributes):
-            print("Warning: line %d contains %i values but it should contain %i values" % (self.lineno, len(l), len(self.attributes)))
-            return 
-
-        datum = []
-        for n, v in zip(self.attributes, l):
-            at = self.attribute_types[n]
-            if v == MISSING:
-                datum.append(v)
-            elif at == TYPE_INTEGER:
-                datum.append(int(v))
-            elif at in (TYPE_NUMERIC, TYPE_REAL):
-                datum.append(Decimal(str(v)))
-            elif at == TYPE_STRING:
-                datum.append(v)
-            elif at == TYPE_NOMINAL:
-                if v in self.attribute_data[n]:
-                    datum.append(v)
-                else:
-                    raise Exception('Incorrect value %s for nominal attribute %s' % (v, n))
-        if self.fout:
-            # If we're streaming out data, then don't even bother saving it to
-            # memory and just flush it out to disk instead.
-            line_str = self.write_line(datum)
-            if line_str:
-                print(line_str, file=self.fout)
-            self.fout.flush()
-        else:
-            self.data.append(datum)
+        if len(l) != plan.size:
+            plan.warn_size(l, self.lineno)
+            return
+        return [
+            MISSING if v == MISSING else f(v)
+            for f, v in zip(plan.value_converters, l)]
+
+    def _parse_data_lines(self, lines):
+        """
+        Parses and stores the remaining lines of the data section.
+        """
+        parse_line = self._get_parse_plan().parse_line
+        append = self.data.append
+        for l in lines:
+            if l and l[0] != '%':
+                datum = parse_line(l, self.lineno)
+                if datum is not None:
+                    append(datum)
+            self.lineno += 1
 
     def __print_warning(self, msg):
         print(('Warning (line %d): ' % self.lineno) + msg)
@@ -694,91 +1807,804 @@ class ArffFile(object):
             print(d)
     
     def set_class(self, name):
-        assert name in self.attributes
-        self.attributes.remove(name)
-        self.attributes.append(name)
+        index = self.attribute_index
+        assert name in index
+        if index[name] != len(self.attributes) - 1:
+            del self.attributes[index[name]]
+            self.attributes.append(name)
+            self._attribute_index = None
+            self._parse_plan = None
     
     def set_nominal_values(self, name, values):
-        assert name in self.attributes
+        assert name in self.attribute_types
         assert self.attribute_types[name] == TYPE_NOMINAL
-        self.attribute_data.setdefault(name, set())
-        self.attribute_data[name] = set(self.attribute_data[name])
-        self.attribute_data[name].update(values)
+        self.get_vocabulary(name).update(values)
+        self._parse_plan = None
+    
+    def get_date_codec(self, name):
+        """
+        Returns the DateCodec for a date attribute's current format, reused
+        so its remembered values are shared by every write.
+        """
+        if self._date_codecs is None:
+            self._date_codecs = {}
+        weka_format = self.attribute_data.get(name) or DEFAULT_DATE_FORMAT
+        codec = self._date_codecs.get(name)
+        if codec is None or codec.weka_format != weka_format:
+            codec = self._date_codecs[name] = DateCodec(weka_format)
+        return codec
+    
+    def get_vocabulary(self, name):
+        """
+        Returns the NominalValues of a nominal attribute, converting any
+        list or set assigned to attribute_data directly.
+        """
+        values = self.attribute_data.get(name)
+        if not isinstance(values, NominalValues):
+            values = self.attribute_data[name] = as_nominal_values(values)
+        return values
     
     def alphabetize_attributes(self):
         """
         Orders attributes names alphabetically, except for the class attribute, which is kept last.
         """
         self.attributes.sort(key=lambda name: (name == self.class_attr_name, name))
+        self._attribute_index = None
+        self._parse_plan = None
     
     def append(self, line, schema_only=False, update_schema=True):
+        if self.fout and isinstance(line, Mapping):
+            # The schema is fixed while streaming.
+            line_str = self._format_stream_row(line, update_schema)
+            if line_str and not schema_only:
+                self.fout.write(line_str + '\n')
+            return
         schema_change = False
-        if isinstance(line, dict):
+        if isinstance(line, Mapping):
             # Validate line types against schema.
             if update_schema:
+                attribute_types = self.attribute_types
                 for k, v in list(line.items()):
-                    prior_type = self.attribute_types.get(k, v.c_type if isinstance(v, Value) else None)
+                    prior_type = attribute_types.get(k, v.c_type if isinstance(v, Value) else None)
                     if not isinstance(v, Value):
                         if v == MISSING:
                             v = Str(v)
                         else:
-                            print('prior_type:', prior_type, k, v)
                             v = TYPE_TO_CLASS[prior_type](v)
                     if v.value != MISSING:
                         assert prior_type == v.c_type, \
                             ('Attempting to set attribute %s to type %s but it is already defined as type %s.') % (k, prior_type, v.c_type)
-                    if k not in self.attribute_types:
-                        if self.fout:
-                            # Remove feature that violates the schema
-                            # during streaming.
-                            if k in line:
-                                del line[k]
-                        else:
-                            self.attribute_types[k] = v.c_type
-                            self.attributes.append(k)
-                            schema_change = True
+                    if k not in attribute_types:
+                        attribute_types[k] = v.c_type
+                        self._add_attribute(k)
+                        schema_change = True
                     if isinstance(v, Nominal):
-                        if self.fout:
-                            # Remove feature that violates the schema
-                            # during streaming.
-                            if k not in self.attributes:
-                                if k in line:
-                                    del line[k]
-                            elif v.value not in self.attribute_data[k]:
-                                if k in line:
-                                    del line[k]
-                        else:
-                            self.attribute_data.setdefault(k, set())
-                            if v.value not in self.attribute_data[k]:
-                                self.attribute_data[k].add(v.value)
-                                schema_change = True
+                        values = self.get_vocabulary(k)
+                        if v.value not in values:
+                            values.add(v.value)
+                            schema_change = True
                     if v.cls:
                         if self.class_attr_name is None:
                             self.class_attr_name = k
                         else:
                             assert self.class_attr_name == k, \
                                 ('Attempting to set class to "%s" when it has already been set to "%s"') % (k, self.class_attr_name)
-                                    
-                    # Ensure the class attribute is the last one listed,
-                    # as that's assumed to be the class unless otherwise specified.
-                    if self.class_attr_name:
-                        try:
-                            self.attributes.remove(self.class_attr_name)
-                            self.attributes.append(self.class_attr_name)
-                        except ValueError:
-                            pass
-                    
-                if schema_change:
-                    assert not self.fout, 'Attempting to add data that doesn\'t match the schema while streaming.'
+                
+                # Reorder once per row, and only if new attributes were
+                # added after the class.
+                if self._move_class_last() or schema_change:
+                    self._parse_plan = None
                     
             if not schema_only:
                 # Append line to data set.
-                if self.fout:
-                    line_str = self.write_line(line)
-                    if line_str:
-                        print(line_str, file=self.fout)
-                else:
-                    self.data.append(line)
+                self.data.append(line)
         else:
             assert len(line) == len(self.attributes)
             self._parse_data(line)
+
+class ArffReader(object):
+    """
+    Reads an ARFF file lazily.
+
+    The header is parsed up front into the schema attribute, an ArffFile
+    without data, and iterating over the reader then parses and yields
+    one data row at a time, so memory use doesn't grow with the file size.
+
+        with ArffReader('big.arff') as reader:
+            for row in reader:
+                ...
+    """
+
+    def __init__(self, filename, arff_class=None, numeric_type=Decimal):
+        self.filename = filename
+        self.schema = (arff_class or ArffFile)(numeric_type=numeric_type)
+        self.schema.state = 'comment'
+        self.schema.lineno = 1
+        self._fin = open_file(filename)
+        for l in self._fin:
+            self.schema.parseline(l.rstrip('\r\n'))
+            self.schema.lineno += 1
+            if self.schema.state == 'data':
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        schema = self.schema
+        # The schema is fixed once the header is read, so its plan is
+        # looked up once instead of being checked for every row.
+        parse_line = schema._get_parse_plan().parse_line
+        for l in self._fin:
+            if l[0] != '%' and l.strip():
+                row = parse_line(l, schema.lineno)
+                if row is not None:
+                    yield row
+            schema.lineno += 1
+
+    def close(self):
+        self._fin.close()
+
+# By default, the offset of every this many rows is indexed.
+DEFAULT_INDEX_INTERVAL = 1000
+
+# Python 2's array.array has no 'q' typecode, but its 'l' is 64 bits on
+# most platforms.
+INT64_TYPECODE = 'q' if PY3 else 'l'
+
+INDEX_MAGIC = b'ARFFIDX1'
+
+# The interval, number of rows, offset of the data section and size of the
+# ARFF file an index was built for, followed by the offsets themselves.
+INDEX_HEADER = struct.Struct('<4q')
+
+class IndexedArffFile(object):
+    """
+    Random access to the data rows of an ARFF file.
+
+    The file is memory mapped and scanned once to record the byte offset
+    of every Kth data row, after which indexing or slicing only parses the
+    rows requested, plus at most K-1 skipped lines.
+
+        with ArffFile.open_indexed('big.arff') as data:
+            shard = data[1000:2000] # an ArffFile holding those rows
+
+    If index_filename is given, the offsets are saved there and reused as
+    long as the file is newer than the ARFF file and was built with the
+    same interval for an ARFF file of the same size and header.
+    """
+
+    def __init__(self, filename, arff_class=None, numeric_type=Decimal,
+        interval=DEFAULT_INDEX_INTERVAL, index_filename=None):
+        self.filename = filename
+        self.schema = (arff_class or ArffFile)(numeric_type=numeric_type)
+        self.schema.state = 'comment'
+        self.schema.lineno = 1
+        assert get_compression(filename) is None, 'Compressed files cannot be indexed.'
+        self._fin = open(filename, 'rb')
+        # Empty files can't be mapped.
+        self._mmap = None
+        if os.path.getsize(filename):
+            self._mmap = mmap.mmap(self._fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data_offset = 0
+        for l in self._iter_lines(0):
+            self.data_offset += len(l)
+            self.schema.parseline(l.decode('utf-8').rstrip('\r\n'))
+            self.schema.lineno += 1
+            if self.schema.state == 'data':
+                break
+        if not (index_filename and os.path.isfile(index_filename)
+        and os.path.getmtime(index_filename) >= os.path.getmtime(filename)
+        and self._load_index(index_filename, interval)):
+            self._build_index(interval)
+            if index_filename:
+                self._save_index(index_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.rows
+
+    def _iter_lines(self, offset):
+        """
+        Iterates over the lines of the file starting at the given offset.
+        
+        Each iterator keeps its own position instead of moving the map's,
+        so several may be read from at once.
+        """
+        mm = self._mmap
+        if mm is None:
+            return
+        find = mm.find
+        size = len(mm)
+        while offset < size:
+            end = find(b'\n', offset) + 1 or size
+            yield mm[offset:end]
+            offset = end
+
+    @staticmethod
+    def _is_data(l):
+        return l[:1] != b'%' and l.strip()
+
+    def _build_index(self, interval):
+        self.interval = interval
+        self.offsets = array(INT64_TYPECODE)
+        self.rows = 0
+        if self._mmap is None:
+            return
+        offset = self.data_offset
+        is_data = self._is_data
+        for l in self._iter_lines(offset):
+            if is_data(l):
+                if not self.rows % interval:
+                    self.offsets.append(offset)
+                self.rows += 1
+            offset += len(l)
+
+    def _get_size(self):
+        return len(self._mmap) if self._mmap is not None else 0
+
+    def _save_index(self, index_filename):
+        with open(index_filename, 'wb') as fout:
+            fout.write(INDEX_MAGIC)
+            fout.write(INDEX_HEADER.pack(self.interval, self.rows, self.data_offset, self._get_size()))
+            fout.write(struct.pack('<%iq' % len(self.offsets), *self.offsets))
+
+    def _load_index(self, index_filename, interval):
+        """
+        Reads the offsets saved by _save_index(), returning False without
+        reading them if they weren't built for this file and interval.
+        """
+        with open(index_filename, 'rb') as fin:
+            if fin.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return False
+            header = fin.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size:
+                return False
+            saved_interval, rows, data_offset, size = INDEX_HEADER.unpack(header)
+            if (saved_interval, data_offset, size) != (interval, self.data_offset, self._get_size()):
+                return False
+            data = fin.read()
+        count = -(-rows//interval)
+        if len(data) != count*8:
+            return False
+        self.interval = interval
+        self.rows = rows
+        self.offsets = array(INT64_TYPECODE, struct.unpack('<%iq' % count, data))
+        return True
+
+    def iter_rows(self, start=0, stop=None):
+        """
+        Iterates over the rows numbered from start up to stop.
+        """
+        stop = self.rows if stop is None else min(stop, self.rows)
+        if start >= stop:
+            return
+        i = start - start % self.interval
+        # The schema is fixed once indexed, so its plan is looked up once.
+        parse_line = self.schema._get_parse_plan().parse_line
+        is_data = self._is_data
+        for l in self._iter_lines(self.offsets[start//self.interval]):
+            if not is_data(l):
+                continue
+            if i >= start:
+                row = parse_line(l.decode('utf-8'))
+                if row is not None:
+                    yield row
+            i += 1
+            if i >= stop:
+                return
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.rows)
+            a = self.schema.copy(schema_only=True)
+            a.comment = copy.copy(self.schema.comment)
+            if step > 0:
+                a.data = list(self.iter_rows(start, stop))[::step]
+            elif start > stop:
+                a.data = list(self.iter_rows(stop + 1, start + 1))[::step]
+            return a
+        if index < 0:
+            index += self.rows
+        if not 0 <= index < self.rows:
+            raise IndexError('Row index out of range.')
+        for row in self.iter_rows(index, index + 1):
+            return row
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._fin.close()
+
+def get_nominal_values(values):
+    """
+    Returns nominal values in the order used by Weka to index them.
+    """
+    if isinstance(values, (list, tuple, NominalValues)):
+        return list(values)
+    return sorted(_ for _ in values if _ != MISSING)
+
+class ArffColumns(object):
+    """
+    Columnar, NumPy-backed storage of an ARFF data set.
+
+    Each attribute is held in a single array:
+
+    - integer attributes as int64,
+    - numeric and real attributes as float64,
+    - nominal attributes as int32 codes indexing nominal_values[name],
+    - string and date attributes as object arrays of strings.
+
+    Missing values are flagged in a parallel boolean array per attribute,
+    in the missing attribute.
+
+    As in Weka, values omitted from sparse rows are read as zero, or as the
+    first value of nominal attributes.
+
+    Indexing with a slice, boolean mask or array of row indexes returns a new
+    instance sharing the schema, and, for slices, the underlying memory.
+
+    Instances read by load_binary() may memory map their file, which is
+    released by close(), or on leaving a with block.
+    """
+
+    DTYPES = {
+        TYPE_INTEGER: 'int64',
+        TYPE_NUMERIC: 'float64',
+        TYPE_REAL: 'float64',
+        TYPE_NOMINAL: 'int32',
+        TYPE_STRING: 'object',
+        TYPE_DATE: 'object',
+    }
+
+    # Typecodes of the array.array buffers filled while parsing.
+    TYPECODES = {
+        TYPE_INTEGER: INT64_TYPECODE,
+        TYPE_NUMERIC: 'd',
+        TYPE_REAL: 'd',
+        TYPE_NOMINAL: 'i',
+    }
+
+    # The memory mapped file the columns were read from, if any.
+    _memmap = None
+
+    def __init__(self, schema, columns, missing=None):
+        assert np is not None, 'NumPy is required for columnar storage.'
+        self.schema = schema
+        self.columns = columns # {attr_name: array}
+        if missing is None:
+            missing = dict(
+                (name, np.zeros(len(column), dtype=bool))
+                for name, column in columns.items())
+        self.missing = missing # {attr_name: boolean array}
+        self.nominal_values = dict(
+            (name, get_nominal_values(schema.attribute_data[name]))
+            for name in schema.attributes
+            if schema.attribute_types[name] == TYPE_NOMINAL)
+
+    @property
+    def attributes(self):
+        return self.schema.attributes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Releases the file mapped by load_binary(). The columns can't be used
+        afterwards.
+
+        Arrays taken from the columns before closing keep the file mapped
+        until they're garbage collected.
+        """
+        if self._memmap is None:
+            return
+        mm = self._memmap._mmap
+        self._memmap = None
+        self.columns = {}
+        self.missing = {}
+        try:
+            mm.close()
+        except BufferError:
+            pass
+
+    def __len__(self):
+        if not self.attributes:
+            return 0
+        return len(self.columns[self.attributes[0]])
+
+    def __getitem__(self, index):
+        if isinstance(index, basestring):
+            return self.columns[index]
+        return type(self)(
+            self.schema,
+            dict((name, column[index]) for name, column in self.columns.items()),
+            dict((name, mask[index]) for name, mask in self.missing.items()))
+
+    def decode(self, name):
+        """
+        Returns the values of a nominal attribute as an object array of
+        strings, with missing values set to None.
+        """
+        labels = np.array(self.nominal_values[name] + [None], dtype=object)
+        codes = np.where(self.missing[name], -1, self.columns[name])
+        return labels[codes]
+
+    def iter_rows(self):
+        """
+        Iterates over the rows in the same dense format used by ArffFile.data.
+        """
+        converters = []
+        for name in self.attributes:
+            at = self.schema.attribute_types[name]
+            if at == TYPE_INTEGER:
+                converters.append(int)
+            elif at in (TYPE_NUMERIC, TYPE_REAL):
+                if self.schema.numeric_type is float:
+                    converters.append(float)
+                else:
+                    converters.append(lambda v: Decimal(repr(float(v))))
+            elif at == TYPE_NOMINAL:
+                converters.append(self.nominal_values[name].__getitem__)
+            else:
+                converters.append(str)
+        columns = [self.columns[name] for name in self.attributes]
+        missing = [self.missing[name] for name in self.attributes]
+        for i in range(len(self)):
+            yield [
+                MISSING if m[i] else f(c[i])
+                for f, c, m in zip(converters, columns, missing)]
+
+    def _format_column(self, i, name, fmt):
+        """
+        Formats every value of the column of the ith attribute at once,
+        returning a list of strings.
+        """
+        at = self.schema.attribute_types[name]
+        column = self.columns[name]
+        if at == TYPE_NOMINAL:
+            values = np.array(self.nominal_values[name] + [MISSING], dtype=object)
+            if fmt == SPARSE:
+                values = np.array([smart_quote(_) for _ in values], dtype=object)
+            strings = values[np.where(self.missing[name], -1, column)]
+        elif at == TYPE_INTEGER:
+            strings = column.astype(str).astype(object)
+        elif at in (TYPE_NUMERIC, TYPE_REAL):
+            strings = np.array(list(map(repr, column.tolist())), dtype=object)
+        elif at == TYPE_STRING:
+            if fmt == DENSE:
+                strings = np.array([self.schema.esc(_) for _ in column], dtype=object)
+            else:
+                strings = np.array(['"%s"' % _ for _ in column], dtype=object)
+        elif at == TYPE_DATE and fmt == SPARSE:
+            format_date = self.schema.get_date_codec(name).format
+            strings = np.array([smart_quote(format_date(_)) for _ in column], dtype=object)
+        else:
+            raise Exception("Type " + at + " not supported for writing!")
+        if at != TYPE_NOMINAL:
+            strings[self.missing[name]] = MISSING
+        if fmt == SPARSE:
+            strings = ('%i ' % i) + strings
+        return strings.tolist()
+
+    def write(self,
+        fout=None,
+        fmt=SPARSE,
+        schema_only=False,
+        data_only=False,
+        chunk_size=WRITE_CHUNK_SIZE):
+        """
+        Write the data set to a string, formatting a whole chunk of each
+        column at a time.
+        The output is the same as ArffFile.from_numpy(self).write().
+        """
+        assert not (schema_only and data_only), 'Make up your mind.'
+        assert fmt in FORMATS, 'Invalid format "%s". Should be one of: %s' % (fmt, ', '.join(FORMATS))
+        close = False
+        if fout is None:
+            close = True
+            fout = StringIO()
+        if not data_only:
+            self.schema.write(fout=fout, schema_only=True)
+        if not schema_only:
+            print("@data", file=fout)
+            for start in range(0, len(self), chunk_size):
+                chunk = self[start:start + chunk_size]
+                columns = [chunk._format_column(i, name, fmt) for i, name in enumerate(self.attributes)]
+                if fmt == DENSE:
+                    lines = map(','.join, zip(*columns))
+                elif len(columns) == 1:
+                    # Skip lines with nothing other than a missing class.
+                    lines = ('{' + _ + '}' for _ in columns[0] if MISSING not in _)
+                else:
+                    lines = ('{' + ', '.join(_) + '}' for _ in zip(*columns))
+                write_lines(fout, lines, chunk_size=chunk_size)
+        if isinstance(fout, StringIO) and close:
+            return fout.getvalue()
+
+    @classmethod
+    def from_rows(cls, schema, rows):
+        """
+        Fills the columns from ArffFile.data style rows.
+        """
+        builder = _ColumnBuilder(schema)
+        for row in rows:
+            builder.append(row)
+        return builder.build(cls)
+
+    @classmethod
+    def load(cls, filename, numeric_type=Decimal):
+        """
+        Reads an ARFF file straight into columns, without creating
+        per-value objects for its rows.
+        """
+        with ArffReader(filename, numeric_type=numeric_type) as reader:
+            builder = _ColumnBuilder(reader.schema)
+            lineno = reader.schema.lineno
+            for l in reader._fin:
+                l = l.strip()
+                if l and l[0] != '%':
+                    builder.append_line(l, lineno)
+                lineno += 1
+        return builder.build(cls)
+
+    def save_binary(self, filename, fmt=None):
+        """
+        Saves the columns in a compact binary file, read back with
+        load_binary().
+
+        The schema is stored in a JSON header, followed by a fixed-width
+        block per column, aligned so it can be memory mapped. String and
+        date columns are stored as UTF-8 text with a block of offsets.
+
+        In the sparse layout, each column only stores the rows holding a
+        non-zero or missing value, along with their row numbers. By default
+        it's used when most values are zero.
+        """
+        n = len(self)
+        if fmt is None:
+            nonzero = sum(
+                int(np.count_nonzero(self._get_stored_rows(name)))
+                for name in self.attributes)
+            fmt = SPARSE if nonzero*2 < n*len(self.attributes) else DENSE
+        assert fmt in FORMATS, 'Invalid format "%s". Should be one of: %s' % (fmt, ', '.join(FORMATS))
+        schema = self.schema
+        header = dict(
+            relation=schema.relation,
+            comment=schema.comment,
+            attributes=schema.attributes,
+            attribute_types=schema.attribute_types,
+            attribute_data=dict(
+                (name, self.nominal_values[name] if name in self.nominal_values else schema.attribute_data.get(name))
+                for name in schema.attributes),
+            class_attr_name=schema.class_attr_name,
+            numeric_type='float' if schema.numeric_type is float else 'decimal',
+            fmt=fmt,
+            rows=n,
+            columns=[],
+        )
+        blocks = []
+        offset = 0
+        for name in self.attributes:
+            column = self.columns[name]
+            missing = self.missing[name]
+            arrays = {}
+            if fmt == SPARSE:
+                rows = np.flatnonzero(self._get_stored_rows(name))
+                arrays['rows'] = rows.astype('<i8')
+                column = column[rows]
+                missing = missing[rows]
+            at = schema.attribute_types[name]
+            if at in self.TYPECODES:
+                arrays['values'] = column.astype(np.dtype(self.DTYPES[at]).newbyteorder('<'))
+            else:
+                text = [_ or '' for _ in column.tolist()]
+                arrays['offsets'] = np.cumsum([0] + [len(_) for _ in text]).astype('<i8')
+                arrays['text'] = np.frombuffer(''.join(text).encode('utf-8'), dtype='u1')
+            if missing.any():
+                arrays['missing'] = missing.astype('u1')
+            specs = {}
+            for key in sorted(arrays):
+                a = arrays[key]
+                specs[key] = [offset, a.dtype.str, len(a)]
+                blocks.append((offset, a))
+                offset = _align(offset + a.nbytes)
+            header['columns'].append(specs)
+        header = json.dumps(header).encode('utf-8')
+        data_start = _align(len(BINARY_MAGIC) + 8 + len(header))
+        with open(filename, 'wb') as fout:
+            fout.write(BINARY_MAGIC)
+            fout.write(struct.pack('<Q', len(header)))
+            fout.write(header)
+            for block_offset, a in blocks:
+                fout.write(b'\0'*(data_start + block_offset - fout.tell()))
+                fout.write(a.tobytes())
+
+    def _get_stored_rows(self, name):
+        """
+        Returns a boolean array flagging the values stored in the sparse
+        layout, those that aren't zero or the first nominal value.
+        """
+        column = self.columns[name]
+        if self.schema.attribute_types[name] in self.TYPECODES:
+            stored = column != 0
+        else:
+            stored = column != ''
+        return stored | self.missing[name]
+
+    @classmethod
+    def load_binary(cls, filename, memory_map=True):
+        """
+        Reads columns from a file written by save_binary().
+
+        Numeric and nominal columns in the dense layout are memory mapped,
+        so they're read from disk only as they're used, until close() is
+        called. Pass memory_map=False to read the whole file instead.
+        """
+        with open(filename, 'rb') as fin:
+            magic = fin.read(len(BINARY_MAGIC))
+            assert magic == BINARY_MAGIC, '%s is not a binary ARFF file.' % filename
+            header_size = struct.unpack('<Q', fin.read(8))[0]
+            header = json.loads(fin.read(header_size).decode('utf-8'))
+        data_start = _align(len(BINARY_MAGIC) + 8 + header_size)
+        if memory_map:
+            buf = np.memmap(filename, dtype='u1', mode='r')
+        else:
+            buf = np.fromfile(filename, dtype='u1')
+
+        def get_block(spec):
+            offset, dtype, length = spec
+            dtype = np.dtype(str(dtype))
+            start = data_start + offset
+            return buf[start:start + length*dtype.itemsize].view(dtype)
+
+        schema = ArffFile(
+            relation=header['relation'],
+            numeric_type=float if header['numeric_type'] == 'float' else Decimal)
+        schema.comment = header['comment']
+        schema.attributes = header['attributes']
+        schema.attribute_types = header['attribute_types']
+        schema.attribute_data = header['attribute_data']
+        schema.class_attr_name = header['class_attr_name']
+        n = header['rows']
+        columns = {}
+        missing = {}
+        for name, specs in zip(schema.attributes, header['columns']):
+            if 'values' in specs:
+                column = get_block(specs['values'])
+            else:
+                text = get_block(specs['text']).tobytes().decode('utf-8')
+                offsets = get_block(specs['offsets']).tolist()
+                column = np.array([text[a:b] for a, b in zip(offsets, offsets[1:])], dtype=object)
+            if 'missing' in specs:
+                mask = get_block(specs['missing']).view(bool)
+            else:
+                mask = np.zeros(len(column), dtype=bool)
+            if 'rows' in specs:
+                rows = get_block(specs['rows'])
+                if column.dtype == object:
+                    dense = np.array(['']*n, dtype=object)
+                else:
+                    dense = np.zeros(n, dtype=column.dtype)
+                dense[rows] = column
+                column = dense
+                dense = np.zeros(n, dtype=bool)
+                dense[rows] = mask
+                mask = dense
+            columns[name] = column
+            missing[name] = mask
+        columns = cls(schema, columns, missing)
+        if memory_map:
+            columns._memmap = buf
+        return columns
+
+BINARY_MAGIC = b'ARFFBIN1'
+
+# Blocks in binary files start at multiples of this many bytes.
+BINARY_ALIGNMENT = 8
+
+def _align(offset):
+    return -(-offset//BINARY_ALIGNMENT)*BINARY_ALIGNMENT
+
+def convert_binary_to_arff(filename, arff_filename, fmt=SPARSE):
+    """
+    Writes a file saved with save_binary() out as a text ARFF file,
+    such as for passing to Weka.
+    """
+    with ArffColumns.load_binary(filename) as columns:
+        with open_file(arff_filename, 'w') as fout:
+            columns.write(fout=fout, fmt=fmt)
+
+# Placeholder for values omitted from sparse rows.
+_OMITTED = object()
+
+class _ColumnBuilder(object):
+    """
+    Accumulates rows into compact array.array buffers, converted into
+    NumPy arrays once all rows have been added.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema.copy(schema_only=True)
+        self.schema.comment = copy.copy(schema.comment)
+        self.schema.class_attr_name = schema.class_attr_name
+        self.attributes = self.schema.attributes
+        self.types = [self.schema.attribute_types[name] for name in self.attributes]
+        self.buffers = [
+            array(ArffColumns.TYPECODES[at]) if at in ArffColumns.TYPECODES else []
+            for at in self.types]
+        self.masks = [array('b') for _ in self.attributes]
+        self.codes = [
+            NominalValues(get_nominal_values(self.schema.attribute_data[name]))
+            if at == TYPE_NOMINAL else None
+            for name, at in zip(self.attributes, self.types)]
+        self.index = dict((name, i) for i, name in enumerate(self.attributes))
+
+    def _add(self, i, v):
+        at = self.types[i]
+        if isinstance(v, Value):
+            v = v.value
+        if v is _OMITTED or v is None or v == MISSING:
+            self.buffers[i].append(0 if at in ArffColumns.TYPECODES else '')
+            self.masks[i].append(v is not _OMITTED)
+            return
+        if at == TYPE_NOMINAL:
+            try:
+                v = self.codes[i].code(str(v))
+            except KeyError:
+                raise Exception('Incorrect value %s for nominal attribute %s' % (v, self.attributes[i]))
+        elif at == TYPE_INTEGER:
+            v = int(v)
+        elif at in (TYPE_NUMERIC, TYPE_REAL):
+            v = float(v)
+        else:
+            v = str(v)
+        self.buffers[i].append(v)
+        self.masks[i].append(0)
+
+    def append(self, row):
+        if isinstance(row, Mapping):
+            # Sparse row, with omitted values defaulting to zero.
+            row = [row.get(name, _OMITTED) for name in self.attributes]
+        assert len(row) == len(self.attributes)
+        for i, v in enumerate(row):
+            self._add(i, v)
+
+    def append_line(self, l, lineno=0):
+        """
+        Adds a data line string, split the same way ArffFile parses it.
+        """
+        sparse, values = self.schema._get_parse_plan().split_line(l, lineno)
+        if values is None:
+            return
+        if sparse:
+            row = [_OMITTED]*len(self.attributes)
+            for index, value in values:
+                row[index] = value
+        else:
+            row = values
+        for i, v in enumerate(row):
+            self._add(i, v)
+
+    def build(self, cls):
+        columns = {}
+        missing = {}
+        for name, at, buf, mask in zip(self.attributes, self.types, self.buffers, self.masks):
+            if at in ArffColumns.TYPECODES:
+                columns[name] = np.frombuffer(buf, dtype=ArffColumns.TYPECODES[at]).astype(
+                    ArffColumns.DTYPES[at], copy=False)
+            else:
+                columns[name] = np.array(buf, dtype=object)
+            missing[name] = np.frombuffer(mask, dtype='int8').astype(bool)
+        return cls(self.schema, columns, missing)
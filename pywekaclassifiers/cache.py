@@ -0,0 +1,340 @@
+"""
+Content-addressed caches shared by classifiers.
+
+ModelCache keeps serialized Weka models on disk, named by the hash of their
+contents, so repeated calls with the same model reuse a single file instead
+of writing it out again each time.
+
+    from pywekaclassifiers.cache import ModelCache
+    Classifier.model_cache = ModelCache('/var/cache/weka-models')
+
+PredictionCache and DiskPredictionCache remember the prediction made for
+each query row, so repeated rows aren't sent to Weka again.
+
+    from pywekaclassifiers.cache import PredictionCache
+    Classifier.prediction_cache = PredictionCache(max_entries=100000, ttl=3600)
+"""
+from __future__ import print_function, absolute_import
+
+import errno
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from six.moves import cPickle as pickle
+
+# Default upper bound on the total size of cached model files.
+DEFAULT_MAX_BYTES = 1024*1024*1024
+
+# Default upper bound on the number of predictions kept in memory.
+DEFAULT_MAX_PREDICTIONS = 100000
+
+MODEL_SUFFIX = '.model'
+
+PREDICTION_SUFFIX = '.prediction'
+
+def get_private_directory(name):
+    """
+    Returns a directory in the system's temporary directory that only the
+    current user can access, creating it if it doesn't exist.
+    
+    Since the path is predictable, an existing directory is only used if
+    it's owned by the current user and closed to everyone else.
+    """
+    getuid = getattr(os, 'getuid', None)
+    if getuid is not None:
+        name = '%s-%i' % (name, getuid())
+    path = os.path.join(tempfile.gettempdir(), name)
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise Exception('%s is not a directory.' % path)
+    if getuid is not None and (info.st_uid != getuid() or info.st_mode & 0o077):
+        raise Exception('%s must be owned by the current user and not accessible to others.' % path)
+    return path
+
+def get_model_key(model_data):
+    """
+    Returns the content hash identifying a serialized model.
+    """
+    return hashlib.sha1(model_data).hexdigest()
+
+def get_prediction_hasher(model_key, schema_str, distribution=False):
+    """
+    Returns a hash of everything but the query row that a prediction
+    depends on, to be copied and updated with each row by get_prediction_key().
+    """
+    hasher = hashlib.sha1()
+    hasher.update(('%s\n%i\n' % (model_key, bool(distribution))).encode('utf-8'))
+    hasher.update(schema_str.encode('utf-8'))
+    return hasher
+
+def get_prediction_key(hasher, line):
+    """
+    Returns the key identifying the prediction of a query row, given as
+    the line written for it in the ARFF file sent to Weka.
+    """
+    hasher = hasher.copy()
+    hasher.update(line.encode('utf-8'))
+    return hasher.hexdigest()
+
+class _CacheStats(object):
+
+    hits = 0
+
+    misses = 0
+
+    @property
+    def hit_rate(self):
+        """
+        The fraction of lookups that were found in the cache.
+        """
+        total = self.hits + self.misses
+        if total:
+            return self.hits/float(total)
+        return 0.
+
+class _FileCache(_CacheStats):
+    """
+    Stores files in a directory, evicting the least recently used ones
+    once the total size or number of files exceeds the given limits.
+
+    Files are written atomically, so the same directory may be shared
+    between processes. Since cached files are trusted, a directory given
+    explicitly must only be writable by trusted users. By default, a
+    directory private to the current user is used.
+    """
+
+    suffix = None
+
+    default_directory = None
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, max_files=None):
+        if directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            self.directory = directory
+        else:
+            # Cached files are trusted when read back, so the default
+            # directory must not be writable by other users.
+            self.directory = get_private_directory(self.default_directory)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _add(self, key, tmp_fn):
+        fn = self.get_path(key)
+        os.rename(tmp_fn, fn)
+        self.evict(keep=fn)
+        return fn
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used files until the cache is within its
+        limits, never removing the file named by keep.
+        """
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(self.suffix):
+                    continue
+                fn = os.path.join(self.directory, name)
+                try:
+                    info = os.stat(fn)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, fn, info.st_size))
+            entries.sort()
+            total = sum(size for _, _, size in entries)
+            count = len(entries)
+            for _, fn, size in entries:
+                if (self.max_bytes is None or total <= self.max_bytes) \
+                and (self.max_files is None or count <= self.max_files):
+                    break
+                if fn == keep:
+                    continue
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
+                total -= size
+                count -= 1
+
+    def clear(self):
+        """
+        Removes all cached files.
+        """
+        with self._lock:
+            for name in os.listdir(self.directory):
+                if name.endswith(self.suffix):
+                    os.remove(os.path.join(self.directory, name))
+
+class ModelCache(_FileCache):
+    """
+    Names each model file by the hash of its contents, so get() returns the
+    same file for the same model data, writing it only the first time, and
+    add_file() adopts the file Weka just saved a model to instead of copying it.
+    """
+
+    suffix = MODEL_SUFFIX
+
+    default_directory = 'pywekaclassifiers-models'
+
+    def __contains__(self, model_data):
+        return os.path.isfile(self.get_path(get_model_key(model_data)))
+
+    def get(self, model_data):
+        """
+        Returns the filename of a file containing the given model,
+        writing it only if it isn't already cached.
+        """
+        key = get_model_key(model_data)
+        fn = self.get_path(key)
+        try:
+            # Mark the file as recently used.
+            os.utime(fn, None)
+            self.hits += 1
+            return fn
+        except OSError:
+            pass
+        self.misses += 1
+        fd, tmp_fn = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as fout:
+            fout.write(model_data)
+        return self._add(key, tmp_fn)
+
+    def add_file(self, fn, model_data=None):
+        """
+        Moves an existing model file into the cache and returns its new
+        filename.
+        """
+        if model_data is None:
+            with open(fn, 'rb') as fin:
+                model_data = fin.read()
+        fd, tmp_fn = tempfile.mkstemp(dir=self.directory)
+        os.close(fd)
+        shutil.move(fn, tmp_fn)
+        return self._add(get_model_key(model_data), tmp_fn)
+
+class PredictionCache(_CacheStats):
+    """
+    Keeps predictions in memory, evicting the least recently used ones once
+    there are more than max_entries of them or their pickled size exceeds
+    max_bytes, and dropping any cached more than ttl seconds ago.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_PREDICTIONS, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # {key: (time cached, size, value)}, least recently used first.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the cached value, or None if there isn't one.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                self.bytes -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value):
+        size = 0
+        if self.max_bytes is not None:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (time.time(), size, value)
+            self.bytes += size
+            while self._entries and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries)
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                _, (_, size, _) = self._entries.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+class DiskPredictionCache(_FileCache):
+    """
+    Keeps predictions in files, one per query row, which may be shared
+    between processes, evicting the least recently used files once their
+    total size or number exceeds the given limits, and ignoring any
+    cached more than ttl seconds ago.
+
+    The directory is only checked against the limits every evict_interval
+    additions, so it may briefly exceed them. Predictions are unpickled
+    when read, so the directory must only be writable by trusted users.
+    """
+
+    suffix = PREDICTION_SUFFIX
+
+    default_directory = 'pywekaclassifiers-predictions'
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, max_files=None, ttl=None, evict_interval=100):
+        super(DiskPredictionCache, self).__init__(directory, max_bytes=max_bytes, max_files=max_files)
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self._additions = 0
+
+    def get(self, key):
+        """
+        Returns the cached value, or None if there isn't one.
+        """
+        fn = self.get_path(key)
+        try:
+            with open(fn, 'rb') as fin:
+                created, value = pickle.load(fin)
+            if self.ttl is None or time.time() - created <= self.ttl:
+                # Mark the file as recently used.
+                os.utime(fn, None)
+                self.hits += 1
+                return value
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            pass
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        fd, tmp_fn = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as fout:
+            pickle.dump((time.time(), value), fout, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fn, self.get_path(key))
+        self._additions += 1
+        if self._additions % self.evict_interval == 0:
+            self.evict()
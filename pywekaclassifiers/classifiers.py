@@ -1,31 +1,51 @@
 #!/usr/bin/python
 from __future__ import print_function, absolute_import
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import errno
 import gzip
+from itertools import chain, islice, product
 import math
+import multiprocessing
 import os
+import random
 import re
 import shutil
+import signal
+import stat
 import subprocess
 from subprocess import Popen, PIPE
 import sys
 import tempfile
+import threading
 import time
 import traceback
 from decimal import Decimal
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, which has no named pipes either.
+    fcntl = None
 
 from six.moves import cPickle as pickle
 from six import string_types as basestring # pylint: disable=redefined-builtin
 from six import iteritems
 from six import u as unicode # pylint: disable=redefined-builtin
 from six import PY3
+from six import reraise
 
 from pywekaclassifiers import arff
 from pywekaclassifiers.arff import SPARSE, DENSE, Num, Nom, Int, Str, Date
+from pywekaclassifiers.cache import get_model_key, get_prediction_hasher, get_prediction_key
 
 DEFAULT_WEKA_JAR_PATH = '/usr/share/java/weka.jar:/usr/share/java/libsvm.jar'
 
+# The command used to launch the JVM.
+JAVA = os.environ.get('WEKA_JAVA', 'java')
+
 BP = os.path.dirname(os.path.abspath(__file__))
 CP = os.environ.get('WEKA_JAR_PATH', DEFAULT_WEKA_JAR_PATH)
 for _cp in CP.split(os.pathsep):
@@ -95,7 +115,7 @@ class _Helper(object):
         
     def __call__(self, *args, **kwargs):
         args = list(self.args) + list(args)
-        ckargs = self.ckargs
+        ckargs = dict(self.ckargs)
         ckargs.update(kwargs)
         return Classifier(ckargs=ckargs, *args)
     
@@ -144,6 +164,14 @@ WEKA_ACCURACY_REGEX = re.compile(r'===\s+Stratified cross-validation\s+===' + \
 WEKA_TEST_ACCURACY_REGEX = re.compile(r'===\s+Error on test data\s+===\n+\s' + \
     r'*\n+\s*Correctly Classified Instances\s+[0-9]+\s+([0-9\.]+)\s+%',
     re.DOTALL)
+# Statistics of the test data, as opposed to the training data Weka also
+# evaluates when given both, read without crossing into another section.
+WEKA_TEST_CORRELATION_REGEX = re.compile(r'===\s+Error on test data\s+===' + \
+    r'(?:(?!===).)*?Correlation coefficient\s+(-?[0-9\.]+)',
+    re.DOTALL)
+WEKA_TEST_MAE_REGEX = re.compile(r'===\s+Error on test data\s+===' + \
+    r'(?:(?!===).)*?Mean absolute error\s+([0-9\.]+)',
+    re.DOTALL)
 
 class PredictionResult(object):
     
@@ -164,8 +192,11 @@ class PredictionResult(object):
     
     @classmethod
     def avg(cls, *instances):
-        total = Decimal(len(instances))
-        predicted = sum([instance.predicted for instance in instances if instance.predicted is not None])/total
+        predicted = [instance.predicted for instance in instances if instance.predicted is not None]
+        total = len(instances)
+        if not any(isinstance(_, float) for _ in predicted):
+            total = Decimal(total)
+        predicted = sum(predicted)/total
         probs = [instance.probability for instance in instances if instance.probability is not None]
         if probs:
             probability = sum(probs)
@@ -208,23 +239,417 @@ def get_weka_accuracy(arff_fn, arff_test_fn, cls):
         print("Unexpected Error: %s" % e)
         return 0
 
+J48_TREE_REGEX = re.compile(r'J48 pruned tree\s+\-+:\s+([0-9]+)\s+', re.MULTILINE|re.DOTALL)
+
+NOMINAL_HEADER_REGEX = re.compile(r'error\s+(?:distribution|prediction)')
+
+NOMINAL_PREDICTION_REGEX = re.compile(
+    r"^\s*[0-9\.]+\s+[a-zA-Z0-9\.\?\:]+\s+(?P<cls_value>[a-zA-Z0-9_\.\?\:]+)\s+\+?\s+(?P<prob>[a-zA-Z0-9\.\?\,\*]+)")
+
+SIMPLE_PREDICTION_REGEX = re.compile(
+    # inst#     actual  predicted 
+    r"^\s*([0-9\.]+)\s+([a-zA-Z0-9\-\.\?\:]+)\s+([a-zA-Z0-9\-_\.\?\:]+)\s+")
+
+def parse_predictions(stdout_str, query, distribution=False):
+    """
+    Iterates over the PredictionResult instances found in the output
+    Weka prints when called with "-p 0" against the given query ArffFile.
+    """
+    return iter_predictions(stdout_str.splitlines(), query, distribution=distribution)
+
+def iter_predictions(lines, query, distribution=False):
+    """
+    Iterates over the PredictionResult instances found in lines of the
+    output Weka prints when called with "-p 0" against the given query
+    ArffFile.
+    
+    The format is detected from the table header, after which each result
+    is yielded as soon as its line is read, so lines may be read lazily
+    from a running process.
+    """
+    # sample line:     1        1:?       4:36   +   1
+
+    # Expected output without distribution:
+    #=== Predictions on test data ===
+    #
+    # inst#     actual  predicted error prediction
+    #     1        1:? 11:Acer_tr   +   1
+
+    #=== Predictions on test data ===
+    #
+    # inst#     actual  predicted      error
+    #     1          ?      7              ? 
+
+    #=== Predictions on test data ===
+    #
+    # inst#     actual  predicted error prediction
+    #     1        1:?        1:0       0.99 
+    #     2        1:?        1:0       0.99 
+    #     3        1:?        1:0       0.99 
+    #     4        1:?        1:0       0.99 
+    #     5        1:?        1:0       0.99 
+
+    # Expected output with distribution:
+    #=== Predictions on test data ===
+    #
+    # inst#     actual  predicted error distribution
+    #     1        1:? 11:Acer_tr   +   0,0,0,0,0,0,0,0,0,0,*1,0,0,0,0,0...
+
+    # Expected output with simple format:
+    # inst#     actual  predicted      error
+    #     1          ?     -3.417          ?
+
+    class_name = query.attributes[-1]
+    class_values = None
+    if query.attribute_types[class_name] == arff.TYPE_NOMINAL:
+        class_values = query.get_vocabulary(class_name)
+    
+    def nominal_result(match):
+        prediction, prob = match.groups()
+        class_index, class_label = prediction.split(':')
+        class_index = int(class_index)
+        if distribution:
+            # Convert list of probabilities into a hash linking the prob
+            # to the associated class value.
+            prob = dict(zip(
+                class_values,
+                map(float, prob.replace('*', '').split(','))))
+        else:
+            prob = float(prob)
+        class_label = class_values.value(class_index-1)
+        return PredictionResult(
+            actual=None,
+            predicted=class_label,
+            probability=prob,)
+    
+    def simple_result(match):
+        inst, actual, predicted = match.groups()
+        actual_value = query.get_attribute_value(class_name, actual)
+        predicted_value = query.get_attribute_value(class_name, predicted)
+        return PredictionResult(
+            actual=actual_value,
+            predicted=predicted_value,
+            probability=None,)
+    
+    fmt = None
+    header_lines = [] # lines read before the table header
+    checked_tree = False
+    total = 0
+    lines = iter(lines)
+    while 1:
+        line = next(lines, None)
+        if line is None:
+            break
+        line = line.rstrip('\r\n') + '\n'
+        if fmt is None:
+            if not checked_tree and 'J48 pruned tree' in line:
+                # The tree spans several lines, so read the rest of the output.
+                rest = [line] + [_.rstrip('\r\n') + '\n' for _ in lines]
+                q = J48_TREE_REGEX.findall(''.join(rest))
+                if q:
+                    class_label = q[0]
+                    prob = 1.0
+                    yield PredictionResult(
+                        actual=None,
+                        predicted=class_label,
+                        probability=prob,)
+                    return
+                checked_tree = True
+                lines = iter(rest[1:])
+            if NOMINAL_HEADER_REGEX.search(line):
+                fmt = 'nominal'
+            elif 'inst#' in line:
+                fmt = 'simple'
+            else:
+                header_lines.append(line)
+            continue
+        if fmt == 'nominal':
+            match = NOMINAL_PREDICTION_REGEX.match(line)
+            if match:
+                total += 1
+                yield nominal_result(match)
+        else:
+            match = SIMPLE_PREDICTION_REGEX.match(line)
+            if match:
+                total += 1
+                yield simple_result(match)
+    
+    if fmt is None:
+        # Otherwise, assume a simple output without a header.
+        for line in header_lines:
+            match = SIMPLE_PREDICTION_REGEX.match(line)
+            if match:
+                total += 1
+                yield simple_result(match)
+    assert total, "No results found matching %s pattern in stdout: %s" \
+        % ('distribution' if fmt == 'nominal' else 'simple', ''.join(header_lines))
+
 class TrainingError(Exception):
     pass
 
 class PredictionError(Exception):
     pass
 
+def write_temp_arff(data):
+    """
+    Writes an ArffFile to a new temporary file and returns its name.
+    """
+    fd, fn = tempfile.mkstemp(suffix='.arff')
+    with os.fdopen(fd, 'w') as fout:
+        data.write(fout=fout)
+    return fn
+
+class ArffPipe(object):
+    """
+    Serves an ArffFile to another process through a named pipe, so it can
+    be read like a file while its rows are written out lazily, without the
+    data ever touching the disk.
+    
+    The data may also be the name of a compressed ARFF file, which is then
+    decompressed into the pipe.
+    
+    Since Weka may read a file more than once, the data is written again
+    each time the pipe is opened, until the pipe is closed.
+    """
+
+    def __init__(self, data, fmt=SPARSE):
+        assert hasattr(os, 'mkfifo'), 'Named pipes are not supported on this platform.'
+        self.data = data
+        self.fmt = fmt
+        self._dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self._dir, 'data.arff')
+        os.mkfifo(self.filename)
+        self._closed = threading.Event()
+        # The error raised while serving the data, if any, re-raised by close().
+        self.exc_info = None
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _serve(self):
+        while not self._closed.is_set():
+            try:
+                # Opening without blocking fails until there's a reader,
+                # letting the loop notice when the pipe is closed.
+                fd = os.open(self.filename, os.O_WRONLY|os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    self._closed.wait(0.01)
+                    continue
+                self.exc_info = self.exc_info or sys.exc_info()
+                return
+            try:
+                self._write(fd)
+            except Exception as e: # pylint: disable=broad-except
+                # The reader stopping early, e.g. after reading the header,
+                # isn't an error.
+                if not isinstance(e, (IOError, OSError)) or e.errno != errno.EPIPE:
+                    self.exc_info = self.exc_info or sys.exc_info()
+
+    def _write(self, fd):
+        """
+        Writes the data to a newly opened pipe, always closing it so the
+        reader sees the end of the file, even if writing fails.
+        """
+        with os.fdopen(fd, 'w') as fout:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            # Replace the pipe, so the next open waits for a new reader
+            # instead of joining the current one.
+            os.remove(self.filename)
+            os.mkfifo(self.filename)
+            if self.exc_info is not None:
+                # Once writing has failed, later readers get an empty file
+                # instead of waiting on a pipe nobody serves.
+                return
+            if isinstance(self.data, basestring):
+                with arff.open_file(self.data) as fin:
+                    shutil.copyfileobj(fin, fout)
+            else:
+                self.data.write(fout=fout, fmt=self.fmt)
+
+    def close(self):
+        """
+        Stops serving the data and removes the pipe, then raises any error
+        raised while writing the data.
+        """
+        self._closed.set()
+        self._thread.join()
+        shutil.rmtree(self._dir, ignore_errors=True)
+        if self.exc_info is not None:
+            reraise(*self.exc_info)
+
+def _is_pipe(fn):
+    return os.path.exists(fn) and stat.S_ISFIFO(os.stat(fn).st_mode)
+
+def get_weka_file(data, pipe=False):
+    """
+    Returns a tuple of the form (filename, cleanup), naming an uncompressed
+    ARFF file Weka can read holding the given ArffFile or ARFF filename,
+    and a function removing any temporary file or pipe created for it, or
+    None.
+    
+    ArffFiles are written to a temporary file, or with pipe=True, streamed
+    through a named pipe. Compressed files are decompressed through a named
+    pipe where supported, or into a temporary file otherwise.
+    """
+    if isinstance(data, basestring):
+        assert os.path.isfile(data)
+        if arff.get_compression(data) is None:
+            return data, None
+        if hasattr(os, 'mkfifo'):
+            data_pipe = ArffPipe(data)
+            return data_pipe.filename, data_pipe.close
+        fd, fn = tempfile.mkstemp(suffix='.arff')
+        with os.fdopen(fd, 'w') as fout:
+            with arff.open_file(data) as fin:
+                shutil.copyfileobj(fin, fout)
+        return fn, partial(os.remove, fn)
+    assert isinstance(data, arff.ArffFile), 'Must be of type ArffFile, not "%s"' % type(data).__name__
+    if pipe:
+        data_pipe = ArffPipe(data)
+        return data_pipe.filename, data_pipe.close
+    fn = write_temp_arff(data)
+    return fn, partial(os.remove, fn)
+
+def _kill(p):
+    """
+    Kills a process started by _start_command(), along with its children.
+    """
+    try:
+        if sys.platform == "win32":
+            p.kill()
+        else:
+            os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def _start_command(cmd, timeout=None):
+    """
+    Starts a shell command, returning the process and, if timeout is given,
+    the started timer that will kill it after that many seconds.
+    """
+    kwargs = {}
+    if sys.platform != "win32":
+        # Run in a new session, so the JVM is killed with the shell.
+        # A preexec_fn isn't safe when other threads are running, so it's
+        # only used where Popen can't start the session itself.
+        if PY3:
+            kwargs['start_new_session'] = True
+        else:
+            kwargs['preexec_fn'] = os.setsid
+    p = Popen(
+        cmd,
+        shell=True,
+        stdin=PIPE, stdout=PIPE, stderr=PIPE,
+        close_fds=sys.platform != "win32",
+        **kwargs)
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, _kill, [p])
+        timer.start()
+    return p, timer
+
+def run_command(cmd, timeout=None):
+    """
+    Runs a shell command and returns a tuple of the form
+    (timed_out, stdout, stderr).
+    
+    If the command is still running after timeout seconds, it's killed
+    along with any processes it started.
+    """
+    p, timer = _start_command(cmd, timeout=timeout)
+    try:
+        stdout_str, stderr_str = p.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    timed_out = timer is not None and p.returncode == -signal.SIGKILL
+    return timed_out, stdout_str, stderr_str
+
+class CommandStream(object):
+    """
+    Runs a shell command, iterating over the lines of its stdout as they're
+    written, while a separate thread collects stderr so neither pipe can
+    fill up and block the process.
+    
+    If the command is still running after timeout seconds, it's killed
+    along with any processes it started.
+    """
+
+    def __init__(self, cmd, timeout=None):
+        self.process, self._timer = _start_command(cmd, timeout=timeout)
+        self.process.stdin.close()
+        self._stderr = []
+        self._stderr_thread = threading.Thread(target=self._read_stderr)
+        self._stderr_thread.daemon = True
+        self._stderr_thread.start()
+
+    def _read_stderr(self):
+        self._stderr.append(self.process.stderr.read())
+
+    def __iter__(self):
+        for line in iter(self.process.stdout.readline, b''):
+            yield line.decode('utf-8')
+
+    def kill(self):
+        _kill(self.process)
+
+    def wait(self):
+        """
+        Waits for the command to exit, returning a tuple of the form
+        (timed_out, stderr).
+        """
+        self.process.stdout.close()
+        self.process.wait()
+        self._stderr_thread.join()
+        self.process.stderr.close()
+        if self._timer is not None:
+            self._timer.cancel()
+        timed_out = self._timer is not None and self.process.returncode == -signal.SIGKILL
+        return timed_out, b''.join(self._stderr)
+
 class Classifier(object):
     
-    def __init__(self, name, ckargs=None, model_data=None):
+    # An optional long-lived prediction process, such as a
+    # worker.PredictionWorker, or a worker.WorkerPool shared by many
+    # classifiers, used by predict() instead of launching a new JVM for
+    # every call.
+    worker = None
+    
+    # The type numeric values are parsed into, Decimal or float.
+    numeric_type = Decimal
+    
+    # An optional cache.ModelCache holding model files, so they're only
+    # written to disk once instead of for every call to Weka.
+    model_cache = None
+    
+    # An optional cache.PredictionCache or cache.DiskPredictionCache
+    # remembering the prediction made for each query row, so only rows
+    # not seen before are sent to Weka.
+    prediction_cache = None
+    
+    def __init__(self, name, ckargs=None, model_data=None, numeric_type=Decimal):
         self._model_data = model_data
         self.name = name # Weka classifier class name.
         self.schema = None
         self.ckargs = ckargs
+        self.numeric_type = numeric_type
         
         self.last_training_stdout = None
         self.last_training_stderr = None
 
+    def __getstate__(self):
+        # Running processes can't be pickled.
+        state = self.__dict__.copy()
+        state.pop('worker', None)
+        return state
+
     @classmethod
     def load(cls, fn, compress=True, *args, **kwargs):
         if compress and not fn.strip().lower().endswith('.gz'):
@@ -285,42 +710,62 @@ class Classifier(object):
         if matches:
             return float(matches[0])
 
-    def train(self, training_data, testing_data=None, verbose=False):
+    def _find_output_statistic(self, regex):
+        """
+        Returns the first statistic the regex matches in the output of the
+        last training, or None if there isn't one.
+        """
+        s = self.last_training_stdout
+        if PY3:
+            s = s.decode('utf-8')
+        matches = regex.findall(s)
+        if matches:
+            return float(matches[0])
+
+    @property
+    def testing_correlation_coefficient(self):
+        """
+        The correlation coefficient Weka reported for the testing data, or
+        None if the classifier wasn't last trained against testing data.
+        """
+        return self._find_output_statistic(WEKA_TEST_CORRELATION_REGEX)
+
+    @property
+    def testing_mean_absolute_error(self):
+        return self._find_output_statistic(WEKA_TEST_MAE_REGEX)
+
+    def train(self, training_data, testing_data=None, verbose=False, timeout=None, pipe=False):
         """
         Updates the classifier with new data.
+        
+        If timeout is given, Weka is killed and a TrainingError raised once
+        training has taken more than that many seconds.
+        
+        If pipe is True, ArffFile data is streamed to Weka through named
+        pipes instead of being written to temporary files.
+        
+        Data files may be compressed with gzip, bzip2 or xz.
         """
         model_fn = None
-        training_fn = None
-        clean_training = False
-        testing_fn = None
-        clean_testing = False
+        cleanups = []
         try:
             
             # Validate training data.
-            if isinstance(training_data, basestring):
-                assert os.path.isfile(training_data)
-                training_fn = training_data
-            else:
-                assert isinstance(training_data, arff.ArffFile)
-                fd, training_fn = tempfile.mkstemp(suffix='.arff')
-                os.close(fd)
-                with open(training_fn, 'w') as fout:
-                    fout.write(training_data.write())
-                clean_training = True
+            training_fn, cleanup = get_weka_file(training_data, pipe=pipe)
+            if cleanup:
+                cleanups.append(cleanup)
             assert training_fn
                 
             # Validate testing data.
             if testing_data:
-                if isinstance(testing_data, basestring):
-                    assert os.path.isfile(testing_data)
-                    testing_fn = testing_data
-                else:
-                    assert isinstance(testing_data, arff.ArffFile)
-                    fd, testing_fn = tempfile.mkstemp(suffix='.arff')
-                    os.close(fd)
-                    with open(testing_fn, 'w') as fout:
-                        fout.write(testing_data.write())
-                    clean_testing = True
+                testing_fn, cleanup = get_weka_file(testing_data, pipe=pipe)
+                if cleanup:
+                    cleanups.append(cleanup)
+            elif _is_pipe(training_fn):
+                # Weka may have both files open at once, so they can't share
+                # a pipe.
+                testing_fn, cleanup = get_weka_file(training_data, pipe=pipe)
+                cleanups.append(cleanup)
             else:
                 testing_fn = training_fn
             assert testing_fn
@@ -328,16 +773,22 @@ class Classifier(object):
             # Validate model file.
             fd, model_fn = tempfile.mkstemp()
             os.close(fd)
+            load_model_fn = model_fn
             if self._model_data:
-                fout = open(model_fn, 'wb')
-                fout.write(self._model_data)
-                fout.close()
+                if self.model_cache is not None:
+                    load_model_fn = self.model_cache.get(self._model_data)
+                else:
+                    fout = open(model_fn, 'wb')
+                    fout.write(self._model_data)
+                    fout.close()
             
             # Call Weka Jar.
             args = dict(
+                java=JAVA,
                 CP=CP,
                 classifier_name=self.name,
                 model_fn=model_fn,
+                load_model_fn=load_model_fn,
                 training_fn=training_fn,
                 testing_fn=testing_fn,
                 ckargs=self._get_ckargs_str(),
@@ -345,26 +796,23 @@ class Classifier(object):
             if self._model_data:
                 # Load existing model.
                 cmd = (
-                    "java -cp %(CP)s %(classifier_name)s -l \"%(model_fn)s\" "
+                    "%(java)s -cp %(CP)s %(classifier_name)s -l \"%(load_model_fn)s\" "
                     "-t \"%(training_fn)s\" -T \"%(testing_fn)s\" -d \"%(model_fn)s\"") % args
             else:
                 # Create new model file.
                 cmd = (
-                    "java -cp %(CP)s %(classifier_name)s -t \"%(training_fn)s\" "
+                    "%(java)s -cp %(CP)s %(classifier_name)s -t \"%(training_fn)s\" "
                     "-T \"%(testing_fn)s\" -d \"%(model_fn)s\" %(ckargs)s") % args
             if verbose:
                 print(cmd)
-            p = Popen(
-                cmd,
-                shell=True,
-                stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=sys.platform != "win32")
-            stdin, stdout, stderr = (p.stdin, p.stdout, p.stderr)
-            stdout_str = stdout.read()
-            stderr_str = stderr.read()
+            timed_out, stdout_str, stderr_str = run_command(cmd, timeout=timeout)
             
             self.last_training_stdout = stdout_str
             self.last_training_stderr = stderr_str
             
+            if timed_out:
+                raise TrainingError('Training %s timed out after %s seconds.' % (self.name, timeout))
+            
             if verbose:
                 print('stdout:')
                 print(stdout_str)
@@ -376,23 +824,35 @@ class Classifier(object):
                 raise TrainingError(stderr_str)
             
             # Save schema.
-            if not self.schema:
-                self.schema = arff.ArffFile.load(training_fn, schema_only=True).copy(schema_only=True)
+            if self.schema is None:
+                if isinstance(training_data, arff.ArffFile):
+                    self.schema = training_data.copy(schema_only=True)
+                else:
+                    self.schema = arff.ArffFile.load(training_data, schema_only=True)
             
             # Save model.
             with open(model_fn, 'rb') as fin:
                 self._model_data = fin.read()
             assert self._model_data
+            if self.model_cache is not None:
+                # Keep the new model file for later predictions.
+                self.model_cache.add_file(model_fn, self._model_data)
+                model_fn = None
         finally:
             # Cleanup files.
             if model_fn:
                 os.remove(model_fn)
-            if training_fn and clean_training:
-                os.remove(training_fn)
-            if testing_fn and clean_testing:
-                os.remove(testing_fn)
+            # Every pipe is closed before raising the first one's error.
+            errors = []
+            for cleanup in cleanups:
+                try:
+                    cleanup()
+                except Exception: # pylint: disable=broad-except
+                    errors.append(sys.exc_info())
+            if errors:
+                reraise(*errors[0])
         
-    def predict(self, query_data, verbose=False, distribution=False, cleanup=True):
+    def predict(self, query_data, verbose=False, distribution=False, cleanup=True, timeout=None, pipe=False, cache=True):
         """
         Iterates over the predicted values and probability (if supported).
         Each iteration yields a tuple of the form (prediction, probability).
@@ -402,165 +862,291 @@ class Classifier(object):
         
         See http://weka.wikispaces.com/Making+predictions
         for further explanation on interpreting Weka prediction output.
+        
+        If a worker is attached, the query is sent to it instead of a new
+        Java process.
+        
+        If timeout is given, Weka is killed and a PredictionError raised once
+        it has run for more than that many seconds.
+        
+        If pipe is True, an ArffFile query is streamed to Weka through a named
+        pipe instead of being written to a temporary file.
+        
+        If a prediction cache is attached, and cache is True, rows predicted
+        before are answered from it, and only the rest are sent to Weka.
         """
+        if cache and self.prediction_cache is not None:
+            for result in self._predict_cached(
+                query_data,
+                verbose=verbose,
+                distribution=distribution,
+                cleanup=cleanup,
+                timeout=timeout,
+                pipe=pipe):
+                yield result
+            return
+        
+        if self.worker is not None:
+            for result in self.worker.predict(self, query_data, distribution=distribution, verbose=verbose):
+                yield result
+            return
+        
         model_fn = None
+        clean_model = False
         query_fn = None
-        clean_query = False
-        stdout = None
+        query_cleanup = None
         try:
             
             # Validate query data.
-            if isinstance(query_data, basestring):
-                assert os.path.isfile(query_data)
-                query_fn = query_data
-            else:
-                assert type(query_data).__name__ == 'ArffFile', 'Must be of type ArffFile, not "%s"' % type(query_data).__name__
-                fd, query_fn = tempfile.mkstemp(suffix='.arff')
-                if verbose:
-                    print('writing', query_fn)
-                os.close(fd)
-                open(query_fn, 'w').write(query_data.write())
-                clean_query = True
+            query_fn, query_cleanup = get_weka_file(query_data, pipe=pipe)
+            if verbose and query_cleanup is not None:
+                print('writing', query_fn)
             assert query_fn
                 
             # Validate model file.
-            fd, model_fn = tempfile.mkstemp()
-            os.close(fd)
             assert self._model_data, "You must train this classifier before predicting."
-            fout = open(model_fn, 'wb')
-            fout.write(self._model_data)
-            fout.close()
+            if self.model_cache is not None:
+                model_fn = self.model_cache.get(self._model_data)
+            else:
+                fd, model_fn = tempfile.mkstemp()
+                os.close(fd)
+                clean_model = True
+                fout = open(model_fn, 'wb')
+                fout.write(self._model_data)
+                fout.close()
 
             args = dict(
+                java=JAVA,
                 CP=CP,
                 classifier_name=self.name,
                 model_fn=model_fn,
                 query_fn=query_fn,
                 distribution=('-distribution' if distribution else ''),
             )
-            cmd = ("java -cp %(CP)s %(classifier_name)s -p 0 %(distribution)s -l \"%(model_fn)s\" -T \"%(query_fn)s\"") % args
+            cmd = ("%(java)s -cp %(CP)s %(classifier_name)s -p 0 %(distribution)s -l \"%(model_fn)s\" -T \"%(query_fn)s\"") % args
             if verbose:
                 print(cmd)
-            p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True)
-            stdin, stdout, stderr = (p.stdin, p.stdout, p.stderr)
-            stdout_str = stdout.read()
-            stderr_str = stderr.read()
-            if verbose:
-                print('stdout:')
-                print(stdout_str)
-                print('stderr:')
-                print(stderr_str)
-            if stderr_str:
-                raise PredictionError(stderr_str)
             
-            if stdout_str:
-                # inst#     actual  predicted error prediction
-                #header = 'inst,actual,predicted,error'.split(',')
-                query = arff.ArffFile.load(query_fn)
+            # Only the schema is needed to decode predictions, so the
+            # data is only read to report the query variables.
+            if isinstance(query_data, arff.ArffFile):
+                query = arff.ArffFile.parse(
+                    query_data.write(schema_only=True),
+                    schema_only=True,
+                    numeric_type=query_data.numeric_type)
+                query.data = query_data.data
+            else:
+                query = arff.ArffFile.load(
+                    query_data,
+                    schema_only=not verbose,
+                    numeric_type=self.numeric_type)
+            if verbose:
                 query_variables = [
                     query.attributes[i]
                     for i, v in enumerate(query.data[0])
                     if v == arff.MISSING]
                 if not query_variables:
                     query_variables = [query.attributes[-1]]
-#                assert query_variables, \
-#                    "There must be at least one query variable in the query."
+                print('query_variables:', query_variables)
+            
+            # Parse predictions as Weka prints them.
+            command = CommandStream(cmd, timeout=timeout)
+            def read_lines():
+                for line in command:
+                    if verbose:
+                        print(line, end='')
+                    yield line
+            lines = read_lines()
+            parse_error = None
+            done = False
+            try:
                 if verbose:
-                    print('query_variables:', query_variables)
-                header = 'predicted'.split(',')
-                # sample line:     1        1:?       4:36   +   1
-                
-                # Expected output without distribution:
-                #=== Predictions on test data ===
-                #
-                # inst#     actual  predicted error prediction
-                #     1        1:? 11:Acer_tr   +   1
-
-                #=== Predictions on test data ===
-                #
-                # inst#     actual  predicted      error
-                #     1          ?      7              ? 
-
-                #=== Predictions on test data ===
-                #
-                # inst#     actual  predicted error prediction
-                #     1        1:?        1:0       0.99 
-                #     2        1:?        1:0       0.99 
-                #     3        1:?        1:0       0.99 
-                #     4        1:?        1:0       0.99 
-                #     5        1:?        1:0       0.99 
-
-                # Expected output with distribution:
-                #=== Predictions on test data ===
-                #
-                # inst#     actual  predicted error distribution
-                #     1        1:? 11:Acer_tr   +   0,0,0,0,0,0,0,0,0,0,*1,0,0,0,0,0...
-
-                # Expected output with simple format:
-                # inst#     actual  predicted      error
-                #     1          ?     -3.417          ? 
-
-
-                q = re.findall(
-                    r'J48 pruned tree\s+\-+:\s+([0-9]+)\s+',
-                    stdout_str.decode('utf-8'), re.MULTILINE|re.DOTALL)
-                if q:
-                    class_label = q[0]
-                    prob = 1.0
-                    yield PredictionResult(
-                        actual=None,
-                        predicted=class_label,
-                        probability=prob,)
-                elif re.findall(r'error\s+(?:distribution|prediction)', stdout_str.decode('utf-8')):
-                    # Check for distribution output.
-                    matches = re.findall(
-                        r"^\s*[0-9\.]+\s+[a-zA-Z0-9\.\?\:]+\s+(?P<cls_value>[a-zA-Z0-9_\.\?\:]+)\s+\+?\s+(?P<prob>[a-zA-Z0-9\.\?\,\*]+)",
-                        stdout_str.decode('utf-8'),
-                        re.MULTILINE)
-                    assert matches, ("No results found matching distribution pattern in stdout: %s") % stdout_str
-                    for match in matches:
-                        prediction, prob = match
-                        class_index, class_label = prediction.split(':')
-                        class_index = int(class_index)
-                        if distribution:
-                            # Convert list of probabilities into a hash linking the prob
-                            # to the associated class value.
-                            prob = dict(zip(
-                                query.attribute_data[query.attributes[-1]],
-                                map(float, prob.replace('*', '').split(','))))
-                        else:
-                            prob = float(prob)
-                        class_label = query.attribute_data[query.attributes[-1]][class_index-1]
-                        yield PredictionResult(
-                            actual=None,
-                            predicted=class_label,
-                            probability=prob,)
-                else:
-                    # Otherwise, assume a simple output.
-                    matches = re.findall(
-                        # inst#     actual  predicted 
-                        r"^\s*([0-9\.]+)\s+([a-zA-Z0-9\-\.\?\:]+)\s+([a-zA-Z0-9\-_\.\?\:]+)\s+",
-                        stdout_str.decode('utf-8'),
-                        re.MULTILINE)
-                    assert matches, "No results found matching simple pattern in stdout: %s" % stdout_str
-                    #print('matches:',len(matches)
-                    for match in matches:
-                        inst, actual, predicted = match
-                        class_name = query.attributes[-1]
-                        actual_value = query.get_attribute_value(class_name, actual)
-                        predicted_value = query.get_attribute_value(class_name, predicted)
-                        yield PredictionResult(
-                            actual=actual_value,
-                            predicted=predicted_value,
-                            probability=None,)
+                    print('stdout:')
+                first_line = next(lines, None)
+                if first_line is not None:
+                    try:
+                        for result in iter_predictions(chain([first_line], lines), query, distribution=distribution):
+                            yield result
+                    except AssertionError as e:
+                        # Weka's own error, if any, explains this better.
+                        parse_error = e
+                done = True
+            finally:
+                if not done:
+                    command.kill()
+                    command.wait()
+            timed_out, stderr_str = command.wait()
+            if timed_out:
+                raise PredictionError('Predicting with %s timed out after %s seconds.' % (self.name, timeout))
+            if verbose:
+                print('stderr:')
+                print(stderr_str)
+            if stderr_str:
+                raise PredictionError(stderr_str)
+            if parse_error is not None:
+                raise parse_error
         finally:
+            # Pipes are always closed, even if files are kept.
+            if query_cleanup is not None and (cleanup or _is_pipe(query_fn)):
+                query_cleanup()
             # Cleanup files.
             if cleanup:
-                if model_fn:
-                    self._model_data = open(model_fn, 'rb').read()
+                # Predicting never changes the model, so there's no need
+                # to read it back.
+                if model_fn and clean_model:
                     os.remove(model_fn)
-                if query_fn and clean_query:
-                    os.remove(query_fn)
+                
+    def _predict_cached(self, query_data, distribution=False, **kwargs):
+        """
+        Iterates over the predictions for the query, looking each row up in
+        the prediction cache and sending only the distinct rows missing from
+        it to Weka, in a single call.
+        
+        Results are yielded in the order of the query rows, with hits before
+        the first miss yielded before Weka is even started.
+        """
+        assert self._model_data, "You must train this classifier before predicting."
+        cache = self.prediction_cache
+        if isinstance(query_data, basestring):
+            assert os.path.isfile(query_data)
+            query = arff.ArffFile.load(query_data, numeric_type=self.numeric_type)
+        else:
+            assert isinstance(query_data, arff.ArffFile), \
+                'Must be of type ArffFile, not "%s"' % type(query_data).__name__
+            query = query_data
+        
+        # Rows are identified by their sparse line, which is the same
+        # however the row is stored, along with the model and the schema
+        # they're decoded against.
+        hasher = get_prediction_hasher(
+            get_model_key(self._model_data),
+            query.write_attributes(),
+            distribution=distribution)
+        write_line = query.get_line_writer(SPARSE)
+        keys = []
+        found = {} # {key: cached result}
+        missing = set()
+        miss_mask = []
+        for row in query.data:
+            line = write_line(row)
+            key = None
+            if line is not None:
+                key = get_prediction_key(hasher, line)
+            keys.append(key)
+            is_miss = False
+            if key is not None and key not in found and key not in missing:
+                result = cache.get(key)
+                if result is None:
+                    missing.add(key)
+                    is_miss = True
+                else:
+                    found[key] = result
+            miss_mask.append(is_miss)
+        
+        # Weka is only called once the first miss is reached, and its
+        # results are merged back in as they're read.
+        fresh = None
+        for key in keys:
+            if key is None:
+                # Rows with nothing to write are never sent to Weka.
+                continue
+            result = found.get(key)
+            if result is None:
+                if fresh is None:
+                    fresh = self.predict(
+                        query.view(miss_mask),
+                        distribution=distribution,
+                        cache=False,
+                        **kwargs)
+                result = next(fresh, None)
+                if result is None:
+                    raise PredictionError(
+                        'Weka returned %i predictions for %i uncached rows.'
+                        % (sum(key in found for key in missing), len(missing)))
+                cache.set(key, result)
+                found[key] = result
+            yield result
+        if fresh is not None:
+            # Finish reading, so any error Weka reports is still raised.
+            for _ in fresh:
+                pass
+
+    def predict_iter(self, query_source, chunk_size=1000, schema=None, pipeline=False, **kwargs):
+        """
+        Iterates over predictions like predict(), but queries Weka with at
+        most chunk_size rows at a time, so memory use is bounded by the chunk
+        size rather than the size of the query.
+        
+        The query_source may be an ArffFile, the name of an ARFF file, which
+        is read lazily, or an iterable of rows in the form stored in
+        ArffFile.data, described by schema (by default the schema the
+        classifier was trained with).
+        
+        If pipeline is True, the next chunk is read and written out in a
+        background thread while the current one is being predicted.
+        
+        Other keyword arguments are passed on to predict(). With pipe=True,
+        each chunk is streamed to Weka instead of written to a file.
+        """
+        pipe = kwargs.get('pipe', False)
+        assert chunk_size >= 1
+        reader = None
+        if isinstance(query_source, basestring):
+            reader = arff.ArffReader(query_source, numeric_type=self.numeric_type)
+            schema = reader.schema
+            rows = iter(reader)
+        elif isinstance(query_source, arff.ArffFile):
+            schema = query_source
+            rows = iter(query_source.data)
+        else:
+            if schema is None:
+                schema = self.schema
+            assert schema is not None, 'A schema is required to predict rows.'
+            rows = iter(query_source)
+        schema = schema.copy(schema_only=True)
+        
+        def write_chunk():
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return None
+            query = schema.copy(schema_only=True)
+            query.data = chunk
+            if pipe:
+                return query
+            return write_temp_arff(query)
+        
+        pool = None
+        pending = None
+        if pipeline:
+            pool = ThreadPool(1)
+            pending = pool.apply_async(write_chunk)
+        try:
+            while 1:
+                if pipeline:
+                    query = pending.get()
+                    pending = None
+                    if query is not None:
+                        pending = pool.apply_async(write_chunk)
+                else:
+                    query = write_chunk()
+                if query is None:
+                    break
+                try:
+                    for result in self.predict(query, **kwargs):
+                        yield result
+                finally:
+                    if not pipe:
+                        os.remove(query)
+        finally:
+            if pending is not None:
+                query = pending.get()
+                if query is not None and not pipe:
+                    os.remove(query)
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if reader is not None:
+                reader.close()
                 
     def test(self, test_data, verbose=0):
         data = arff.ArffFile.load(test_data)
@@ -579,9 +1165,10 @@ class Classifier(object):
 
 class EnsembleClassifier(object):
     
-    def __init__(self, classes=None):
+    def __init__(self, classes=None, numeric_type=Decimal):
+        self.numeric_type = numeric_type
         self.best = None, None # score, cls
-        self.training_results = {} # {name: score}
+        self.training_results = OrderedDict() # {name: score}
         self.trained_classifiers = {} # {name: classifier instance}
         self.prediction_results = {} # {name: results}
         self.classes = list(classes or WEKA_CLASSIFIERS)
@@ -619,28 +1206,87 @@ class EnsembleClassifier(object):
         i = sum(1 for data in self.training_results.values() if not isinstance(data, basestring))
         return i/float(total)
     
-    def train(self, training_data, testing_data=None, verbose=False):
+    def _train_classifier(self, name, training_fn, testing_fn, schema, verbose=False, timeout=None):
+        """
+        Trains a single member of the ensemble, returning a tuple of the form
+        (classifier, (coef, inv_mae)), or (None, traceback) on failure.
+        """
+        try:
+            c = Classifier(name=name, numeric_type=self.numeric_type)
+            c.schema = schema.copy(schema_only=True)
+            t0 = time.time()
+            c.train(training_data=training_fn, testing_data=testing_fn, verbose=verbose, timeout=timeout)
+            td = time.time() - t0
+            coef = c.training_correlation_coefficient
+            mae = c.training_mean_absolute_error
+            print('%s: training seconds: %s, correlation_coefficient: %s, mean_absolute_error: %s' % (name, td, coef, mae))
+            return c, (coef, 1/(1+float(mae)))
+        except Exception:
+            traceback.print_exc()
+            return None, traceback.format_exc()
 
-        total = len(self.classes)
-        i = 0
-        for name in self.classes:
-            i += 1
-            try:
-                c = Classifier(name=name)
-                print('Training classifier %i of %i %.02f%% %s...' % (i+1, total, i/float(total)*100, name))
-                t0 = time.time()
-                c.train(training_data=training_data, testing_data=testing_data, verbose=verbose)
-                self.trained_classifiers[name] = c
-                td = time.time() - t0
-                print('Training seconds:', td)
-                coef = c.training_correlation_coefficient
-                print('correlation_coefficient:', coef)
-                mae = c.training_mean_absolute_error
-                print('mean_absolute_error:', mae)
-                self.training_results[name] = (coef, 1/(1+float(mae)))
-            except Exception:
-                traceback.print_exc()
-                self.training_results[name] = traceback.format_exc()
+    def train(self, training_data, testing_data=None, verbose=False, max_workers=1, timeout=None):
+        """
+        Trains every classifier in the ensemble, running up to max_workers
+        of them at once.
+        
+        If timeout is given, any classifier taking longer than that many
+        seconds to train is killed and recorded as an error.
+        """
+        assert max_workers >= 1
+        training_fn = None
+        clean_training = False
+        testing_fn = None
+        clean_testing = False
+        try:
+            
+            # Write the data once, to be shared by all classifiers.
+            if isinstance(training_data, basestring):
+                assert os.path.isfile(training_data)
+                training_fn = training_data
+            else:
+                assert isinstance(training_data, arff.ArffFile)
+                training_fn = write_temp_arff(training_data)
+                clean_training = True
+            if testing_data:
+                if isinstance(testing_data, basestring):
+                    assert os.path.isfile(testing_data)
+                    testing_fn = testing_data
+                else:
+                    assert isinstance(testing_data, arff.ArffFile)
+                    testing_fn = write_temp_arff(testing_data)
+                    clean_testing = True
+            schema = arff.ArffFile.load(training_fn, schema_only=True)
+            
+            total = len(self.classes)
+            def train_classifier(args):
+                i, name = args
+                print('Training classifier %i of %i %.02f%% %s...' % (i+1, total, (i+1)/float(total)*100, name))
+                return self._train_classifier(
+                    name, training_fn, testing_fn, schema, verbose=verbose, timeout=timeout)
+            jobs = list(enumerate(self.classes))
+            if max_workers == 1:
+                results = list(map(train_classifier, jobs))
+            else:
+                pool = ThreadPool(min(max_workers, total) or 1)
+                try:
+                    results = pool.map(train_classifier, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            
+            # Record results in the order the classifiers were given,
+            # regardless of which finished first.
+            for name, (c, result) in zip(self.classes, results):
+                if c is not None:
+                    self.trained_classifiers[name] = c
+                self.training_results[name] = result
+        finally:
+            # Cleanup files.
+            if training_fn and clean_training:
+                os.remove(training_fn)
+            if testing_fn and clean_testing:
+                os.remove(testing_fn)
 
     def get_best_predictors(self, tolerance, verbose=False):
         best_coef = -1e9999999999
@@ -660,36 +1306,305 @@ class EnsembleClassifier(object):
                 best_names.add(name)
         return best_names
 
-    def predict(self, query_data, tolerance=0, **kwargs):
+    def _predict_classifier(self, name, query_fn, deadline_time=None, **kwargs):
+        """
+        Queries a single member of the ensemble, returning its list of
+        results, or a traceback on failure.
+        """
+        try:
+            timeout = None
+            if deadline_time is not None:
+                timeout = deadline_time - time.time()
+                if timeout <= 0:
+                    raise PredictionError('Deadline passed before querying %s.' % name)
+            c = self.trained_classifiers[name]
+            return list(c.predict(query_data=query_fn, timeout=timeout, **kwargs))
+        except Exception:
+            traceback.print_exc()
+            return traceback.format_exc()
+
+    def predict(self, query_data, tolerance=0, max_workers=1, deadline=None, **kwargs):
+        """
+        Returns the averaged predictions of the best classifiers, querying up
+        to max_workers of them at once.
+        
+        If deadline is given, members that haven't answered within that many
+        seconds are dropped from the average.
+        """
         verbose = kwargs.get('verbose', False)
         assert self.training_results, 'Classifier must be trained first!'
+        assert max_workers >= 1
         
-        best_names = self.get_best_predictors(tolerance=tolerance)
-
-        total = len(best_names)
-        i = 0
-        for name in best_names:
-            i += 1
-            try:
-                c = self.trained_classifiers[name]
+        best_names = sorted(self.get_best_predictors(tolerance=tolerance))
+        
+        deadline_time = None
+        if deadline is not None:
+            deadline_time = time.time() + deadline
+        
+        query_fn = None
+        clean_query = False
+        try:
+            
+            # Write the query once, to be shared by all classifiers.
+            if isinstance(query_data, basestring):
+                assert os.path.isfile(query_data)
+                query_fn = query_data
+            else:
+                assert isinstance(query_data, arff.ArffFile)
+                query_fn = write_temp_arff(query_data)
+                clean_query = True
+            
+            total = len(best_names)
+            def predict_classifier(args):
+                i, name = args
                 if verbose:
-                    print('Querying classifier %i of %i %.02f%% %s...' % (i, total, i/float(total)*100, name))
-                t0 = time.time()
-                results = list(c.predict(query_data=query_data, **kwargs))
-                td = time.time() - t0
-                self.prediction_results[name] = results
-            except Exception:
-                traceback.print_exc()
-                self.prediction_results[name] = traceback.format_exc()
+                    print('Querying classifier %i of %i %.02f%% %s...' % (i+1, total, (i+1)/float(total)*100, name))
+                return name, self._predict_classifier(name, query_fn, deadline_time=deadline_time, **kwargs)
+            jobs = list(enumerate(best_names))
+            pending = set(best_names)
+            if max_workers == 1:
+                results = iter(map(predict_classifier, jobs))
+            else:
+                pool = ThreadPool(min(max_workers, total) or 1)
+                results = pool.imap_unordered(predict_classifier, jobs)
+            try:
+                while pending:
+                    try:
+                        if deadline_time is None or max_workers == 1:
+                            name, result = next(results)
+                        else:
+                            name, result = results.next(max(deadline_time - time.time(), 0))
+                    except StopIteration:
+                        break
+                    except multiprocessing.TimeoutError:
+                        # Stop waiting on members that may not be using a
+                        # process that can be killed.
+                        for pending_name in pending:
+                            self.prediction_results[pending_name] = \
+                                'Deadline passed before %s answered.' % pending_name
+                        break
+                    pending.discard(name)
+                    self.prediction_results[name] = result
+            finally:
+                if max_workers != 1:
+                    pool.close()
+                    if not pending:
+                        pool.join()
+        finally:
+            # Cleanup files.
+            # Any member still running has either read the query already or
+            # will fail on its deadline.
+            if query_fn and clean_query:
+                os.remove(query_fn)
         
+        # Average each instance's predictions over the members that answered.
         results = {} # {index, [results]}
-        for k, v in self.prediction_results.items():
+        for name in best_names:
+            v = self.prediction_results.get(name)
+            if v is None or isinstance(v, basestring):
+                continue
             for i, result in enumerate(v):
-                if isinstance(v, basestring):
-                    continue
                 results.setdefault(i, [])
                 results[i].append(result)
         
         results = [PredictionResult.avg(*data) for i, data in sorted(results.items())]
 
         return results
+
+def get_test_score(c):
+    """
+    Returns the score Weka reported on the testing data for a classifier
+    trained against it: the correlation coefficient for numeric classes,
+    or the fraction of correctly classified instances for nominal ones.
+    """
+    coef = c.testing_correlation_coefficient
+    if coef is not None:
+        return coef
+    accuracy = c._find_output_statistic(WEKA_TEST_ACCURACY_REGEX)
+    if accuracy is not None:
+        return accuracy/100.
+
+class GridResult(object):
+    """
+    The cross-validation scores of one combination of classifier options.
+    """
+    
+    def __init__(self, name, ckargs):
+        self.name = name
+        self.ckargs = ckargs
+        self.scores = [] # [score of each fold evaluated]
+        self.error = None
+        self.stopped = False
+    
+    @property
+    def score(self):
+        if self.error is None and self.scores:
+            return sum(self.scores)/float(len(self.scores))
+    
+    def __repr__(self):
+        return '<%s %s score=%s folds=%i%s>' % (
+            self.name.split('.')[-1], self.ckargs, self.score, len(self.scores),
+            ' stopped' if self.stopped else '')
+
+class GridSearch(object):
+    """
+    Cross-validates every combination of a grid of classifier options.
+    
+    The data is split into k folds written out once, and reused by every
+    combination searched. Each fold is evaluated for all remaining
+    combinations at once, running up to max_workers trainings in parallel,
+    and combinations scoring worse than the best so far by more than
+    stop_margin are dropped instead of being evaluated on the other folds.
+    
+        with GridSearch('training.arff', folds=5, max_workers=4) as search:
+            best = search.run(IBk, {'K': range(1, 51)})
+            print(best.ckargs, best.score)
+    """
+    
+    def __init__(self, data, folds=5, max_workers=1, shuffle=False, seed=0,
+        stop_margin=0.1, min_folds=1, scoring=get_test_score,
+        timeout=None, numeric_type=Decimal, verbose=False):
+        assert folds >= 2
+        assert max_workers >= 1
+        self.data = data
+        self.folds = folds
+        self.max_workers = max_workers
+        self.shuffle = shuffle
+        self.seed = seed
+        self.stop_margin = stop_margin
+        self.min_folds = min_folds
+        self.scoring = scoring
+        self.timeout = timeout
+        self.numeric_type = numeric_type
+        self.verbose = verbose
+        self.results = [] # [GridResult]
+        self._fold_dir = None
+        self._fold_fns = None # [(training_fn, testing_fn)]
+        self._schema = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def get_folds(self):
+        """
+        Returns a list of (training_fn, testing_fn) filename pairs, one per
+        fold, writing them on first use.
+        """
+        if self._fold_fns is not None:
+            return self._fold_fns
+        data = self.data
+        if isinstance(data, basestring):
+            data = arff.ArffFile.load(data, numeric_type=self.numeric_type)
+        assert isinstance(data, arff.ArffFile)
+        positions = list(range(len(data)))
+        if self.shuffle:
+            random.Random(self.seed).shuffle(positions)
+        assignments = [0]*len(positions)
+        for i, position in enumerate(positions):
+            assignments[position] = i % self.folds
+        self._fold_dir = tempfile.mkdtemp(prefix='pywekaclassifiers-folds-')
+        fold_fns = []
+        for fold in range(self.folds):
+            fns = []
+            for part, keep in (('train', False), ('test', True)):
+                fn = os.path.join(self._fold_dir, 'fold%i-%s.arff' % (fold, part))
+                with open(fn, 'w') as fout:
+                    data.view([(_ == fold) == keep for _ in assignments]).write(fout=fout)
+                fns.append(fn)
+            fold_fns.append(tuple(fns))
+        self._schema = data.copy(schema_only=True)
+        self._fold_fns = fold_fns
+        return fold_fns
+    
+    def _evaluate(self, result, fold):
+        """
+        Trains a classifier on one fold, recording its score or error.
+        """
+        training_fn, testing_fn = self._fold_fns[fold]
+        try:
+            c = Classifier(name=result.name, ckargs=result.ckargs, numeric_type=self.numeric_type)
+            c.schema = self._schema.copy(schema_only=True)
+            c.train(training_data=training_fn, testing_data=testing_fn, verbose=self.verbose, timeout=self.timeout)
+            score = self.scoring(c)
+            assert score is not None, 'No score found in the output of %s.' % result.name
+            result.scores.append(score)
+        except Exception:
+            if self.verbose:
+                traceback.print_exc()
+            result.error = traceback.format_exc()
+    
+    def run(self, classifier, grid):
+        """
+        Searches the grid of option values, given as a dictionary mapping
+        option names to lists of values, for a classifier given by name or
+        as one of the shortcuts such as IBk.
+        
+        Returns the GridResult with the best mean score, or None if every
+        combination failed. All results are kept in the results attribute.
+        """
+        if isinstance(classifier, _Helper):
+            name, base_ckargs = classifier.name, classifier.ckargs
+        else:
+            name, base_ckargs = classifier, {}
+        keys = sorted(grid)
+        results = []
+        for values in product(*[list(grid[key]) for key in keys]):
+            ckargs = dict(base_ckargs)
+            ckargs.update(zip(keys, values))
+            results.append(GridResult(name, ckargs))
+        self.results.extend(results)
+        
+        fold_fns = self.get_folds()
+        pool = None
+        if self.max_workers > 1:
+            pool = ThreadPool(min(self.max_workers, len(results)) or 1)
+        try:
+            active = list(results)
+            for fold in range(len(fold_fns)):
+                jobs = [(result, fold) for result in active]
+                if pool is None:
+                    for job in jobs:
+                        self._evaluate(*job)
+                else:
+                    pool.map(lambda job: self._evaluate(*job), jobs)
+                active = [result for result in active if result.error is None]
+                if self.stop_margin is not None and fold + 1 >= self.min_folds and active:
+                    # Drop combinations that are clearly losing.
+                    best_score = max(result.score for result in active)
+                    for result in active:
+                        if result.score < best_score - self.stop_margin:
+                            result.stopped = True
+                    active = [result for result in active if not result.stopped]
+                if self.verbose:
+                    print('Fold %i of %i: %i combinations remaining.' % (fold + 1, len(fold_fns), len(active)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        
+        return self._get_best(results)
+    
+    @staticmethod
+    def _get_best(results):
+        finished = [result for result in results if result.score is not None and not result.stopped]
+        if finished:
+            return max(finished, key=lambda result: result.score)
+    
+    @property
+    def best(self):
+        """
+        The best result of every search run so far.
+        """
+        return self._get_best(self.results)
+    
+    def close(self):
+        """
+        Removes the fold files.
+        """
+        if self._fold_dir:
+            shutil.rmtree(self._fold_dir, ignore_errors=True)
+        self._fold_dir = None
+        self._fold_fns = None
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Stand-in for "java -cp weka.jar <classifier>" used by the tests.
+
+Accepts the same -t/-T/-d/-l/-p/-distribution arguments, but the "model"
+is a JSON file summarizing the class values it was trained on, and it
+always predicts their mean, or most common value for nominal classes.
+
+A few extra classifier options control its behaviour:
+
+    -K N        reported correlation coefficient is 1/(1+|N-3|) on the
+                test data, and 1/(1+|N-1|) on the training data
+    -sleep N    sleep N seconds when training and predicting
+    -fail       write an error to stderr
+
+Options may also be given per classifier through the FAKE_WEKA_OPTIONS
+environment variable, as a JSON object mapping classifier names to
+{option: value} objects.
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from pywekaclassifiers import arff # pylint: disable=wrong-import-position
+
+def parse_args(argv):
+    assert argv[0] == '-cp', argv
+    name = argv[2]
+    opts = {}
+    key = None
+    for arg in argv[3:]:
+        if arg.startswith('-') and not arg[1:2].isdigit():
+            key = arg[1:]
+            opts[key] = None
+        else:
+            opts[key] = arg
+    extra = json.loads(os.environ.get('FAKE_WEKA_OPTIONS') or '{}')
+    opts.update(extra.get(name, {}))
+    return name, opts
+
+def train(name, opts):
+    data = arff.ArffFile.load(opts['t'])
+    class_name = data.attributes[-1]
+    model = dict(classifier=name, options=opts, n=0, sum=0, counts={})
+    if 'l' in opts:
+        with open(opts['l']) as fin:
+            model = json.load(fin)
+    for row in data.data:
+        value = row[-1] if isinstance(row, list) else row.get(class_name)
+        if hasattr(value, 'value'):
+            value = value.value
+        if value is None or value == arff.MISSING:
+            continue
+        if data.attribute_types[class_name] == arff.TYPE_NOMINAL:
+            model['counts'][value] = model['counts'].get(value, 0) + 1
+        else:
+            model['sum'] += float(value)
+        model['n'] += 1
+    with open(opts['d'], 'w') as fout:
+        json.dump(model, fout)
+    coef = train_coef = 0.5
+    if model['options'].get('K') is not None:
+        coef = 1.0/(1 + abs(float(model['options']['K']) - 3))
+        train_coef = 1.0/(1 + abs(float(model['options']['K']) - 1))
+    # Like Weka, the training data is evaluated first.
+    print('=== Error on training data ===')
+    print('')
+    print('Correlation coefficient                  %.4f' % train_coef)
+    print('Mean absolute error                      %.4f' % (1 - train_coef))
+    print('')
+    print('=== Error on test data ===')
+    print('')
+    print('Correlation coefficient                  %.4f' % coef)
+    print('Mean absolute error                      %.4f' % (1 - coef))
+
+def predict(opts):
+    with open(opts['l']) as fin:
+        model = json.load(fin)
+    sleep = opts.get('sleep', model['options'].get('sleep'))
+    if sleep is not None:
+        time.sleep(float(sleep))
+    query = arff.ArffFile.load(opts['T'])
+    class_name = query.attributes[-1]
+    print('')
+    print('=== Predictions on test data ===')
+    print('')
+    if query.attribute_types[class_name] == arff.TYPE_NOMINAL:
+        values = query.attribute_data[class_name]
+        label = max(sorted(model['counts']), key=lambda v: model['counts'][v])
+        index = values.index(label)
+        if 'distribution' in opts:
+            print(' inst#     actual  predicted error distribution')
+            prob = ','.join(('*1' if i == index else '0') for i in range(len(values)))
+        else:
+            print(' inst#     actual  predicted error prediction')
+            prob = '1'
+        for i in range(len(query.data)):
+            print('%6i %10s %10s %5s %s' % (i + 1, '1:?', '%i:%s' % (index + 1, label), '', prob))
+    else:
+        mean = model['sum']/float(model['n'] or 1)
+        if query.attribute_types[class_name] == arff.TYPE_INTEGER:
+            mean = int(round(mean))
+        print(' inst#     actual  predicted      error')
+        for i in range(len(query.data)):
+            print('%6i %10s %10s %10s ' % (i + 1, '?', '%g' % round(mean, 3), '?'))
+    print('')
+
+def main():
+    name, opts = parse_args(sys.argv[1:])
+    if 'fail' in opts:
+        print('Exception: %s failed' % name, file=sys.stderr)
+        sys.exit(1)
+    if 'p' in opts:
+        predict(opts)
+    else:
+        if 'sleep' in opts:
+            time.sleep(float(opts['sleep']))
+        train(name, opts)
+
+if __name__ == '__main__':
+    main()
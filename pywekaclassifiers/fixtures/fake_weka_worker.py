@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Stand-in for WekaPredictionServer used by the tests.
+
+Speaks the same protocol, but a "model" is just a text file containing
+the value to predict for every query instance.
+"""
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from pywekaclassifiers import arff # pylint: disable=wrong-import-position
+
+def main():
+    models = {}
+    for line in iter(sys.stdin.readline, ''):
+        parts = line.strip().split(' ', 2)
+        if parts[0] == 'load':
+            with open(parts[2]) as fin:
+                models[parts[1]] = fin.read().strip()
+            print('ok')
+        elif parts[0] == 'unload':
+            models.pop(parts[1], None)
+            print('ok')
+        elif parts[0] == 'predict':
+            body = []
+            for line in iter(sys.stdin.readline, ''):
+                if line.strip() == '.':
+                    break
+                body.append(line)
+            if parts[1] not in models:
+                print('error Model %s is not loaded.' % parts[1])
+            else:
+                query = arff.ArffFile.parse(''.join(body))
+                print('=== Predictions on test data ===')
+                print('')
+                print(' inst#     actual  predicted      error')
+                for i in range(len(query.data)):
+                    print('%6i %10s %10s %10s ' % (i + 1, '?', models[parts[1]], '?'))
+                print('.')
+        elif parts[0] == 'quit':
+            break
+        else:
+            print('error Unknown command %s.' % parts[0])
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
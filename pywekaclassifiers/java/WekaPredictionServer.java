@@ -0,0 +1,135 @@
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.io.StringReader;
+import java.util.HashMap;
+import java.util.Map;
+
+import weka.classifiers.Classifier;
+import weka.core.Instance;
+import weka.core.Instances;
+import weka.core.SerializationHelper;
+import weka.core.Utils;
+
+/**
+ * Long-lived prediction server used by pywekaclassifiers.worker.
+ *
+ * Reads one command per line from stdin:
+ *
+ *   load KEY MODEL_FILE
+ *   unload KEY
+ *   predict KEY DISTRIBUTION(0|1)
+ *   ...ARFF text...
+ *   .
+ *   quit
+ *
+ * and answers each with "ok" or "error MESSAGE". Predictions are written in
+ * the same table format printed by "-p 0", followed by a line holding a
+ * single ".".
+ */
+public class WekaPredictionServer {
+
+    public static void main(String[] args) throws Exception {
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        PrintStream out = new PrintStream(System.out, false, "UTF-8");
+        Map<String, Classifier> models = new HashMap<String, Classifier>();
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] parts = line.trim().split(" ", 3);
+            try {
+                if (parts[0].equals("load")) {
+                    models.put(parts[1], (Classifier) SerializationHelper.read(parts[2]));
+                    out.println("ok");
+                } else if (parts[0].equals("unload")) {
+                    models.remove(parts[1]);
+                    out.println("ok");
+                } else if (parts[0].equals("predict")) {
+                    // Always consume the query body, so a failed request
+                    // doesn't leave the stream out of sync.
+                    StringBuilder arff = new StringBuilder();
+                    while ((line = in.readLine()) != null && !line.equals(".")) {
+                        arff.append(line).append('\n');
+                    }
+                    Classifier model = models.get(parts[1]);
+                    if (model == null) {
+                        throw new Exception("Model " + parts[1] + " is not loaded.");
+                    }
+                    Instances data = new Instances(new StringReader(arff.toString()));
+                    data.setClassIndex(data.numAttributes() - 1);
+                    predict(model, data, parts[2].equals("1"), out);
+                    out.println(".");
+                } else if (parts[0].equals("quit")) {
+                    break;
+                } else {
+                    throw new Exception("Unknown command " + parts[0] + ".");
+                }
+            } catch (Exception e) {
+                out.println("error " + String.valueOf(e).replace('\n', ' '));
+            }
+            out.flush();
+        }
+        out.flush();
+    }
+
+    private static void predict(Classifier model, Instances data, boolean distribution, PrintStream out) throws Exception {
+        boolean nominal = data.classAttribute().isNominal();
+        out.println("=== Predictions on test data ===");
+        out.println();
+        if (nominal) {
+            out.println(" inst#     actual  predicted error " + (distribution ? "distribution" : "prediction"));
+        } else {
+            out.println(" inst#     actual  predicted      error");
+        }
+        for (int i = 0; i < data.numInstances(); i++) {
+            Instance inst = data.instance(i);
+            double predicted = model.classifyInstance(inst);
+            StringBuilder row = new StringBuilder();
+            row.append(Utils.padLeft("" + (i + 1), 6)).append(' ');
+            if (nominal) {
+                String actual = "1:?";
+                if (!inst.classIsMissing()) {
+                    actual = ((int) inst.classValue() + 1) + ":" + inst.stringValue(data.classIndex());
+                }
+                String label = "?";
+                if (!Utils.isMissingValue(predicted)) {
+                    label = ((int) predicted + 1) + ":" + data.classAttribute().value((int) predicted);
+                }
+                boolean error = !inst.classIsMissing() && !Utils.isMissingValue(predicted)
+                    && (int) inst.classValue() != (int) predicted;
+                row.append(Utils.padLeft(actual, 10)).append(' ');
+                row.append(Utils.padLeft(label, 10)).append(' ');
+                row.append(error ? "  + " : "    ").append(' ');
+                double[] dist = model.distributionForInstance(inst);
+                if (distribution) {
+                    for (int j = 0; j < dist.length; j++) {
+                        if (j > 0) {
+                            row.append(',');
+                        }
+                        if (j == (int) predicted) {
+                            row.append('*');
+                        }
+                        row.append(Utils.doubleToString(dist[j], 3));
+                    }
+                } else if (!Utils.isMissingValue(predicted)) {
+                    row.append(Utils.doubleToString(dist[(int) predicted], 3));
+                } else {
+                    row.append('?');
+                }
+            } else {
+                String actual = "?";
+                String error = "?";
+                if (!inst.classIsMissing()) {
+                    actual = Utils.doubleToString(inst.classValue(), 3);
+                    if (!Utils.isMissingValue(predicted)) {
+                        error = Utils.doubleToString(predicted - inst.classValue(), 3);
+                    }
+                }
+                String label = Utils.isMissingValue(predicted) ? "?" : Utils.doubleToString(predicted, 3);
+                row.append(Utils.padLeft(actual, 10)).append(' ');
+                row.append(Utils.padLeft(label, 10)).append(' ');
+                row.append(Utils.padLeft(error, 10)).append(' ');
+            }
+            out.println(row.toString());
+        }
+    }
+}
@@ -1,16 +1,58 @@
 from __future__ import print_function
 
+import json
 import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime
+from decimal import Decimal
 
-from pywekaclassifiers.classifiers import Classifier, PredictionResult, PredictionError, BP, DENSE, UPDATEABLE_WEKA_CLASSIFIER_NAMES
+from six.moves import cPickle as pickle
+
+from pywekaclassifiers.classifiers import Classifier, EnsembleClassifier, GridSearch, PredictionResult, PredictionError, BP, DENSE, UPDATEABLE_WEKA_CLASSIFIER_NAMES
 from pywekaclassifiers.classifiers import IBk # pylint: disable=no-name-in-module
 from pywekaclassifiers import arff
+from pywekaclassifiers import classifiers
+from pywekaclassifiers.cache import DiskPredictionCache, ModelCache, PredictionCache, get_model_key, get_private_directory
 from pywekaclassifiers.arff import Num, Nom, Int, Str, Date
+from pywekaclassifiers.worker import PredictionWorker, WorkerPool
 
+FAKE_JAVA = '"%s" "%s"' % (sys.executable, os.path.join(BP, 'fixtures/fake_weka.py'))
 
 class Test(unittest.TestCase):
     
+    def use_fake_weka(self):
+        """
+        Runs Weka commands with a stand-in script instead of Java for the
+        rest of the test.
+        """
+        java = classifiers.JAVA
+        classifiers.JAVA = FAKE_JAVA
+        self.addCleanup(setattr, classifiers, 'JAVA', java)
+    
+    def set_fake_weka_options(self, options):
+        """
+        Passes extra options to the stand-in script, per classifier name.
+        """
+        os.environ['FAKE_WEKA_OPTIONS'] = json.dumps(options)
+        self.addCleanup(os.environ.pop, 'FAKE_WEKA_OPTIONS', None)
+    
+    @unittest.skipIf(sys.platform == 'win32', 'Process groups not supported.')
+    def test_run_command_timeout(self):
+        # The shell and the process it started are both killed, so the
+        # output pipes close without waiting for the child to finish.
+        t0 = time.time()
+        timed_out, _, _ = classifiers.run_command('sleep 30; echo done', timeout=0.5)
+        self.assertTrue(timed_out)
+        self.assertTrue(time.time() - t0 < 10)
+        timed_out, stdout, _ = classifiers.run_command('echo done', timeout=10)
+        self.assertFalse(timed_out)
+        self.assertEqual(stdout.strip(), b'done')
+    
     def test_arff(self):
     
         data = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-train.arff'))
@@ -311,5 +353,943 @@ M,0.35,0.265,0.09,0.2255,0.0995,0.0485,0.07,?
         # automatically omitted when in streaming mode.
         self.assertEqual(s3, s4)
 
+    def test_pickle_arff(self):
+        """
+        Confirm files still pickle after parsing, with compiled parsers rebuilt.
+        """
+        a = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-train.arff'))
+        a.append(list(a.data[0]))
+        b = pickle.loads(pickle.dumps(a, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(b.data, a.data)
+        b.append(list(a.data[0]))
+        self.assertEqual(b.data[-1], a.data[0])
+        self.assertEqual(b.write(), a.write() + a.write_line(a.data[0]) + '\n')
+
+    def test_parse_plan_schema_edits(self):
+        """
+        Confirm rows are parsed against the schema after direct edits to it.
+        """
+        a = arff.ArffFile(relation='test', schema=[('x', 'integer'), ('cls', ('a', 'b'))])
+        a.append([1, 'a'])
+        a.attribute_data['cls'] = ['a', 'b', 'c']
+        a.append([2, 'c'])
+        a.attribute_types['x'] = arff.TYPE_NUMERIC
+        a.append(['1.5', 'b'])
+        a.attributes.reverse()
+        a.append(['a', '3'])
+        self.assertEqual(a.data, [[1, 'a'], [2, 'c'], [Decimal('1.5'), 'b'], ['a', Decimal('3')]])
+
+    def test_attribute_index(self):
+        """
+        Confirm the attribute index follows appends and reorderings.
+        """
+        a = arff.ArffFile(relation='test')
+        a.append(dict(b=Num(1), cls=Nom('x', cls=True)))
+        a.append(dict(c=Num(2), a=Num(3), cls=Nom('y', cls=True)))
+        self.assertEqual(a.attributes[-1], 'cls')
+        self.assertEqual(a.attribute_index, dict((n, i) for i, n in enumerate(a.attributes)))
+        a.alphabetize_attributes()
+        self.assertEqual(a.attributes, ['a', 'b', 'c', 'cls'])
+        self.assertEqual(a.attribute_index, {'a': 0, 'b': 1, 'c': 2, 'cls': 3})
+        a.set_class('a')
+        self.assertEqual(a.attribute_index, {'b': 0, 'c': 1, 'cls': 2, 'a': 3})
+        a.define_attribute('d', arff.TYPE_NUMERIC)
+        self.assertEqual(a.attribute_index['d'], 4)
+        a.attributes = ['d', 'c']
+        self.assertEqual(a.attribute_index, {'d': 0, 'c': 1})
+        
+        # Reordering the list in place is noticed too.
+        a = arff.ArffFile(relation='test', schema=[('c', 'numeric'), ('b', 'numeric'), ('a', 'numeric')])
+        self.assertEqual(a.attribute_index['a'], 2)
+        a.attributes.sort()
+        a.set_class('b')
+        self.assertEqual(a.attributes, ['a', 'c', 'b'])
+
+    def test_nominal_values(self):
+        """
+        Confirm nominal values keep their declared order and codes.
+        """
+        values = arff.NominalValues(['yes', 'no'])
+        values.update(set(['maybe', 'never']))
+        self.assertEqual(list(values), ['yes', 'no', 'maybe', 'never'])
+        self.assertEqual(values.code('maybe'), 2)
+        self.assertEqual(values.value(3), 'never')
+        self.assertEqual(values.add('no'), 1)
+        self.assertRaises(KeyError, values.code, 'other')
+        self.assertEqual(pickle.loads(pickle.dumps(values)), values)
+        
+        a = arff.ArffFile.parse("""@relation test
+@attribute a {yes,no}
+@data
+yes
+yes
+{0 no}
+""")
+        self.assertEqual(a.attribute_data['a'], arff.NominalValues(['yes', 'no']))
+        self.assertTrue(a.data[0][0] is a.data[1][0])
+        self.assertTrue(a.data[2]['a'].value is a.attribute_data['a'].value(1))
+        with self.assertRaises(Exception):
+            a.append(['maybe'])
+        
+        # Predictions are decoded in the declared order, not sorted.
+        query = arff.ArffFile.parse("""@relation test
+@attribute class {yes,no}
+@data
+?
+""")
+        stdout_str = """
+ inst#     actual  predicted error distribution
+     1        1:?       2:no       0.2,*0.8
+"""
+        result, = classifiers.parse_predictions(stdout_str, query, distribution=True)
+        self.assertEqual(result.predicted, 'no')
+        self.assertEqual(result.probability, {'yes': 0.2, 'no': 0.8})
+        
+        # List methods still work for callers expecting a list.
+        self.assertEqual(values.index('maybe'), 2)
+        self.assertRaises(ValueError, values.index, 'other')
+        values.append('other')
+        self.assertEqual(values, ['yes', 'no', 'maybe', 'never', 'other'])
+
+    def test_predict_nominal(self):
+        """
+        Confirm nominal class predictions are decoded into their labels.
+        """
+        self.use_fake_weka()
+        train_data = arff.ArffFile(relation='test', schema=[('x', 'numeric'), ('cls', ('yes', 'no', 'maybe'))])
+        for x, cls in ((1, 'no'), (2, 'no'), (3, 'yes')):
+            train_data.append([x, cls])
+        c = Classifier(name='weka.classifiers.lazy.IBk')
+        c.train(train_data)
+        query = train_data.copy(schema_only=True)
+        query.append([4, '?'])
+        query.append([5, '?'])
+        predictions = list(c.predict(query))
+        self.assertEqual([p.predicted for p in predictions], ['no', 'no'])
+        self.assertEqual(predictions[0].probability, 1.0)
+        prediction = list(c.predict(query, distribution=True))[0]
+        self.assertEqual(prediction.probability, {'maybe': 0.0, 'no': 1.0, 'yes': 0.0})
+
+    def test_sparse_row(self):
+        """
+        Confirm sparse lines are stored compactly but still read like dicts.
+        """
+        text = """% 
+@relation test
+@attribute a numeric
+@attribute b string
+@attribute c {x,y}
+@data
+{2 y, 0 1.5}
+{1 "hello world", 2 ?}
+"""
+        a = arff.ArffFile.parse(text)
+        row = a.data[0]
+        self.assertTrue(isinstance(row, arff.SparseRow))
+        self.assertEqual(row, {'a': Num(1.5), 'c': Nom('y')})
+        self.assertEqual(list(row), ['a', 'c'])
+        self.assertEqual(len(row), 2)
+        self.assertTrue('c' in row)
+        self.assertFalse('b' in row)
+        self.assertEqual(row.get('b'), None)
+        self.assertEqual(row['c'].c_type, arff.TYPE_NOMINAL)
+        self.assertEqual(a.data[1]['c'], Str('?'))
+        self.assertTrue(a.write().endswith('@data\n{0 1.5, 2 y}\n{1 "hello world", 2 ?}\n'))
+        
+        row['b'] = Str('hi')
+        del row['c']
+        self.assertEqual(row, {'a': Num(1.5), 'b': Str('hi')})
+        self.assertRaises(KeyError, row.__setitem__, 'd', Num(1))
+        self.assertEqual(pickle.loads(pickle.dumps(row)), row)
+        self.assertEqual(a.copy().data, a.data)
+
+    def test_date_codec(self):
+        """
+        Confirm dates are parsed and formatted with the attribute's pattern.
+        """
+        codec = arff.DateCodec()
+        self.assertEqual(codec.parse('2017-12-01 10:20:30'), datetime(2017, 12, 1, 10, 20, 30))
+        # Other formats fall back to dateutil.
+        self.assertEqual(codec.format('Dec 1 2017 10:20:30'), '2017-12-01 10:20:30')
+        self.assertEqual(codec.format(datetime(2017, 12, 1, 10, 20, 30, 5)), '2017-12-01 10:20:30')
+        
+        codec = arff.DateCodec('dd/MM/yyyy', cache_size=1)
+        self.assertEqual(codec.format(datetime(2017, 12, 1)), '01/12/2017')
+        self.assertEqual(codec.parse('01/12/2017'), datetime(2017, 12, 1))
+        self.assertEqual(codec.format('2017-12-02'), '02/12/2017')
+        
+        a = arff.ArffFile(relation='test')
+        a.define_attribute('t', arff.TYPE_DATE)
+        codec = a.get_date_codec('t')
+        self.assertTrue(a.get_date_codec('t') is codec)
+        a.attribute_data['t'] = 'yyyy'
+        self.assertEqual(a.get_date_codec('t').format('2017-12-01'), '2017')
+        
+        # Columns format dates with the same codec.
+        if arff.np is not None:
+            a.append({'t': Date('2017-12-01')})
+            self.assertEqual(a.to_numpy().write(), a.write())
+            self.assertTrue(a.write().endswith('{0 2017}\n'))
+
+    def test_views(self):
+        """
+        Confirm views share row objects, but not the lists holding them,
+        while copies share neither.
+        """
+        a = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-train.arff'))
+        rows = list(a.data)
+        b = a.copy()
+        self.assertEqual(b.data, rows)
+        self.assertFalse(b.data[0] is a.data[0])
+        b.data[0][1] = Num(0)
+        self.assertEqual(a.data[0], rows[0])
+        self.assertNotEqual(a.data[0][1], Num(0))
+        
+        b = a.view()
+        self.assertEqual(b.data, rows)
+        self.assertTrue(b.data[0] is a.data[0])
+        # The source keeps its plain list.
+        self.assertTrue(type(a.data) is list)
+        json.dumps(a.data, default=str)
+        b.data.append(rows[0])
+        a.data[0] = rows[1]
+        self.assertEqual(len(b.data), len(rows) + 1)
+        self.assertEqual(b.data[0], rows[0])
+        self.assertEqual(len(a.data), len(rows))
+        self.assertEqual(b.copy().data, b.data)
+        
+        train = a.view([i % 4 != 0 for i in range(len(rows))])
+        test = a.view(lambda row: row[0] == 'M')
+        self.assertTrue(test.data[0] is a.data[0])
+        self.assertEqual(a.filter(lambda row: row[0] == 'M').data, list(test.data))
+        self.assertFalse(a.filter(lambda row: row[0] == 'M').data[0] is test.data[0])
+        self.assertEqual(len(train), len(rows) - (len(rows) + 3)//4)
+        self.assertEqual(list(test.data), [row for row in a.data if row[0] == 'M'])
+        self.assertEqual(train.write(), a.write().split('@data')[0] + '@data\n' + ''.join(
+            a.write_line(row) + '\n' for i, row in enumerate(a.data) if i % 4))
+        
+        c = test.select(['Class_Rings', 'Sex'])
+        self.assertEqual(c.attributes, ['Sex', 'Class_Rings'])
+        self.assertEqual(c.data[0], [test.data[0][0], test.data[0][-1]])
+        self.assertEqual(c.filter([True] + [False]*(len(c) - 1)).data, [c.data[0]])
+        self.assertEqual(pickle.loads(pickle.dumps(c.data)), list(c.data))
+        
+        s = arff.ArffFile.parse("""@relation test
+@attribute a numeric
+@attribute b numeric
+@data
+{0 1, 1 2}
+{1 3}
+""").select(['b'])
+        self.assertEqual(list(s.data), [{'b': Num(2)}, {'b': Num(3)}])
+        self.assertTrue(s.write().endswith('@data\n{0 2.0}\n{0 3.0}\n'))
+
+    def test_iteration_modes(self):
+        """
+        Confirm rows can be iterated as dicts, tuples, records or batches.
+        """
+        a = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-train.arff'))
+        rows = [tuple(row) for row in a.data]
+        self.assertEqual(list(a.iter_tuples()), rows)
+        self.assertEqual([dict(zip(a.attributes, row)) for row in rows], list(a))
+        records = list(a.iter_records())
+        self.assertEqual(records[0].Whole_weight, rows[0][4])
+        self.assertEqual(records[0].Class_Rings, rows[0][-1])
+        batches = list(a.iter_batches(batch_size=2))
+        self.assertEqual(len(batches), (len(rows) + 1)//2)
+        self.assertEqual(batches[0]['Sex'], (rows[0][0], rows[1][0]))
+        
+        s = arff.ArffFile(relation='test')
+        s.append({'a': Num(1.5), 'b': Int(2, cls=True)})
+        s.append({'b': Int(3, cls=True)})
+        self.assertEqual(list(s.iter_tuples()), [(1.5, 2), (None, 3)])
+        self.assertEqual(list(s), [{'a': Num(1.5), 'b': Int(2)}, {'b': Int(3)}])
+        # Quoted keys outside the attributes are still cleaned.
+        s.data.append({"'c'": 1})
+        self.assertEqual(list(s)[-1], {'c': 1})
+
+    def test_append_many(self):
+        """
+        Confirm batches of rows are streamed the same as single rows.
+        """
+        def get_rows():
+            return [
+                dict(Sex=Nom('M'), Length=Num(0.35), Class_Rings=Int(15, cls=True)),
+                dict(Sex=Nom('F'), Length=Num(0.5), Class_Rings=Int(7, cls=True)),
+                # Values outside the schema are dropped.
+                dict(Sex=Nom('N'), Length=Num(0.25), Other=Num(1), Class_Rings=Int(9, cls=True)),
+            ]
+        a = arff.ArffFile(relation='test')
+        for row in get_rows()[:2]:
+            a.append(row, schema_only=True)
+        a.alphabetize_attributes()
+        
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        a.open_stream(fn=os.path.join(tmp_dir, 'single.arff'), buffer_size=10)
+        for row in get_rows():
+            a.append(row)
+        single = open(a.close_stream()).read()
+        
+        a.open_stream(fn=os.path.join(tmp_dir, 'many.arff'))
+        a.append_many(get_rows())
+        a.append_many([[Decimal('0.75'), 'F', 3]])
+        a.flush()
+        self.assertTrue(open(os.path.join(tmp_dir, 'many.arff')).read().endswith('{0 0.75, 1 F, 2 3}\n'))
+        many = open(a.close_stream()).read()
+        self.assertEqual(many, single + '{0 0.75, 1 F, 2 3}\n')
+        self.assertTrue(single.endswith('@data\n{0 0.35, 1 M, 2 15}\n{0 0.5, 1 F, 2 7}\n{0 0.25, 2 9}\n'))
+        self.assertEqual(a.data, [])
+
+    def test_prediction_worker(self):
+        """
+        Confirm a worker answers repeated predictions from the same process.
+        """
+        c = Classifier(name='weka.classifiers.lazy.IBk', model_data=b'7')
+        c.worker = PredictionWorker(command=[sys.executable, os.path.join(BP, 'fixtures/fake_weka_worker.py')])
+        query_fn = os.path.join(BP, 'fixtures/abalone-query.arff')
+        try:
+            predictions = list(c.predict(query_fn))
+            self.assertEqual(predictions,
+                [PredictionResult(actual=None, predicted=7, probability=None)])
+            pid = c.worker.process.pid
+            
+            query = arff.ArffFile.load(query_fn)
+            query.append(['F', 0.5, 0.4, 0.1, 0.3, 0.1, 0.05, 0.1, '?'])
+            predictions = list(c.predict(query))
+            self.assertEqual(len(predictions), 2)
+            self.assertEqual(c.worker.process.pid, pid)
+            
+            # Retraining swaps the model held by the worker.
+            c._model_data = b'9'
+            predictions = list(c.predict(query_fn))
+            self.assertEqual(predictions[0].predicted, 9)
+            self.assertEqual(c.worker.process.pid, pid)
+            
+            # The worker isn't pickled with the classifier.
+            fn = os.path.join(BP, 'fixtures/IBk.worker.pkl')
+            c.save(fn)
+            c2 = Classifier.load(fn)
+            os.remove(fn + '.gz')
+            self.assertEqual(c2.worker, None)
+            self.assertEqual(c2._model_data, b'9')
+        finally:
+            c.worker.close()
+        self.assertEqual(c.worker.process, None)
+
+    def test_private_directory(self):
+        """
+        Confirm the server is only compiled into a directory closed to other users.
+        """
+        path = get_private_directory('pywekaclassifiers-test')
+        self.addCleanup(os.rmdir, path)
+        self.assertEqual(get_private_directory('pywekaclassifiers-test'), path)
+        if hasattr(os, 'getuid'):
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+            os.chmod(path, 0o777)
+            with self.assertRaises(Exception):
+                get_private_directory('pywekaclassifiers-test')
+            os.chmod(path, 0o700)
+
+    def test_worker_pool(self):
+        """
+        Confirm a pool keeps the most recently used models loaded.
+        """
+        command = [sys.executable, os.path.join(BP, 'fixtures/fake_weka_worker.py')]
+        query_fn = os.path.join(BP, 'fixtures/abalone-query.arff')
+        models = [Classifier(name='weka.classifiers.lazy.IBk', model_data=str(i).encode()) for i in range(3)]
+        with WorkerPool(size=2, models_per_worker=1, command=command) as pool:
+            for c in models:
+                c.worker = pool
+            for c in models[:2]:
+                self.assertEqual(list(c.predict(query_fn))[0].predicted, int(c._model_data))
+            self.assertEqual((pool.hits, pool.misses, pool.evictions), (0, 2, 0))
+            self.assertEqual(len(pool.workers), 2)
+            
+            # Resident models are answered by the worker holding them.
+            self.assertEqual(list(models[1].predict(query_fn))[0].predicted, 1)
+            self.assertEqual(list(models[0].predict(query_fn))[0].predicted, 0)
+            self.assertEqual((pool.hits, pool.misses, pool.evictions), (2, 2, 0))
+            
+            # A new model replaces the least recently used one.
+            self.assertEqual(list(models[2].predict(query_fn))[0].predicted, 2)
+            self.assertEqual((pool.hits, pool.misses, pool.evictions), (2, 3, 1))
+            self.assertEqual(len(pool.workers), 2)
+            self.assertEqual(pool.model_keys, set(get_model_key(c._model_data) for c in (models[0], models[2])))
+            
+            # Workers busy predicting are still matched to their models.
+            with pool.workers[0]._lock, pool.workers[1]._lock:
+                for c in (models[0], models[2]):
+                    key = get_model_key(c._model_data)
+                    self.assertTrue(key in pool.get_worker(key).get_models())
+            
+            # Predicting concurrently keeps each worker's models consistent.
+            results = []
+            threads = [
+                threading.Thread(target=lambda c=c: results.append(
+                    (list(c.predict(query_fn))[0].predicted, int(c._model_data))))
+                for c in models*5]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(results), 15)
+            self.assertTrue(all(predicted == expected for predicted, expected in results))
+            for worker in pool.workers:
+                self.assertEqual(len(worker.get_models()), 1)
+        self.assertEqual(pool.workers, [])
+
+    def test_iter_rows(self):
+        """
+        Confirm rows read lazily match those loaded into memory.
+        """
+        fn = os.path.join(BP, 'fixtures/abalone.arff')
+        data = arff.ArffFile.load(fn)
+        rows = list(arff.ArffFile.iter_rows(fn))
+        self.assertEqual(len(rows), 4177)
+        self.assertEqual(rows, data.data)
+        
+        with arff.ArffReader(fn) as reader:
+            self.assertEqual(reader.schema.attributes, data.attributes)
+            self.assertEqual(len(reader.schema.data), 0)
+            self.assertEqual(next(iter(reader)), data.data[0])
+        
+        # Sparse rows are read as dictionaries.
+        a = arff.ArffFile(relation='test')
+        a.append({'a': Num(1.5), 'b': Nom('x'), 'c': Int(3, cls=True)})
+        a.append({'b': Nom('y'), 'c': Int(4, cls=True)})
+        fn = os.path.join(BP, 'fixtures/sparse.tmp.arff')
+        a.save(fn)
+        try:
+            rows = list(arff.ArffFile.iter_rows(fn))
+        finally:
+            os.remove(fn)
+        self.assertEqual(rows, arff.ArffFile.parse(a.write()).data)
+        self.assertEqual(rows[1], {'b': Nom('y'), 'c': Int(4)})
+
+    @unittest.skipIf(arff.np is None, 'NumPy is not installed.')
+    def test_numpy(self):
+        """
+        Confirm the columnar storage round-trips the row storage.
+        """
+        fn = os.path.join(BP, 'fixtures/abalone.arff')
+        data = arff.ArffFile.load(fn)
+        columns = data.to_numpy()
+        self.assertEqual(len(columns), 4177)
+        self.assertEqual(str(columns['Length'].dtype), 'float64')
+        self.assertEqual(str(columns['Class_Rings'].dtype), 'int64')
+        self.assertEqual(columns.nominal_values['Sex'], ['M', 'F', 'I'])
+        self.assertEqual(list(columns['Sex'][:3]), [0, 0, 1])
+        self.assertEqual(list(columns[1:3].decode('Sex')), ['M', 'F'])
+        self.assertEqual(arff.ArffFile.from_numpy(columns).data, data.data)
+        
+        # Writing whole columns gives the same output as writing rows.
+        self.assertEqual(columns.write(chunk_size=1000), data.write())
+        self.assertEqual(columns.write(fmt=DENSE, chunk_size=1000),
+            arff.ArffFile.from_numpy(columns).write(fmt=DENSE))
+        
+        # Filling the columns straight from the file gives the same result.
+        columns2 = arff.ArffColumns.load(fn)
+        for name in data.attributes:
+            self.assertTrue((columns[name] == columns2[name]).all())
+        
+        # Missing values are masked.
+        query = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-query.arff'))
+        columns = query.to_numpy()
+        self.assertEqual(list(columns.missing['Class_Rings']), [True])
+        self.assertEqual(list(columns.missing['Length']), [False])
+        self.assertEqual(arff.ArffFile.from_numpy(columns).data, query.data)
+        
+        # Values omitted from sparse rows are read as zero.
+        a = arff.ArffFile(relation='test')
+        a.append({'a': Num(1.5), 'b': Nom('x'), 'c': Int(3, cls=True)})
+        a.append({'b': Nom('y'), 'c': Int(4, cls=True)})
+        columns = a.to_numpy()
+        self.assertEqual(list(columns['a']), [1.5, 0])
+        self.assertEqual(list(columns.missing['a']), [False, False])
+        self.assertEqual(list(columns.decode('b')), ['x', 'y'])
+        
+        # Lines are split the same way as when reading rows, quoted sparse
+        # values included, and dense lines of the wrong length are skipped.
+        fn = os.path.join(BP, 'fixtures/columns.tmp.arff')
+        with open(fn, 'w') as fout:
+            fout.write("@relation test\n@attribute a numeric\n@attribute b string\n@data\n"
+                "1,x\n2\n{0 3, 1 'y z'}\n")
+        self.addCleanup(os.remove, fn)
+        rows = arff.ArffFile.load(fn)
+        columns = arff.ArffColumns.load(fn)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(list(columns['a']), [1, 3])
+        self.assertEqual(list(columns['b']), ['x', 'y z'])
+        self.assertEqual(rows.data[1]['b'], Str('y z'))
+
+    @unittest.skipIf(arff.np is None, 'NumPy not installed.')
+    def test_binary(self):
+        """
+        Confirm data round-trips through the binary format in both layouts.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        fn = os.path.join(tmp_dir, 'data.bin')
+        data = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone.arff'))
+        data.class_attr_name = 'Class_Rings'
+        columns = data.to_numpy()
+        for fmt in (DENSE, arff.SPARSE):
+            data.save_binary(fn, fmt=fmt)
+            columns2 = arff.ArffColumns.load_binary(fn)
+            self.assertEqual(columns2.schema.class_attr_name, 'Class_Rings')
+            self.assertEqual(columns2.nominal_values, columns.nominal_values)
+            self.assertEqual(columns2.write(), columns.write())
+            self.assertEqual(arff.ArffFile.load_binary(fn).data, data.data)
+        
+        # Closing releases the memory mapped file.
+        with arff.ArffColumns.load_binary(fn) as columns2:
+            self.assertEqual(len(columns2), len(data))
+            mm = columns2._memmap._mmap
+        self.assertTrue(mm.closed)
+        self.assertEqual(columns2.columns, {})
+        
+        # Missing values, strings and sparse rows are kept.
+        a = arff.ArffFile(relation='test')
+        a.append({'a': Num(1.5), 'b': Nom('x'), 's': Str('hello world'), 'c': Int(3, cls=True)})
+        a.append({'b': Nom('y'), 's': Str('?'), 'c': Int(4, cls=True)})
+        a.append({'a': Num('?'), 'c': Int(5, cls=True)})
+        columns = a.to_numpy()
+        a.save_binary(fn)
+        columns2 = arff.ArffColumns.load_binary(fn, memory_map=False)
+        for name in a.attributes:
+            self.assertEqual(list(columns2[name]), list(columns[name]))
+            self.assertEqual(list(columns2.missing[name]), list(columns.missing[name]))
+        arff_fn = os.path.join(tmp_dir, 'data.arff')
+        arff.convert_binary_to_arff(fn, arff_fn)
+        self.assertEqual(open(arff_fn).read(), columns.write())
+
+    def test_numeric_type(self):
+        """
+        Confirm numeric values can be kept as floats instead of Decimals.
+        """
+        fn = os.path.join(BP, 'fixtures/abalone.arff')
+        data = arff.ArffFile.load(fn)
+        self.assertTrue(isinstance(data.data[0][1], Decimal))
+        data = arff.ArffFile.load(fn, numeric_type=float)
+        self.assertEqual(data.data[0][:3], ['M', 0.455, 0.365])
+        self.assertTrue(isinstance(data.data[0][1], float))
+        self.assertTrue(isinstance(data.data[0][-1], int))
+        self.assertEqual(data.copy().numeric_type, float)
+        self.assertEqual(data.get_attribute_value('Length', '0.5'), 0.5)
+        self.assertTrue(isinstance(next(arff.ArffFile.iter_rows(fn, numeric_type=float))[1], float))
+        
+        data.append(['F', 1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(data.data[-1][1:3], [1.0, 2.0])
+        self.assertTrue(isinstance(data.data[-1][1], float))
+        
+        # Averaging keeps the type of the predictions.
+        avg = PredictionResult.avg(
+            PredictionResult(actual=None, predicted=1.0, probability=None),
+            PredictionResult(actual=None, predicted=2.0, probability=None))
+        self.assertEqual(avg.predicted, 1.5)
+        self.assertTrue(isinstance(avg.predicted, float))
+        avg = PredictionResult.avg(
+            PredictionResult(actual=None, predicted=Decimal('1'), probability=None),
+            PredictionResult(actual=None, predicted=Decimal('2'), probability=None))
+        self.assertEqual(avg.predicted, Decimal('1.5'))
+        
+        c = Classifier(name='weka.classifiers.lazy.IBk', model_data=b'7.5', numeric_type=float)
+        c.worker = PredictionWorker(command=[sys.executable, os.path.join(BP, 'fixtures/fake_weka_worker.py')])
+        try:
+            query = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-query.arff'), numeric_type=float)
+            query.attribute_types['Class_Rings'] = arff.TYPE_NUMERIC
+            predictions = list(c.predict(query))
+        finally:
+            c.worker.close()
+        self.assertEqual(predictions[0].predicted, 7.5)
+        self.assertTrue(isinstance(predictions[0].predicted, float))
+
+    def test_model_cache(self):
+        """
+        Confirm models are only written to disk once and evicted by LRU.
+        """
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = ModelCache(cache_dir, max_files=2)
+        fn1 = cache.get(b'model1')
+        self.assertEqual(cache.get(b'model1'), fn1)
+        self.assertEqual(open(fn1, 'rb').read(), b'model1')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.get(b'model2')
+        cache.get(b'model3')
+        self.assertFalse(b'model1' in cache)
+        self.assertTrue(b'model2' in cache)
+        cache.get(b'model2')
+        cache.get(b'model4')
+        self.assertFalse(b'model3' in cache)
+        self.assertTrue(b'model2' in cache)
+        cache.clear()
+        self.assertEqual(os.listdir(cache_dir), [])
+        
+        self.use_fake_weka()
+        c = Classifier(name='weka.classifiers.lazy.IBk')
+        c.model_cache = ModelCache(cache_dir)
+        c.train(os.path.join(BP, 'fixtures/abalone-train.arff'))
+        self.assertTrue(c._model_data in c.model_cache)
+        model_data = c._model_data
+        query_fn = os.path.join(BP, 'fixtures/abalone-query.arff')
+        for _ in range(3):
+            predictions = list(c.predict(query_fn))
+            self.assertEqual(len(predictions), 1)
+        self.assertEqual((c.model_cache.hits, c.model_cache.misses), (3, 0))
+        self.assertEqual(c._model_data, model_data)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        
+        # Incremental training loads the prior model from the cache.
+        c.train(os.path.join(BP, 'fixtures/abalone-train.arff'))
+        self.assertEqual(c.model_cache.hits, 4)
+        self.assertNotEqual(c._model_data, model_data)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_prediction_cache(self):
+        """
+        Confirm only uncached rows are sent to Weka and results are merged
+        back in query order.
+        """
+        cache = PredictionCache(max_entries=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 1, 1))
+        cache.ttl = -1
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 1)
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        disk_cache = DiskPredictionCache(cache_dir, max_files=2, evict_interval=1)
+        # By default, files are kept where other users can't plant them.
+        for default_cache in (DiskPredictionCache(), ModelCache()):
+            self.assertEqual(default_cache.directory, get_private_directory(default_cache.default_directory))
+        for key in 'abc':
+            disk_cache.set(key, PredictionResult(actual=None, predicted=key, probability=None))
+            time.sleep(0.01)
+        self.assertEqual(disk_cache.get('a'), None)
+        self.assertEqual(disk_cache.get('c').predicted, 'c')
+        self.assertEqual(disk_cache.hit_rate, 0.5)
+
+        class RecordingWorker(object):
+            # Predicts each row's first value, remembering how many rows it was sent.
+            sent = []
+            def predict(self, classifier, query_data, distribution=False, verbose=False):
+                self.sent.append(len(query_data.data))
+                for row in query_data.data:
+                    yield PredictionResult(actual=None, predicted=row[0], probability=None)
+
+        query = arff.ArffFile(relation='test', schema=[('x', 'integer'), ('y', 'integer')])
+        for x in (1, 2, 1, 3):
+            query.append([x, '?'])
+        c = Classifier(name='weka.classifiers.lazy.IBk', model_data=b'1')
+        c.worker = RecordingWorker()
+        for c.prediction_cache in (PredictionCache(), DiskPredictionCache(cache_dir)):
+            c.worker.sent[:] = []
+            c.prediction_cache.clear()
+            self.assertEqual([r.predicted for r in c.predict(query)], [1, 2, 1, 3])
+            self.assertEqual(c.worker.sent, [3])
+
+            query.data[2] = [4, '?']
+            self.assertEqual([r.predicted for r in c.predict(query)], [1, 2, 4, 3])
+            self.assertEqual(c.worker.sent, [3, 1])
+            self.assertEqual([r.predicted for r in c.predict(query)], [1, 2, 4, 3])
+            self.assertEqual(c.worker.sent, [3, 1])
+            self.assertEqual((c.prediction_cache.hits, c.prediction_cache.misses), (7, 4))
+            query.data[2] = [1, '?']
+
+            # Other models and distributions are cached separately.
+            c._model_data = b'2'
+            list(c.predict(query, distribution=True))
+            list(c.predict(query, cache=False))
+            self.assertEqual(c.worker.sent, [3, 1, 3, 4])
+            c._model_data = b'1'
+
+    def test_ensemble_train(self):
+        """
+        Confirm ensemble members are trained concurrently, slow members are
+        dropped and results are recorded in order.
+        """
+        self.use_fake_weka()
+        names = [
+            'weka.classifiers.lazy.IBk',
+            'weka.classifiers.rules.ZeroR',
+            'weka.classifiers.rules.OneR',
+            'weka.classifiers.bayes.NaiveBayes',
+        ]
+        self.set_fake_weka_options({
+            'weka.classifiers.lazy.IBk': {'sleep': 1},
+            'weka.classifiers.rules.ZeroR': {'sleep': 30},
+            'weka.classifiers.rules.OneR': {'fail': None},
+        })
+        training_data = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-train.arff'))
+        e = EnsembleClassifier(classes=names)
+        t0 = time.time()
+        e.train(training_data, max_workers=4, timeout=3)
+        self.assertTrue(time.time() - t0 < 10)
+        self.assertEqual(list(e.training_results), names)
+        self.assertEqual(sorted(e.trained_classifiers), [names[3], names[0]])
+        self.assertEqual(e.training_results[names[0]], (0.5, 1/1.5))
+        self.assertTrue('timed out' in e.training_results[names[1]])
+        self.assertTrue('failed' in e.training_results[names[2]])
+        self.assertEqual(e.trained_classifiers[names[3]].schema.attributes, training_data.attributes)
+
+    def test_ensemble_predict(self):
+        """
+        Confirm ensemble members are queried concurrently and slow members
+        are dropped once the deadline passes.
+        """
+        self.use_fake_weka()
+        names = [
+            'weka.classifiers.lazy.IBk',
+            'weka.classifiers.rules.ZeroR',
+            'weka.classifiers.bayes.NaiveBayes',
+        ]
+        e = EnsembleClassifier(classes=names)
+        e.train(os.path.join(BP, 'fixtures/abalone-train.arff'), max_workers=3)
+        query_data = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-query.arff'))
+        expected = e.predict(query_data, max_workers=3)
+        self.assertEqual(len(expected), 1)
+        self.assertEqual(sorted(e.prediction_results), sorted(names))
+        self.assertEqual(e.predict(query_data, max_workers=1), expected)
+        
+        self.set_fake_weka_options({'weka.classifiers.rules.ZeroR': {'sleep': 30}})
+        t0 = time.time()
+        results = e.predict(query_data, max_workers=3, deadline=2)
+        self.assertTrue(time.time() - t0 < 10)
+        self.assertEqual(results, expected)
+        self.assertTrue(isinstance(e.prediction_results[names[1]], str))
+        self.assertEqual(len(e.prediction_results[names[0]]), 1)
+
+    def test_grid_search(self):
+        """
+        Confirm option combinations are cross-validated in parallel, and
+        clearly losing ones are dropped early.
+        """
+        self.use_fake_weka()
+        data = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-train.arff'))
+        with GridSearch(data, folds=3, max_workers=3, stop_margin=0.6) as search:
+            best = search.run(IBk, {'K': [1, 2, 3, 4, 6]})
+            self.assertEqual(best.ckargs['K'], 3)
+            self.assertEqual(best.score, 1.0)
+            self.assertEqual(best.scores, [1.0]*3)
+            results = dict((result.ckargs['K'], result) for result in search.results)
+            # 1/(1+|K-3|) is within the margin only for K=2 and K=4.
+            self.assertEqual([len(results[k].scores) for k in (1, 2, 4, 6)], [1, 3, 3, 1])
+            self.assertTrue(results[1].stopped and results[6].stopped)
+            
+            # Folds are written once, and together cover the data exactly once.
+            folds = search.get_folds()
+            self.assertEqual(len(folds), 3)
+            self.assertEqual(
+                sum(len(arff.ArffFile.load(testing_fn)) for _, testing_fn in folds),
+                len(data))
+            fold_dir = os.path.dirname(folds[0][0])
+            best = search.run('weka.classifiers.lazy.IBk', {'K': [5], 'fail': [None]})
+            self.assertEqual(best, None)
+            self.assertTrue(search.results[-1].error)
+            self.assertEqual(search.best.ckargs['K'], 3)
+            self.assertTrue(search.get_folds() is folds)
+        self.assertFalse(os.path.exists(fold_dir))
+        
+        # Folds are scored on their held out data, not the training data
+        # Weka reports first.
+        c = IBk(K=5)
+        c.train(data, data)
+        self.assertEqual(c.training_correlation_coefficient, 0.2)
+        self.assertEqual(c.testing_correlation_coefficient, 0.3333)
+        self.assertEqual(c.testing_mean_absolute_error, 0.6667)
+        self.assertEqual(classifiers.get_test_score(c), 0.3333)
+
+    def test_predict_iter(self):
+        """
+        Confirm predictions are streamed back in chunks matching predict().
+        """
+        self.use_fake_weka()
+        train_fn = os.path.join(BP, 'fixtures/abalone-train.arff')
+        c = Classifier(name='weka.classifiers.lazy.IBk')
+        c.train(train_fn)
+        expected = list(c.predict(train_fn))
+        self.assertTrue(len(expected) > 7)
+        self.assertEqual(list(c.predict_iter(train_fn, chunk_size=7)), expected)
+        data = arff.ArffFile.load(train_fn)
+        self.assertEqual(list(c.predict_iter(data, chunk_size=7, pipeline=True)), expected)
+        self.assertEqual(list(c.predict_iter(iter(data.data), chunk_size=100, pipeline=True)), expected)
+        self.assertEqual(list(c.predict_iter(iter([]))), [])
+
+    def test_iter_predictions(self):
+        """
+        Confirm predictions are parsed as each line is read.
+        """
+        query = arff.ArffFile.parse("""@relation test
+@attribute a numeric
+@attribute class {no,yes}
+@data
+1,?
+""")
+        def read_lines():
+            yield '=== Predictions on test data ==='
+            yield ''
+            yield ' inst#     actual  predicted error distribution'
+            yield '     1        1:?      2:yes       0.2,*0.8'
+            raise IOError('Read too far.')
+        results = classifiers.iter_predictions(read_lines(), query, distribution=True)
+        result = next(results)
+        self.assertEqual(result.predicted, 'yes')
+        self.assertEqual(result.probability, {'no': 0.2, 'yes': 0.8})
+        
+        stdout_str = """
+=== Predictions on test data ===
+
+ inst#     actual  predicted error prediction
+     1        1:?      2:yes       0.8
+     2        1:?       1:no       0.6
+"""
+        results = list(classifiers.parse_predictions(stdout_str, query))
+        self.assertEqual([(_.predicted, _.probability) for _ in results], [('yes', 0.8), ('no', 0.6)])
+        self.assertRaises(AssertionError, list, classifiers.parse_predictions('', query))
+        
+        # Weka's errors are reported even after streaming its output.
+        self.use_fake_weka()
+        c = Classifier(name='weka.classifiers.lazy.IBk')
+        c.train(os.path.join(BP, 'fixtures/abalone-train.arff'))
+        self.set_fake_weka_options({'weka.classifiers.lazy.IBk': {'fail': None}})
+        predictions = c.predict(os.path.join(BP, 'fixtures/abalone-query.arff'))
+        self.assertRaises(PredictionError, list, predictions)
+
+    @unittest.skipIf(not hasattr(os, 'mkfifo'), 'Named pipes not supported.')
+    def test_pipe(self):
+        """
+        Confirm data can be streamed to Weka through named pipes.
+        """
+        self.use_fake_weka()
+        train_data = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-train.arff'))
+        query_data = arff.ArffFile.load(os.path.join(BP, 'fixtures/abalone-query.arff'))
+        c1 = Classifier(name='weka.classifiers.lazy.IBk')
+        c1.train(train_data)
+        c2 = Classifier(name='weka.classifiers.lazy.IBk')
+        c2.train(train_data, pipe=True)
+        model1 = json.loads(c1._model_data.decode('utf-8'))
+        model2 = json.loads(c2._model_data.decode('utf-8'))
+        self.assertEqual((model2['n'], model2['sum']), (model1['n'], model1['sum']))
+        self.assertEqual(c2.schema.attributes, train_data.attributes)
+        expected = list(c1.predict(query_data))
+        self.assertEqual(list(c2.predict(query_data, pipe=True)), expected)
+        self.assertEqual(list(c2.predict_iter(train_data, chunk_size=7, pipe=True)), list(c1.predict(train_data)))
+        
+        # The data is written again each time the pipe is opened.
+        with classifiers.ArffPipe(query_data) as pipe:
+            for _ in range(2):
+                self.assertEqual(arff.ArffFile.load(pipe.filename).write(), query_data.write())
+        self.assertFalse(os.path.exists(pipe.filename))
+        
+        # Errors writing the data end the file instead of leaving the reader
+        # waiting, and are raised once the pipe is closed.
+        bad_data = query_data.copy(schema_only=True)
+        bad_data.data = [['M', 0.35, 0.265, 0.09, 0.2255, 0.0995, 0.0485, 0.07, 'abc']]
+        pipe = classifiers.ArffPipe(bad_data)
+        with open(pipe.filename) as fin:
+            self.assertTrue(fin.read().startswith('%'))
+        with open(pipe.filename) as fin:
+            self.assertEqual(fin.read(), '')
+        with self.assertRaises(ValueError):
+            pipe.close()
+        with self.assertRaises(ValueError):
+            list(c2.predict(bad_data, pipe=True))
+
+    def test_open_indexed(self):
+        """
+        Confirm ranges of rows are read from an indexed file.
+        """
+        fn = os.path.join(BP, 'fixtures/abalone.arff')
+        data = arff.ArffFile.load(fn)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        index_fn = os.path.join(tmp_dir, 'abalone.idx')
+        with arff.ArffFile.open_indexed(fn, interval=7, index_filename=index_fn) as indexed:
+            self.assertEqual(len(indexed), len(data.data))
+            self.assertEqual(indexed.schema.attributes, data.attributes)
+            self.assertEqual(indexed[1000:2000].data, data.data[1000:2000])
+            self.assertEqual(indexed[5:100:3].data, data.data[5:100:3])
+            self.assertEqual(indexed[0], data.data[0])
+            self.assertEqual(indexed[-1], data.data[-1])
+            self.assertRaises(IndexError, indexed.__getitem__, len(data.data))
+            
+            # Interleaved iterators each keep their own position.
+            pairs = list(zip(indexed.iter_rows(0, 5), indexed.iter_rows(100, 105)))
+            self.assertEqual(pairs, list(zip(data.data[0:5], data.data[100:105])))
+        
+        # The saved index is reused only for the same interval and header.
+        builds = []
+        build_index = arff.IndexedArffFile._build_index
+        def _build_index(indexed, interval):
+            builds.append(interval)
+            build_index(indexed, interval)
+        arff.IndexedArffFile._build_index = _build_index
+        self.addCleanup(setattr, arff.IndexedArffFile, '_build_index', build_index)
+        with arff.ArffFile.open_indexed(fn, interval=7, index_filename=index_fn) as indexed:
+            self.assertEqual(indexed[4000:].data, data.data[4000:])
+        self.assertEqual(builds, [])
+        with arff.ArffFile.open_indexed(fn, interval=100, index_filename=index_fn) as indexed:
+            self.assertEqual(indexed.interval, 100)
+            self.assertEqual(indexed[4000:].data, data.data[4000:])
+        self.assertEqual(builds, [100])
+        moved_fn = os.path.join(tmp_dir, 'abalone.arff')
+        with open(fn) as fin, open(moved_fn, 'w') as fout:
+            fout.write('% An extra comment line.\n' + fin.read())
+        os.utime(index_fn, (time.time() + 10, time.time() + 10))
+        with arff.ArffFile.open_indexed(moved_fn, interval=100, index_filename=index_fn) as indexed:
+            self.assertEqual(indexed[4000:].data, data.data[4000:])
+        self.assertEqual(builds, [100, 100])
+
+    def test_compression(self):
+        """
+        Confirm compressed files are read and written transparently.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        train_fn = os.path.join(BP, 'fixtures/abalone-train.arff')
+        data = arff.ArffFile.load(train_fn)
+        extensions = ['.gz', '.bz2']
+        if arff.lzma is not None:
+            extensions.append('.xz')
+        for ext in extensions:
+            fn = os.path.join(tmp_dir, 'data.arff' + ext)
+            data.save(fn)
+            self.assertEqual(arff.get_compression(fn), arff.COMPRESSION_EXTENSIONS[ext])
+            self.assertNotEqual(open(fn, 'rb').read(), data.write().encode('utf-8'))
+            self.assertEqual(arff.ArffFile.load(fn).write(), data.write())
+        
+        # Compressed files are recognized by their contents.
+        fn = os.path.join(tmp_dir, 'data.arff')
+        shutil.copy(os.path.join(tmp_dir, 'data.arff.gz'), fn)
+        self.assertEqual(arff.get_compression(fn), arff.GZIP)
+        self.assertEqual(list(arff.ArffFile.iter_rows(fn)), arff.ArffFile.load(fn).data)
+        
+        # Streams are compressed as they're written.
+        fn = os.path.join(tmp_dir, 'stream.arff.gz')
+        stream = arff.ArffFile(relation='test')
+        stream.define_attribute('a', arff.TYPE_NUMERIC)
+        stream.define_attribute('b', arff.TYPE_INTEGER)
+        stream.open_stream(fn=fn)
+        stream.append({'a': Num(1.5), 'b': Int(2, cls=True)})
+        stream.close_stream()
+        self.assertEqual(arff.ArffFile.load(fn).data, [{'a': Num(1.5), 'b': Int(2)}])
+        
+        # Weka reads compressed files decompressed on the fly.
+        self.use_fake_weka()
+        c1 = Classifier(name='weka.classifiers.lazy.IBk')
+        c1.train(train_fn)
+        c2 = Classifier(name='weka.classifiers.lazy.IBk')
+        c2.train(os.path.join(tmp_dir, 'data.arff.bz2'))
+        self.assertEqual(json.loads(c2._model_data.decode('utf-8'))['sum'], json.loads(c1._model_data.decode('utf-8'))['sum'])
+        self.assertEqual(c2.schema.attributes, data.attributes)
+        self.assertEqual(list(c2.predict(os.path.join(tmp_dir, 'data.arff.gz'))), list(c1.predict(train_fn)))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,354 @@
+"""
+Long-lived Weka processes that keep a trained model loaded between
+predictions, so each query doesn't pay for JVM startup and model
+deserialization again.
+
+    from pywekaclassifiers.worker import PredictionWorker
+    c.worker = PredictionWorker()
+    predictions = c.predict('query.arff')
+
+Many classifiers can instead share a WorkerPool, which keeps the most
+recently used models loaded across a bounded number of processes.
+"""
+from __future__ import print_function, absolute_import
+
+import itertools
+import os
+import shutil
+import subprocess
+from subprocess import Popen, PIPE
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+from six import string_types as basestring # pylint: disable=redefined-builtin
+
+from pywekaclassifiers import arff
+from pywekaclassifiers.cache import get_model_key, get_private_directory
+from pywekaclassifiers.classifiers import BP, CP, JAVA, PredictionError, iter_predictions
+
+SERVER_CLASS = 'WekaPredictionServer'
+
+SERVER_SOURCE = os.path.join(BP, 'java', SERVER_CLASS + '.java')
+
+# Terminates a query sent to, and the predictions returned by, the server.
+END = '.'
+
+# Orders model uses across all workers.
+_use_counter = itertools.count()
+
+def get_server_command(class_dir=None):
+    """
+    Returns the command that launches the Java prediction server,
+    compiling it against the Weka JAR on first use.
+    
+    The class is compiled into a directory private to the current user,
+    unless another is given, and moved into place once complete, so
+    concurrent first uses never load a partial file.
+    """
+    class_dir = class_dir or get_private_directory('pywekaclassifiers-java')
+    class_fn = os.path.join(class_dir, SERVER_CLASS + '.class')
+    if not os.path.isfile(class_fn) \
+    or os.path.getmtime(class_fn) < os.path.getmtime(SERVER_SOURCE):
+        if not os.path.isdir(class_dir):
+            os.makedirs(class_dir)
+        tmp_dir = tempfile.mkdtemp(dir=class_dir)
+        try:
+            try:
+                subprocess.check_call(['javac', '-cp', CP, '-d', tmp_dir, SERVER_SOURCE])
+            except OSError as e:
+                raise PredictionError(
+                    'Compiling %s requires javac from a JDK (%s). Install one, or pass '
+                    'the command of an already compiled server to PredictionWorker.'
+                    % (SERVER_SOURCE, e))
+            os.rename(os.path.join(tmp_dir, SERVER_CLASS + '.class'), class_fn)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return [JAVA, '-cp', CP + os.pathsep + class_dir, SERVER_CLASS]
+
+class PredictionWorker(object):
+    """
+    Wraps a single prediction server process holding up to max_models
+    models at a time, unloading the least recently used one to make room
+    for another.
+
+    The command defaults to the bundled Java server, but any executable
+    speaking the same line protocol may be used instead.
+    """
+
+    def __init__(self, command=None, verbose=False, max_models=1):
+        assert max_models >= 1
+        self.command = command
+        self.verbose = verbose
+        self.max_models = max_models
+        self.process = None
+        self.model_key = None
+        # {model key: last use}, least recently used first.
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._model_fn = None
+        # Held while predicting, for the whole exchange with the server.
+        self._lock = threading.Lock()
+        # Held only while models is changed or copied, so a pool can see
+        # which models are loaded without waiting for a prediction.
+        self._models_lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception: # pylint: disable=broad-except
+            pass
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """
+        Launches the server process, unless it's already running.
+        """
+        if self.running:
+            return
+        command = self.command or get_server_command()
+        if self.verbose:
+            print(' '.join(command))
+        self.process = Popen(
+            command,
+            stdin=PIPE, stdout=PIPE,
+            universal_newlines=True,
+            close_fds=sys.platform != "win32")
+        self.model_key = None
+        with self._models_lock:
+            self.models.clear()
+
+    def close(self):
+        """
+        Stops the server process and removes its model file.
+        """
+        if self.process is not None:
+            if self.running:
+                try:
+                    self._send('quit')
+                    self.process.stdin.close()
+                except (IOError, OSError):
+                    pass
+                self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+        self.model_key = None
+        with self._models_lock:
+            self.models.clear()
+        if self._model_fn:
+            os.remove(self._model_fn)
+            self._model_fn = None
+
+    def _send(self, *lines):
+        for line in lines:
+            self.process.stdin.write(line + '\n')
+        self.process.stdin.flush()
+
+    def _read(self):
+        """
+        Reads lines up to the end of the current response.
+        """
+        lines = []
+        while 1:
+            line = self.process.stdout.readline()
+            if not line:
+                raise PredictionError('Prediction server exited unexpectedly.')
+            line = line.rstrip('\r\n')
+            if line.startswith('error '):
+                raise PredictionError(line[6:])
+            if line == END:
+                return lines
+            lines.append(line)
+
+    def _ok(self):
+        line = self.process.stdout.readline().rstrip('\r\n')
+        if line != 'ok':
+            if line.startswith('error '):
+                line = line[6:]
+            raise PredictionError(line or 'Prediction server exited unexpectedly.')
+
+    def get_models(self):
+        """
+        Returns a copy of models, which is safe to call while another
+        thread is loading one.
+        """
+        with self._models_lock:
+            return self.models.copy()
+
+    def load(self, model_data, model_fn=None):
+        """
+        Ensures the server holds the given model, unloading the least
+        recently used ones if it already holds max_models.
+        
+        If model_fn is given, the model is read from that file instead of
+        being written to the worker's own.
+        """
+        key = get_model_key(model_data)
+        if key in self.models and self.running:
+            with self._models_lock:
+                del self.models[key]
+                self.models[key] = next(_use_counter)
+            self.model_key = key
+            self.hits += 1
+            return key
+        self.misses += 1
+        self.start()
+        while len(self.models) >= self.max_models:
+            with self._models_lock:
+                old_key, _ = self.models.popitem(last=False)
+            self._send('unload %s' % old_key)
+            self._ok()
+            self.evictions += 1
+        self.model_key = None
+        if not model_fn:
+            if not self._model_fn:
+                fd, self._model_fn = tempfile.mkstemp()
+                os.close(fd)
+            with open(self._model_fn, 'wb') as fout:
+                fout.write(model_data)
+            model_fn = self._model_fn
+        self._send('load %s %s' % (key, model_fn))
+        self._ok()
+        with self._models_lock:
+            self.models[key] = next(_use_counter)
+        self.model_key = key
+        return key
+
+    def predict(self, classifier, query_data, distribution=False, verbose=False):
+        """
+        Iterates over the predictions made by the classifier's model for the
+        given ArffFile or ARFF filename, the same as Classifier.predict().
+        """
+        assert classifier._model_data, "You must train this classifier before predicting."
+        if isinstance(query_data, basestring):
+            assert os.path.isfile(query_data)
+            with arff.open_file(query_data) as fin:
+                query_str = fin.read()
+            numeric_type = classifier.numeric_type
+        else:
+            assert isinstance(query_data, arff.ArffFile), \
+                'Must be of type ArffFile, not "%s"' % type(query_data).__name__
+            query_str = query_data.write()
+            numeric_type = query_data.numeric_type
+        # Predictions are decoded against the schema as written, so nominal
+        # values are indexed in the same order Weka sees them.
+        query = arff.ArffFile.parse(query_str, schema_only=True, numeric_type=numeric_type)
+        model_fn = None
+        if classifier.model_cache is not None:
+            model_fn = classifier.model_cache.get(classifier._model_data)
+        with self._lock:
+            key = self.load(classifier._model_data, model_fn=model_fn)
+            self._send('predict %s %i' % (key, bool(distribution)))
+            self._send(*query_str.splitlines())
+            self._send(END)
+            lines = self._read()
+        if verbose:
+            print('stdout:')
+            print('\n'.join(lines))
+        return iter_predictions(lines, query, distribution=distribution)
+
+class WorkerPool(object):
+    """
+    Shares up to size prediction workers between any number of
+    classifiers, each worker keeping up to models_per_worker models loaded.
+
+    Predictions are sent to a worker already holding the classifier's model
+    when there is one. Otherwise the model is loaded into a new worker, or
+    once the pool is full, into the worker with the most free room or
+    holding the least recently used model, which is unloaded.
+
+        pool = WorkerPool(size=4, models_per_worker=50)
+        Classifier.worker = pool
+        ...
+        print(pool.hits, pool.misses, pool.evictions)
+    """
+
+    def __init__(self, size=2, models_per_worker=8, command=None, verbose=False):
+        assert size >= 1
+        self.size = size
+        self.models_per_worker = models_per_worker
+        self.command = command
+        self.verbose = verbose
+        self.workers = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def hits(self):
+        return sum(worker.hits for worker in self.workers)
+
+    @property
+    def misses(self):
+        return sum(worker.misses for worker in self.workers)
+
+    @property
+    def evictions(self):
+        return sum(worker.evictions for worker in self.workers)
+
+    @property
+    def model_keys(self):
+        """
+        The keys of all models currently loaded.
+        """
+        return set(key for worker in self.workers for key in worker.get_models())
+
+    def get_worker(self, model_key):
+        """
+        Returns the worker that should answer predictions for the given model.
+        """
+        with self._lock:
+            # Workers may be loading models in other threads, so each one's
+            # models are copied once instead of being read as they change.
+            workers = [(worker, worker.get_models()) for worker in self.workers]
+            for worker, models in workers:
+                if model_key in models and worker.running:
+                    return worker
+            if len(self.workers) < self.size:
+                worker = PredictionWorker(
+                    command=self.command,
+                    verbose=self.verbose,
+                    max_models=self.models_per_worker)
+                self.workers.append(worker)
+                return worker
+            def get_priority(args):
+                worker, models = args
+                if len(models) < worker.max_models:
+                    return (0, len(models))
+                return (1, next(iter(models.values()), 0))
+            return min(workers, key=get_priority)[0]
+
+    def predict(self, classifier, query_data, distribution=False, verbose=False):
+        """
+        Iterates over the predictions made by the classifier's model,
+        the same as PredictionWorker.predict().
+        """
+        assert classifier._model_data, "You must train this classifier before predicting."
+        worker = self.get_worker(get_model_key(classifier._model_data))
+        return worker.predict(classifier, query_data, distribution=distribution, verbose=verbose)
+
+    def close(self):
+        """
+        Stops all worker processes.
+        """
+        with self._lock:
+            for worker in self.workers:
+                worker.close()
+            self.workers = []
@@ -33,7 +33,8 @@ setup(name='pywekaclassifiers',
     packages=find_packages(),
     package_data={
         'pywekaclassifiers': [
-            'fixtures/*'
+            'fixtures/*',
+            'java/*',
         ],
     },
     classifiers=[
@@ -50,4 +51,7 @@ setup(name='pywekaclassifiers',
     ],
     platforms=['OS Independent'],
     install_requires=get_reqs('pip-requirements.txt'),
+    extras_require={
+        'numpy': ['numpy'],
+    },
 )